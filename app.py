@@ -1,29 +1,1932 @@
 import os
 import re
 import json
+import zlib
+import struct
+import tarfile
 import time
+import copy
+import shutil
+import socket
+import subprocess
+import atexit
+import sqlite3
+import hashlib
+import heapq
+import itertools
 import threading
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import yt_dlp
+import mimetypes
+import contextlib
+import functools
+import importlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from urllib.parse import urlparse, parse_qs, quote
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context, g, redirect
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
 
+# Módulo que se importa en el primer acceso a uno de sus atributos
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Importar yt-dlp carga cientos de extractores: el arranque y /health no esperan por ello
+yt_dlp = LazyModule('yt_dlp')
+
 # Cargar variables de entorno
 load_dotenv()
 
 app = Flask(__name__)
 
 # Configuración
-DOWNLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
-LOGS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
+LOGS_FOLDER = os.environ.get('LOGS_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
 
 # Crear directorios si no existen
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 os.makedirs(LOGS_FOLDER, exist_ok=True)
 
+# Límites del planificador de trabajos
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 3))   # Descargas simultáneas por nodo
+MAX_QUEUED_DOWNLOADS = int(os.environ.get('MAX_QUEUED_DOWNLOADS', 50))          # Trabajos en espera antes de responder 429
+MAX_POSTPROCESS_WORKERS = int(os.environ.get('MAX_POSTPROCESS_WORKERS', 1))     # Procesos ffmpeg simultáneos
+
+# Descarga paralela de los videos de una lista
+PLAYLIST_WORKERS = int(os.environ.get('PLAYLIST_WORKERS', 3))                   # Videos en paralelo por trabajo (por defecto)
+MAX_PLAYLIST_WORKERS = int(os.environ.get('MAX_PLAYLIST_WORKERS', 8))           # Máximo que puede pedir un trabajo
+MAX_PARALLEL_ENTRIES = int(os.environ.get('MAX_PARALLEL_ENTRIES', 9))           # Videos en paralelo en todo el nodo
+PLAYLIST_ENTRY_RETRIES = int(os.environ.get('PLAYLIST_ENTRY_RETRIES', 2))       # Reintentos por video fallido
+
+# Ancho de banda compartido entre trabajos (bytes/s, 0 = sin límite)
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))                     # Total del nodo, repartido entre trabajos activos
+JOB_BANDWIDTH_LIMIT = int(os.environ.get('JOB_BANDWIDTH_LIMIT', 0))             # Máximo por trabajo
+HTTP_CHUNK_SIZE = int(os.environ.get('HTTP_CHUNK_SIZE', 10485760))              # Tamaño de cada petición HTTP por rangos
+THROTTLE_BACKOFF = float(os.environ.get('THROTTLE_BACKOFF', 30))                 # Pausa tras el primer 429 de un sitio (se duplica)
+THROTTLE_MAX_BACKOFF = float(os.environ.get('THROTTLE_MAX_BACKOFF', 600))        # Pausa máxima
+THROTTLE_RECOVERY = float(os.environ.get('THROTTLE_RECOVERY', 60))               # Segundos sin 429 para recuperar una conexión
+BANDWIDTH_ACTIVE_WINDOW = 2.0                                                     # Un trabajo cuenta como activo si recibió bytes hace menos de esto
+
+# Ajuste automático de fragmentos simultáneos y tamaño de chunk según el rendimiento medido
+FRAGMENT_AUTOTUNE = os.environ.get('FRAGMENT_AUTOTUNE', 'True').lower() == 'true' # Desactivado: 3 fragmentos en listas y HTTP_CHUNK_SIZE fijo
+FRAGMENT_CONCURRENCY_MIN = int(os.environ.get('FRAGMENT_CONCURRENCY_MIN', 1))    # Fragmentos simultáneos por descarga
+FRAGMENT_CONCURRENCY_MAX = int(os.environ.get('FRAGMENT_CONCURRENCY_MAX', 16))
+HTTP_CHUNK_MIN = int(os.environ.get('HTTP_CHUNK_MIN', 1048576))                  # Límites del chunk ajustado
+HTTP_CHUNK_MAX = int(os.environ.get('HTTP_CHUNK_MAX', 52428800))
+MAX_FRAGMENT_CONNECTIONS = int(os.environ.get('MAX_FRAGMENT_CONNECTIONS', 64))   # Conexiones de fragmentos en todo el nodo (0 = sin límite)
+AUTOTUNE_INTERVAL = 5.0                                                           # Segundos de cada medición del rendimiento
+AUTOTUNE_GAIN = 0.1                                                               # Mejora mínima para mantener más conexiones
+AUTOTUNE_HOLD = 6                                                                 # Mediciones sin cambios antes de volver a probar
+AUTOTUNE_CHUNK_SECONDS = 4.0                                                      # Duración objetivo de cada petición por rangos
+
+# Modo de servicio: con gevent_worker.GeventWorker cada petición es un greenlet y socket/time llegan
+# parcheados; threading no, así que las descargas siguen en hilos reales del sistema
+try:
+    from gevent import monkey as gevent_monkey
+    ASYNC_SERVING = gevent_monkey.is_module_patched('socket')
+except ImportError:
+    ASYNC_SERVING = False
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', 8))                     # Extracciones de yt-dlp simultáneas desde la API
+ASYNC_STATUS_POLL = 0.25                                                          # Con gevent, cada cuánto mira un flujo SSE si cambió el estado
+
+# Pool de instancias de YoutubeDL reutilizadas entre tareas
+YTDLP_POOL_SIZE = int(os.environ.get('YTDLP_POOL_SIZE', 16))                     # Instancias libres que se conservan (0 = sin pool)
+YTDLP_POOL_MAX_USES = int(os.environ.get('YTDLP_POOL_MAX_USES', 200))            # Usos antes de reemplazar una instancia
+YTDLP_PREWARM = os.environ.get('YTDLP_PREWARM', 'True').lower() == 'true'        # Importar yt-dlp y crear instancias al arrancar, en segundo plano
+
+# Post-procesamiento: 'pipeline' (etapa ffmpeg propia tras la descarga) o 'inline' (dentro de yt-dlp)
+POSTPROCESS_MODE = os.environ.get('POSTPROCESS_MODE', 'pipeline').lower()
+FFMPEG_BINARY = shutil.which(os.environ.get('FFMPEG_BINARY', 'ffmpeg'))
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', 0)) or max(1, (os.cpu_count() or 1) // max(MAX_POSTPROCESS_WORKERS, 1))
+POSTPROCESS_PIPELINE = POSTPROCESS_MODE == 'pipeline' and FFMPEG_BINARY is not None
+AUDIO_BITRATE = os.environ.get('AUDIO_BITRATE', '192k')                          # Solo si hay que recodificar el audio
+
+# Lotes de URLs (/api/batch)
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS', 1000))                     # URLs por petición
+BATCH_EXTRACT_WORKERS = int(os.environ.get('BATCH_EXTRACT_WORKERS', 4))          # Extracciones en paralelo (compartidas por todos los lotes)
+BATCH_MAX_PENDING_JOBS = int(os.environ.get('BATCH_MAX_PENDING_JOBS', 10))       # Trabajos de un lote en cola o descargando a la vez
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))                          # Lotes en curso a la vez (los demás esperan turno)
+BATCH_TTL = 3600                                                                  # Segundos que se conserva un lote terminado
+BATCH_POLL = 5.0                                                                  # Respaldo para trabajos de un lote que terminan en otro proceso
+ACTIVE_BATCH_STATES = ('queued', 'expanding', 'extracting', 'downloading')
+
+# Caché de metadatos (listas aplanadas e información completa de videos)
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 256))            # Entradas en memoria (LRU)
+PLAYLIST_CACHE_TTL = int(os.environ.get('PLAYLIST_CACHE_TTL', 600))              # Segundos de validez de una lista
+VIDEO_INFO_CACHE_TTL = int(os.environ.get('VIDEO_INFO_CACHE_TTL', 300))          # Las URLs de los formatos caducan: TTL corto
+METADATA_CACHE_DIR = os.environ.get('METADATA_CACHE_DIR', '')                    # Directorio opcional para persistir la caché
+
+# Almacén compartido de archivos descargados (deduplicación entre trabajos)
+CONTENT_STORE_ENABLED = os.environ.get('CONTENT_STORE', 'True').lower() == 'true'
+STORE_FOLDER = os.path.join(DOWNLOAD_FOLDER, '_store')
+
+# Sincronización incremental de listas (tipo 'sync'): índice y archivos de cada lista
+SYNC_FOLDER = os.path.join(DOWNLOAD_FOLDER, '_sync')
+SYNC_RETRY_DELAY = 10                                                             # Segundos antes de reintentar si la lista ya se está sincronizando
+
+# Retención del directorio de descargas
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', 0))                # Presupuesto de disco (0 = sin límite)
+DOWNLOAD_MAX_AGE = int(os.environ.get('DOWNLOAD_MAX_AGE', 86400))                # Segundos desde el último acceso
+RETENTION_SWEEP_INTERVAL = int(os.environ.get('RETENTION_SWEEP_INTERVAL', 300))  # Frecuencia del barrido (0 = desactivado)
+RETENTION_GRACE = 600                                                             # No tocar archivos modificados hace menos de esto
+ACTIVE_JOB_STATES = ('queued', 'starting', 'downloading', 'postprocessing')
+LEFTOVER_SUFFIXES = ('.part', '.ytdl', '.json', '.webp', '.jpg', '.png', '.temp')
+
+# Índice de archivos finales de cada trabajo
+MANIFEST_NAME = '.manifest.jsonl'                                                # Archivo oculto en el directorio del trabajo
+FILES_PAGE_SIZE = int(os.environ.get('FILES_PAGE_SIZE', 500))                    # Archivos por página en /api/status y /api/downloads
+
+# Eventos de progreso (Server-Sent Events)
+SSE_MAX_RATE = float(os.environ.get('SSE_MAX_RATE', 2))                          # Eventos por segundo como máximo por trabajo
+SSE_KEEPALIVE = 15                                                                # Comentario de keep-alive si no hay cambios
+FINISHED_JOB_STATES = ('completed', 'partial', 'error')
+
+# Reproducción mientras se descarga (formatos de un solo archivo)
+STREAM_START_TIMEOUT = float(os.environ.get('STREAM_START_TIMEOUT', 120))       # Espera máxima hasta el primer byte
+STREAM_PROTOCOLS = ('http', 'https')                                             # Protocolos que escriben el archivo en orden
+
+# Publicación del progreso desde progress_hook
+PROGRESS_PUBLISH_INTERVAL = float(os.environ.get('PROGRESS_PUBLISH_INTERVAL', 0.25))  # Segundos entre actualizaciones del estado
+PROGRESS_HOOK_RECORD = os.environ.get('PROGRESS_HOOK_RECORD', '')                     # Archivo .jsonl para grabar eventos del hook
+
+# Almacén persistente del estado de los trabajos (compartido entre workers de gunicorn)
+JOB_STORE = os.environ.get('JOB_STORE', 'sqlite').lower()                             # 'sqlite' o 'memory'
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', os.path.join(DOWNLOAD_FOLDER, '_jobs.sqlite3'))
+JOB_STORE_FLUSH_INTERVAL = float(os.environ.get('JOB_STORE_FLUSH_INTERVAL', 1.0))      # Segundos entre escrituras en lote
+JOB_LEASE_TIMEOUT = float(os.environ.get('JOB_LEASE_TIMEOUT', 30))                   # Segundos sin renovar tras los que un trabajo activo se reanuda
+# Dueño único por arranque: tras reiniciar un contenedor, el hostname y los PID se repiten
+JOB_OWNER = f'{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}'
+
+# Modo distribuido: los nodos toman los trabajos de una cola compartida y se localizan entre sí
+CLUSTER_DB_PATH = os.environ.get('CLUSTER_DB_PATH', '')                              # SQLite compartida por los nodos (vacío = nodo independiente)
+NODE_ID = os.environ.get('NODE_ID', socket.gethostname())                            # Nodo al que pertenece este proceso (sus workers comparten disco)
+NODE_PUBLIC_URL = os.environ.get('NODE_PUBLIC_URL', '').rstrip('/')                  # URL a la que los demás nodos redirigen sus trabajos
+CLUSTER_HEARTBEAT = float(os.environ.get('CLUSTER_HEARTBEAT', 5))                    # Segundos entre latidos
+CLUSTER_NODE_TIMEOUT = float(os.environ.get('CLUSTER_NODE_TIMEOUT', 30))             # Sin latido durante esto, sus trabajos vuelven a la cola
+CLUSTER_POLL = 1.0                                                                   # Cada cuánto busca trabajo un nodo con workers libres
+
+# Entrega de archivos terminados: 'direct' (Python, con sendfile si el servidor lo ofrece),
+# 'x-accel' (nginx con X-Accel-Redirect) o 'x-sendfile' (Apache/lighttpd)
+FILE_SERVING_MODE = os.environ.get('FILE_SERVING_MODE', 'direct').lower()
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/internal-downloads/')      # location interna de nginx
+app.config['USE_X_SENDFILE'] = FILE_SERVING_MODE == 'x-sendfile'
+
+# Observabilidad: /metrics (formato de texto de Prometheus) y trazas por trabajo en logs/
+TRACE_SPANS = os.environ.get('TRACE_SPANS', 'True').lower() == 'true'
+SPANS_FILE = os.environ.get('SPANS_FILE', os.path.join(LOGS_FOLDER, 'spans.jsonl'))
+DISK_USAGE_CACHE_TTL = float(os.environ.get('DISK_USAGE_CACHE_TTL', 60))  # Segundos entre recorridos de DOWNLOAD_FOLDER
+
+# Métricas en memoria del proceso, expuestas sin dependencias externas
+class Metric:
+    def __init__(self, kind, name, documentation, labels=()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    @staticmethod
+    def _format_labels(names, values, extra=()):
+        pairs = list(zip(names, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+class Counter(Metric):
+    def __init__(self, name, documentation, labels=()):
+        super().__init__('counter', name, documentation, labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+class Gauge(Metric):
+    """Valor fijado con set() o calculado en cada lectura con una función."""
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__('gauge', name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), (), self.function())]
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__('histogram', name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append((self.name + '_bucket', key, (('le', repr(float(bound))),), cumulative))
+                result.append((self.name + '_bucket', key, (('le', '+Inf'),), count))
+                result.append((self.name + '_sum', key, (), total))
+                result.append((self.name + '_count', key, (), count))
+        return result
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, extra, value in metric.samples():
+                lines.append(f'{name}{metric._format_labels(metric.labels, key, extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+METRIC_JOBS_STARTED = metrics.register(Counter('ytdl_jobs_started_total', 'Trabajos que empezaron a ejecutarse', ('type',)))
+METRIC_JOBS_FINISHED = metrics.register(Counter('ytdl_jobs_finished_total', 'Trabajos terminados por estado final', ('type', 'status')))
+METRIC_STAGE_SECONDS = metrics.register(Histogram('ytdl_stage_seconds', 'Duración de cada etapa de un trabajo (cola, extracción, descarga, post-procesamiento...)', ('stage',), STAGE_BUCKETS))
+METRIC_POSTPROCESS_SECONDS = metrics.register(Histogram('ytdl_postprocess_seconds', 'Duración del post-procesamiento por tipo de postprocesador', ('postprocessor',), STAGE_BUCKETS))
+METRIC_DOWNLOADED_BYTES = metrics.register(Counter('ytdl_downloaded_bytes_total', 'Bytes descargados por yt-dlp'))
+METRIC_DOWNLOAD_SPEED = metrics.register(Histogram('ytdl_job_download_speed_bytes', 'Velocidad media de descarga de cada trabajo (bytes/s)', (), (1e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8)))
+METRIC_RETRIES = metrics.register(Counter('ytdl_retries_total', 'Reintentos de descarga (fragmento, http o video completo de una lista)', ('kind',)))
+METRIC_THROTTLES = metrics.register(Counter('ytdl_throttle_events_total', 'Episodios de throttling (HTTP 429) que redujeron las descargas simultáneas', ('host',)))
+METRIC_YTDLP_CHECKOUTS = metrics.register(Counter('ytdl_ytdlp_checkouts_total', 'Instancias de YoutubeDL entregadas por el pool (hit = reutilizada, miss = creada)', ('result',)))
+METRIC_HTTP_SECONDS = metrics.register(Histogram('ytdl_http_request_seconds', 'Latencia de las respuestas HTTP por endpoint', ('endpoint',)))
+
+# Trazas por trabajo: una línea JSON por etapa en SPANS_FILE
+spans_file = open(SPANS_FILE, 'a', encoding='utf-8', buffering=1) if TRACE_SPANS else None
+spans_lock = threading.Lock()
+
+def write_span(download_id, span, start, duration, **attrs):
+    if spans_file is None:
+        return
+    record = {'job': download_id, 'span': span, 'start': round(start, 3), 'duration': round(duration, 3)}
+    record.update(attrs)
+    line = json.dumps(record) + '\n'
+    with spans_lock:
+        spans_file.write(line)
+
 # Almacenamiento de estado de descargas
 download_status = {}
 
+# Versión de cada estado para despertar a los clientes SSE cuando cambia
+status_versions = {}
+status_changed = {}
+status_changed_lock = threading.Lock()
+
+def _status_condition(download_id):
+    with status_changed_lock:
+        cond = status_changed.get(download_id)
+        if cond is None:
+            cond = status_changed[download_id] = threading.Condition()
+        return cond
+
+# Lotes que esperan a que termine alguno de sus trabajos (download_id -> Event del lote)
+batch_waiters = {}
+
+def publish_status(download_id):
+    cond = _status_condition(download_id)
+    with cond:
+        status_versions[download_id] = status_versions.get(download_id, 0) + 1
+        cond.notify_all()
+    job_persister.mark_dirty(download_id)
+    waiter = batch_waiters.get(download_id)
+    if waiter is not None and download_status.get(download_id, {}).get('status') in FINISHED_JOB_STATES:
+        waiter.set()
+
+def wait_for_status_change(download_id, seen_version, timeout):
+    if ASYNC_SERVING:
+        # Un greenlet no puede esperar un Condition de hilos reales sin congelar el bucle de eventos
+        deadline = time.time() + timeout
+        while status_versions.get(download_id, 0) == seen_version and time.time() < deadline:
+            time.sleep(ASYNC_STATUS_POLL)
+        return status_versions.get(download_id, 0)
+    cond = _status_condition(download_id)
+    with cond:
+        cond.wait_for(lambda: status_versions.get(download_id, 0) != seen_version, timeout)
+        return status_versions.get(download_id, 0)
+
+# Backend sin persistencia: el estado vive solo en la memoria de cada proceso
+class MemoryJobStore:
+    def save_many(self, rows):
+        pass
+
+    def load(self, download_id):
+        return None
+
+    def delete(self, download_id):
+        pass
+
+    def touch(self, download_id, timestamp):
+        pass
+
+    def last_access(self, download_id):
+        return None
+
+    def renew(self, owner):
+        pass
+
+    def claim_interrupted(self, owner):
+        return []
+
+    def save_batch(self, batch_id, state, data):
+        pass
+
+    def load_batch(self, batch_id):
+        return None
+
+    def purge_batches(self, before):
+        pass
+
+    def claim_interrupted_batches(self, owner):
+        return []
+
+# Backend SQLite en modo WAL compartido por todos los workers (y reinicios) del nodo
+class SQLiteJobStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            state TEXT NOT NULL,
+            status TEXT NOT NULL,
+            options TEXT,
+            updated_at REAL NOT NULL,
+            last_access REAL
+        )
+    """
+    BATCH_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            state TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(self.SCHEMA)
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+        conn.execute(self.BATCH_SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        # Una conexión por hilo; sqlite3 no permite compartirlas entre hilos
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def save_many(self, rows):
+        """rows: lista de (id, estado, opciones o None)."""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                'INSERT INTO jobs (id, owner, state, status, options, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, state = excluded.state, status = excluded.status, '
+                'options = COALESCE(excluded.options, jobs.options), updated_at = excluded.updated_at',
+                [(download_id, JOB_OWNER, status.get('status', ''), json.dumps(status),
+                  json.dumps(options) if options is not None else None, now)
+                 for download_id, status, options in rows])
+
+    def load(self, download_id):
+        row = self._conn().execute('SELECT status FROM jobs WHERE id = ?', (download_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, download_id):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (download_id,))
+
+    def touch(self, download_id, timestamp):
+        # Último acceso en columna propia para que el dueño del trabajo no lo sobrescriba
+        conn = self._conn()
+        with conn:
+            conn.execute('UPDATE jobs SET last_access = ? WHERE id = ?', (timestamp, download_id))
+
+    def last_access(self, download_id):
+        row = self._conn().execute('SELECT last_access FROM jobs WHERE id = ?', (download_id,)).fetchone()
+        return row[0] if row else None
+
+    def renew(self, owner):
+        """Renueva la concesión de los trabajos y lotes activos de este proceso."""
+        conn = self._conn()
+        now = time.time()
+        placeholders = ','.join('?' * len(ACTIVE_JOB_STATES))
+        batch_placeholders = ','.join('?' * len(ACTIVE_BATCH_STATES))
+        with conn:
+            conn.execute(f'UPDATE jobs SET updated_at = ? WHERE owner = ? AND state IN ({placeholders})',
+                         (now, owner, *ACTIVE_JOB_STATES))
+            conn.execute(f'UPDATE batches SET updated_at = ? WHERE owner = ? AND state IN ({batch_placeholders})',
+                         (now, owner, *ACTIVE_BATCH_STATES))
+
+    def claim_interrupted(self, owner):
+        """Reclama los trabajos activos cuya concesión caducó; devuelve (id, estado, opciones)."""
+        conn = self._conn()
+        placeholders = ','.join('?' * len(ACTIVE_JOB_STATES))
+        rows = conn.execute(f'SELECT id, owner, status, options, updated_at FROM jobs WHERE state IN ({placeholders}) '
+                            'AND updated_at < ? AND options IS NOT NULL',
+                            (*ACTIVE_JOB_STATES, time.time() - JOB_LEASE_TIMEOUT)).fetchall()
+        claimed = []
+        for download_id, old_owner, status, options, updated_at in rows:
+            with conn:
+                # La condición sobre dueño y concesión hace que solo un worker gane el trabajo,
+                # y que no se lo quite a un dueño que acaba de renovarla
+                cursor = conn.execute('UPDATE jobs SET owner = ?, updated_at = ? WHERE id = ? AND owner = ? AND updated_at = ?',
+                                      (owner, time.time(), download_id, old_owner, updated_at))
+            if cursor.rowcount == 1:
+                claimed.append((download_id, json.loads(status), json.loads(options)))
+        return claimed
+
+    def save_batch(self, batch_id, state, data):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT INTO batches (id, owner, state, data, updated_at) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, state = excluded.state, '
+                         'data = excluded.data, updated_at = excluded.updated_at',
+                         (batch_id, JOB_OWNER, state, json.dumps(data), time.time()))
+
+    def load_batch(self, batch_id):
+        row = self._conn().execute('SELECT data FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def purge_batches(self, before):
+        """Borra los lotes terminados antes de before."""
+        conn = self._conn()
+        placeholders = ','.join('?' * len(ACTIVE_BATCH_STATES))
+        with conn:
+            conn.execute(f'DELETE FROM batches WHERE state NOT IN ({placeholders}) AND updated_at < ?',
+                         (*ACTIVE_BATCH_STATES, before))
+
+    def claim_interrupted_batches(self, owner):
+        """Reclama los lotes activos cuya concesión caducó; devuelve su estado guardado."""
+        conn = self._conn()
+        placeholders = ','.join('?' * len(ACTIVE_BATCH_STATES))
+        rows = conn.execute(f'SELECT id, owner, data, updated_at FROM batches WHERE state IN ({placeholders}) AND updated_at < ?',
+                            (*ACTIVE_BATCH_STATES, time.time() - JOB_LEASE_TIMEOUT)).fetchall()
+        claimed = []
+        for batch_id, old_owner, data, updated_at in rows:
+            with conn:
+                cursor = conn.execute('UPDATE batches SET owner = ?, updated_at = ? WHERE id = ? AND owner = ? AND updated_at = ?',
+                                      (owner, time.time(), batch_id, old_owner, updated_at))
+            if cursor.rowcount == 1:
+                claimed.append(json.loads(data))
+        return claimed
+
+job_store = SQLiteJobStore(JOB_DB_PATH) if JOB_STORE == 'sqlite' else MemoryJobStore()
+job_options = {}
+
+# Cola compartida entre nodos en una base SQLite común (un volumen del mismo host)
+class ClusterQueue:
+    """
+    Los trabajos nuevos entran sin nodo; cada nodo con workers libres reclama el siguiente por
+    prioridad y orden de llegada, y desde entonces es el único que actualiza su estado en la fila.
+    Cada proceso registra un latido con su nodo, URL y capacidad; los trabajos activos de un
+    proceso sin latido durante CLUSTER_NODE_TIMEOUT vuelven a la cola. La fila de un trabajo
+    indica en qué nodo están sus archivos.
+    """
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS cluster_jobs (
+            id TEXT PRIMARY KEY,
+            priority INTEGER NOT NULL,
+            options TEXT NOT NULL,
+            state TEXT NOT NULL,
+            status TEXT NOT NULL,
+            node TEXT,
+            member TEXT,
+            updated_at REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS cluster_nodes (
+            member TEXT PRIMARY KEY,
+            node TEXT NOT NULL,
+            url TEXT NOT NULL,
+            capacity INTEGER NOT NULL,
+            active INTEGER NOT NULL,
+            queued INTEGER NOT NULL,
+            heartbeat REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS cluster_jobs_pending ON cluster_jobs (node, priority)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: las transacciones se abren con BEGIN IMMEDIATE explícito
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Bloqueo de escritura desde el principio para que dos nodos no reclamen el mismo trabajo
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _live_members(self, conn, now):
+        return conn.execute('SELECT COUNT(*) FROM cluster_nodes WHERE heartbeat > ?',
+                            (now - CLUSTER_NODE_TIMEOUT,)).fetchone()[0]
+
+    def submit(self, download_id, status, options, priority, max_queued_per_member):
+        """Añade un trabajo a la cola; devuelve False si ya está llena para los nodos vivos."""
+        now = time.time()
+        with self._transaction() as conn:
+            queued = conn.execute('SELECT COUNT(*) FROM cluster_jobs WHERE node IS NULL').fetchone()[0]
+            if queued >= max_queued_per_member * max(self._live_members(conn, now), 1):
+                return False
+            conn.execute('INSERT INTO cluster_jobs (id, priority, options, state, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         (download_id, priority, json.dumps(options), status['status'], json.dumps(status), now))
+        return True
+
+    def claim(self, member, node):
+        """Reclama el siguiente trabajo en espera; devuelve (id, estado, opciones) o None."""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT id, status, options FROM cluster_jobs WHERE node IS NULL '
+                               'ORDER BY priority, rowid LIMIT 1').fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE cluster_jobs SET node = ?, member = ?, updated_at = ? WHERE id = ?',
+                         (node, member, time.time(), row[0]))
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def release(self, download_id, member):
+        """Devuelve a la cola un trabajo reclamado que este proceso no pudo empezar."""
+        with self._transaction() as conn:
+            conn.execute('UPDATE cluster_jobs SET node = NULL, member = NULL, updated_at = ? WHERE id = ? AND member = ?',
+                         (time.time(), download_id, member))
+
+    def adopt(self, download_id, member, node):
+        """Un proceso que reanuda un trabajo de su nodo lo conserva si la cola no se lo dio a otro."""
+        with self._transaction() as conn:
+            cursor = conn.execute('UPDATE cluster_jobs SET member = ? WHERE id = ? AND node = ?', (member, download_id, node))
+            if cursor.rowcount:
+                return True
+            # Un trabajo anterior al modo distribuido no tiene fila: sigue siendo de este nodo
+            return conn.execute('SELECT 1 FROM cluster_jobs WHERE id = ?', (download_id,)).fetchone() is None
+
+    def save_many(self, rows, member):
+        """rows: lista de (id, estado); solo se actualizan los trabajos que tiene este proceso."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany('UPDATE cluster_jobs SET state = ?, status = ?, updated_at = ? WHERE id = ? AND member = ?',
+                             [(status.get('status', ''), json.dumps(status), now, download_id, member)
+                              for download_id, status in rows])
+
+    def load(self, download_id):
+        row = self._conn().execute('SELECT status FROM cluster_jobs WHERE id = ?', (download_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def locate(self, download_id):
+        """Nodo que tiene el trabajo, su URL y si sigue vivo; None si aún está en la cola o no existe."""
+        conn = self._conn()
+        row = conn.execute('SELECT node FROM cluster_jobs WHERE id = ?', (download_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        url, heartbeat = conn.execute('SELECT url, MAX(heartbeat) FROM cluster_nodes WHERE node = ?', (row[0],)).fetchone()
+        return {'node': row[0], 'url': url, 'alive': heartbeat is not None and time.time() - heartbeat < CLUSTER_NODE_TIMEOUT}
+
+    def position(self, download_id):
+        row = self._conn().execute(
+            'SELECT COUNT(*) FROM cluster_jobs AS other, cluster_jobs AS job WHERE job.id = ? AND job.node IS NULL '
+            'AND other.node IS NULL AND (other.priority < job.priority OR (other.priority = job.priority AND other.rowid <= job.rowid))',
+            (download_id,)).fetchone()
+        return row[0] or None
+
+    def heartbeat(self, member, node, url, capacity, active, queued):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO cluster_nodes (member, node, url, capacity, active, queued, heartbeat) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(member) DO UPDATE SET node = excluded.node, '
+                         'url = excluded.url, capacity = excluded.capacity, active = excluded.active, '
+                         'queued = excluded.queued, heartbeat = excluded.heartbeat',
+                         (member, node, url, capacity, active, queued, now))
+
+    def requeue_orphans(self):
+        """Devuelve a la cola los trabajos activos de procesos sin latido; devuelve cuántos."""
+        placeholders = ','.join('?' * len(ACTIVE_JOB_STATES))
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE cluster_jobs SET node = NULL, member = NULL, state = 'queued', updated_at = ?, "
+                "status = json_set(status, '$.status', 'queued', '$.current_stage', 'Esperando otro nodo...') "
+                f'WHERE node IS NOT NULL AND state IN ({placeholders}) AND member NOT IN (SELECT member FROM cluster_nodes WHERE heartbeat > ?)',
+                (time.time(), *ACTIVE_JOB_STATES, time.time() - CLUSTER_NODE_TIMEOUT))
+            return cursor.rowcount
+
+    def stats(self):
+        conn = self._conn()
+        now = time.time()
+        nodes = [{'member': member, 'node': node, 'url': url, 'capacity': capacity, 'active': active, 'queued': queued,
+                  'last_heartbeat': round(now - heartbeat, 1), 'alive': now - heartbeat < CLUSTER_NODE_TIMEOUT}
+                 for member, node, url, capacity, active, queued, heartbeat in conn.execute(
+                     'SELECT member, node, url, capacity, active, queued, heartbeat FROM cluster_nodes ORDER BY node, member')]
+        return {'nodes': nodes, 'queued': self.queued()}
+
+    def queued(self):
+        return self._conn().execute('SELECT COUNT(*) FROM cluster_jobs WHERE node IS NULL').fetchone()[0]
+
+cluster_queue = ClusterQueue(CLUSTER_DB_PATH) if CLUSTER_DB_PATH else None
+
+# Escritura diferida: los hooks solo marcan el trabajo y un hilo lo persiste en lote
+class JobPersister:
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if (isinstance(self.store, MemoryJobStore) and cluster_queue is None) or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='job-persister')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def mark_dirty(self, download_id):
+        with self._lock:
+            self._dirty.add(download_id)
+
+    def save_now(self, download_id):
+        with self._lock:
+            self._dirty.discard(download_id)
+        self._save([download_id])
+
+    def flush(self):
+        with self._lock:
+            pending, self._dirty = self._dirty, set()
+        if pending:
+            self._save(pending)
+
+    def _save(self, download_ids):
+        rows = []
+        for download_id in download_ids:
+            status = download_status.get(download_id)
+            if status is None:
+                continue
+            try:
+                rows.append((download_id, json.loads(json.dumps(status)), job_options.get(download_id)))
+            except (RuntimeError, TypeError, ValueError):
+                # El estado cambió mientras se serializaba: reintentar en el próximo lote
+                self.mark_dirty(download_id)
+        if rows:
+            try:
+                self.store.save_many(rows)
+                if cluster_queue is not None:
+                    # Copia en la cola compartida para que cualquier nodo pueda consultar el estado
+                    cluster_queue.save_many([(download_id, status) for download_id, status, _ in rows], JOB_OWNER)
+            except sqlite3.Error:
+                app.logger.exception('No se pudo persistir el estado de %d trabajos', len(rows))
+                for download_id, _, _ in rows:
+                    self.mark_dirty(download_id)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+            try:
+                self.store.renew(JOB_OWNER)
+            except sqlite3.Error:
+                app.logger.exception('No se pudo renovar la concesión de los trabajos')
+
+job_persister = JobPersister(job_store, JOB_STORE_FLUSH_INTERVAL)
+job_persister.start()
+
+# Buscar un trabajo en memoria o, si lo gestiona otro worker, en el almacén persistente
+def find_job(download_id):
+    status = download_status.get(download_id)
+    if status is None:
+        status = job_store.load(download_id)
+    if status is None and cluster_queue is not None:
+        # Trabajo en la cola compartida o en otro nodo: la última copia de su estado
+        status = cluster_queue.load(download_id)
+    return status
+
+# Planificador de trabajos con un pool fijo de workers
+class DownloadScheduler:
+    """
+    Cola de prioridad con un número fijo de workers de descarga.
+    Los trabajos se atienden por prioridad (menor primero) y en orden FIFO
+    dentro de la misma prioridad. Si la cola está llena, submit() devuelve False.
+    """
+
+    def __init__(self, max_workers, max_queued):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._active = set()
+
+    def _ensure_workers(self):
+        # Los workers se crean de forma perezosa para que cada proceso de gunicorn tenga los suyos
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, name=f'download-worker-{len(self._workers)}')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job_id, func, args=(), priority=0):
+        with self._cond:
+            if len(self._heap) >= self.max_queued:
+                return False
+            heapq.heappush(self._heap, (priority, next(self._counter), job_id, func, args))
+            self._ensure_workers()
+            self._cond.notify()
+        return True
+
+    def position(self, job_id):
+        # Posición 1-based dentro de la cola, o None si ya no está en espera
+        with self._cond:
+            for index, item in enumerate(sorted(self._heap)):
+                if item[2] == job_id:
+                    return index + 1
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.max_workers,
+                'active': len(self._active),
+                'queued': len(self._heap),
+                'max_queued': self.max_queued,
+            }
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job_id, func, args = heapq.heappop(self._heap)
+                self._active.add(job_id)
+            try:
+                func(*args)
+            except Exception:
+                app.logger.exception('Error no controlado en el trabajo %s', job_id)
+            finally:
+                with self._cond:
+                    self._active.discard(job_id)
+
+# Hilos para las extracciones de yt-dlp que pide la API. Con gevent se usa su pool de hilos reales:
+# el greenlet que espera el resultado cede el bucle de eventos en lugar de congelarlo
+class BlockingPool:
+    def __init__(self, size, name):
+        if ASYNC_SERVING:
+            from gevent.threadpool import ThreadPool
+            self.threadpool = ThreadPool(size)
+            self.executor = None
+        else:
+            self.threadpool = None
+            self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+
+    def run(self, function, *args):
+        if self.threadpool is not None:
+            return self.threadpool.spawn(function, *args).get()
+        return self.executor.submit(function, *args).result()
+
+extract_pool = BlockingPool(EXTRACT_WORKERS, 'extract')
+scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_QUEUED_DOWNLOADS)
+
+# Participación del proceso en el clúster: latidos, trabajos huérfanos y reclamo de trabajos
+# de la cola compartida mientras el planificador local tenga workers libres
+class ClusterAgent:
+    def __init__(self, queue):
+        self.queue = queue
+        self.wakeup = threading.Event()
+        self.last_heartbeat = 0.0
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='cluster-agent')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Buscar trabajo ya, sin esperar a la siguiente vuelta (un trabajo nuevo o un worker que quedó libre)
+    def wake(self):
+        self.wakeup.set()
+
+    def _loop(self):
+        while True:
+            # Un fallo en una vuelta no puede parar el agente: sin él el nodo deja de latir y de reclamar
+            try:
+                self.tick()
+            except Exception:
+                app.logger.exception('Error en la cola compartida del clúster')
+            self.wakeup.wait(CLUSTER_POLL)
+            self.wakeup.clear()
+
+    def tick(self):
+        now = time.time()
+        stats = scheduler.stats()
+        if now - self.last_heartbeat >= CLUSTER_HEARTBEAT:
+            self.queue.heartbeat(JOB_OWNER, NODE_ID, NODE_PUBLIC_URL, scheduler.max_workers, stats['active'], stats['queued'])
+            self.last_heartbeat = now
+            requeued = self.queue.requeue_orphans()
+            if requeued:
+                app.logger.warning('%d trabajos de nodos sin latido vuelven a la cola compartida', requeued)
+        while stats['active'] + stats['queued'] < scheduler.max_workers:
+            claimed = self.queue.claim(JOB_OWNER, NODE_ID)
+            if claimed is None:
+                break
+            download_id, status, options = claimed
+            if status.get('node'):
+                # Lo empezó un nodo que dejó de responder: aquí empieza de cero
+                restart_status(status, 'Reanudando en otro nodo...')
+            status['node'] = NODE_ID
+            download_status[download_id] = status
+            job_options[download_id] = options
+            if not scheduler.submit(download_id, download_videos, (options, download_id), status.get('priority', 1)):
+                # La cola local está llena: devolverlo a la cola compartida para que lo tome otro proceso
+                download_status.pop(download_id, None)
+                job_options.pop(download_id, None)
+                self.queue.release(download_id, JOB_OWNER)
+                break
+            job_persister.save_now(download_id)
+            app.logger.info('Trabajo %s tomado de la cola compartida por %s', download_id, JOB_OWNER)
+            stats = scheduler.stats()
+
+cluster_agent = ClusterAgent(cluster_queue) if cluster_queue is not None else None
+
+# Pool reducido para el post-procesamiento con ffmpeg (uso intensivo de CPU)
+postprocess_slots = threading.BoundedSemaphore(MAX_POSTPROCESS_WORKERS)
+FFMPEG_POSTPROCESSORS = ('Merger', 'VideoConvertor', 'ExtractAudio')   # pp_key() de yt-dlp
+
+# Límite global de videos de listas descargándose a la vez en el nodo
+playlist_entry_slots = threading.BoundedSemaphore(MAX_PARALLEL_ENTRIES)
+
+# Cubo de tokens con reserva: un bloque grande deja el saldo en negativo y quien lo pidió espera la deuda
+class TokenBucket:
+    __slots__ = ('rate', 'tokens', 'updated')
+
+    def __init__(self, rate, now):
+        self.rate = rate
+        self.tokens = rate   # Ráfaga máxima: un segundo de tráfico
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+# Descargas simultáneas contra un mismo sitio: cada 429 pausa el sitio y reduce el límite a la mitad
+# de las conexiones activas; sin nuevos 429 se recupera una conexión cada THROTTLE_RECOVERY segundos
+class HostLimiter:
+    def __init__(self, host, max_limit):
+        self.host = host
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.level = 0
+        self.backoff_until = 0.0
+        self.last_change = 0.0
+        self.episodes = 0
+        self.cond = threading.Condition()
+
+    def _recover(self, now):
+        if self.limit < self.max_limit and now >= self.backoff_until:
+            steps = int((now - self.last_change) // THROTTLE_RECOVERY)
+            if steps:
+                self.limit = min(self.max_limit, self.limit + steps)
+                self.last_change = now
+                if self.limit == self.max_limit:
+                    self.level = 0
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                self._recover(now)
+                if now >= self.backoff_until and self.active < self.limit:
+                    break
+                wait = self.backoff_until - now if now < self.backoff_until else THROTTLE_RECOVERY
+                self.cond.wait(min(wait, THROTTLE_RECOVERY))
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def throttled(self):
+        with self.cond:
+            now = time.time()
+            # Los reintentos del mismo episodio no vuelven a reducir el límite
+            if now < self.backoff_until:
+                return False
+            self.limit = max(1, min(self.limit, self.active) // 2)
+            self.backoff_until = now + min(THROTTLE_BACKOFF * 2 ** self.level, THROTTLE_MAX_BACKOFF)
+            self.level += 1
+            self.episodes += 1
+            self.last_change = now
+            return True
+
+# Estado del ancho de banda de un trabajo
+class JobBandwidth:
+    __slots__ = ('host', 'status', 'bucket', 'rate', 'counted', 'last_seen', 'waited')
+
+    def __init__(self, host, status):
+        self.host = host
+        self.status = status
+        self.bucket = None
+        self.rate = 0
+        self.counted = 0
+        self.last_seen = 0.0
+        self.waited = 0.0
+
+# Reparto del ancho de banda entre trabajos: un cubo global de BANDWIDTH_LIMIT y uno por trabajo con
+# la parte justa (el total entre los trabajos que están recibiendo bytes, como mucho JOB_BANDWIDTH_LIMIT).
+# progress_hook llama a consume() en el hilo que descarga, que duerme lo que deba para respetar ambos.
+class BandwidthManager:
+    def __init__(self, total_rate, job_rate):
+        self.total_rate = total_rate
+        self.job_rate = job_rate
+        self.total = TokenBucket(total_rate, time.time()) if total_rate else None
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.hosts = {}
+
+    @staticmethod
+    def host_for(url):
+        host = (urlparse(url).hostname or '').lower()
+        return host[4:] if host.startswith('www.') else host
+
+    def start_job(self, download_id, url, status):
+        host = self.host_for(url)
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(host, MAX_CONCURRENT_DOWNLOADS + MAX_PARALLEL_ENTRIES)
+            job = self.jobs[download_id] = JobBandwidth(host, status)
+            self._publish(job, time.time())
+
+    def end_job(self, download_id):
+        with self.lock:
+            self.jobs.pop(download_id, None)
+
+    @contextlib.contextmanager
+    def slot(self, download_id, inner=None):
+        job = self.jobs.get(download_id)
+        limiter = self.hosts.get(job.host) if job else None
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            with inner or contextlib.nullcontext():
+                yield
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def _fair_rate(self, now):
+        rate = self.job_rate
+        if self.total_rate:
+            active = sum(1 for job in self.jobs.values() if now - job.last_seen < BANDWIDTH_ACTIVE_WINDOW)
+            share = self.total_rate // max(active, 1)
+            rate = min(rate, share) if rate else share
+        return rate
+
+    def consume(self, download_id, downloaded):
+        if not self.total_rate and not self.job_rate:
+            return
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(download_id)
+            if job is None:
+                return
+            delta = downloaded - job.counted
+            job.counted = downloaded
+            job.last_seen = now
+            if delta <= 0:
+                return
+            rate = self._fair_rate(now)
+            wait = 0.0
+            if job.bucket is None:
+                job.bucket = TokenBucket(rate, now)
+            job.bucket.rate = rate
+            wait = job.bucket.reserve(delta, now)
+            if self.total is not None:
+                wait = max(wait, self.total.reserve(delta, now))
+            job.waited += wait
+            if rate != job.rate or wait:
+                job.rate = rate
+                self._publish(job, now)
+        if wait:
+            time.sleep(wait)
+
+    def report_throttle(self, download_id):
+        with self.lock:
+            job = self.jobs.get(download_id)
+            limiter = self.hosts.get(job.host) if job else None
+        if limiter is None or not limiter.throttled():
+            return
+        METRIC_THROTTLES.inc(host=limiter.host)
+        fragment_tuner.throttled(limiter.host)
+        app.logger.warning('Throttling de %s: %d descargas simultáneas, pausa hasta %s',
+                           limiter.host, limiter.limit, time.strftime('%H:%M:%S', time.localtime(limiter.backoff_until)))
+        # Es un aviso, no un error del trabajo: solo se refleja en status['bandwidth']
+        now = time.time()
+        with self.lock:
+            for other in self.jobs.values():
+                if other.host == limiter.host:
+                    self._publish(other, now)
+
+    def _publish(self, job, now):
+        limiter = self.hosts[job.host]
+        job.status['bandwidth'] = {
+            'rate_limit': job.rate or None,
+            'waited': round(job.waited, 1),
+            'host': job.host,
+            'host_concurrency': limiter.limit,
+            'throttled_until': limiter.backoff_until if limiter.backoff_until > now else None,
+            'throttle_events': limiter.episodes,
+        }
+
+bandwidth = BandwidthManager(BANDWIDTH_LIMIT, JOB_BANDWIDTH_LIMIT)
+
+# Conexiones de fragmentos de todo el nodo: cada descarga recibe las que pide si caben, y al menos una
+class ConnectionBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    # Cambia las conexiones de una descarga de held a wanted; devuelve las concedidas, que
+    # pueden ser 0 si el presupuesto está agotado
+    def resize(self, held, wanted):
+        with self.lock:
+            granted = max(0, min(wanted, self.limit - self.used + held)) if self.limit else wanted
+            self.used += granted - held
+            return granted
+
+    def release(self, held):
+        with self.lock:
+            self.used -= held
+
+# Estado del ajuste de un trabajo
+class JobTuning:
+    __slots__ = ('host', 'status', 'concurrency', 'chunk', 'downloads', 'epoch', 'previous', 'hold', 'throughput')
+
+    def __init__(self, host, status, concurrency, chunk):
+        self.host = host
+        self.status = status
+        self.concurrency = concurrency
+        self.chunk = chunk
+        self.downloads = {}    # id(params) -> (params de yt-dlp, conexiones concedidas, concurrencia al empezar)
+        self.epoch = None      # (inicio, bytes, espera por ancho de banda) de la medición en curso
+        self.previous = None   # (concurrencia, rendimiento) antes de la última subida
+        self.hold = 0
+        self.throughput = 0.0
+
+# Ajuste de fragmentos simultáneos y chunk por trabajo
+class FragmentTuner:
+    """
+    Cada AUTOTUNE_INTERVAL segundos mide el rendimiento de un trabajo con los bytes que cuenta
+    progress_hook y ajusta los fragmentos simultáneos de sus descargas: duplica mientras el
+    rendimiento mejore al menos AUTOTUNE_GAIN y, si no mejora, vuelve al valor anterior y lo
+    mantiene AUTOTUNE_HOLD mediciones antes de probar otra vez. Si el trabajo espera a su límite
+    de ancho de banda quita una conexión, y un 429 del sitio lo devuelve al mínimo. El chunk se
+    calcula para que cada petición por rangos dure unos AUTOTUNE_CHUNK_SECONDS. Todas las
+    descargas del nodo comparten MAX_FRAGMENT_CONNECTIONS conexiones, que se reservan al empezar
+    cada descarga; si no queda ninguna, la descarga baja sus fragmentos de uno en uno. Un
+    cambio solo afecta a las descargas que empiezan después, así que cada descarga recuerda la
+    concurrencia con la que empezó y un valor nuevo solo se juzga con mediciones en las que
+    todas las descargas en curso empezaron con él. Cada trabajo continúa el ajuste del último
+    trabajo del mismo sitio.
+    """
+
+    def __init__(self, enabled, max_connections):
+        self.enabled = enabled
+        self.budget = ConnectionBudget(max_connections)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.hosts = {}   # sitio -> (concurrencia, chunk, anterior, espera) del último trabajo
+
+    def start_job(self, download_id, url, status):
+        if not self.enabled:
+            return
+        host = BandwidthManager.host_for(url)
+        with self.lock:
+            concurrency, chunk, previous, hold = self.hosts.get(host, (3, HTTP_CHUNK_SIZE, None, 0))
+            concurrency = min(max(concurrency, FRAGMENT_CONCURRENCY_MIN), FRAGMENT_CONCURRENCY_MAX)
+            chunk = min(max(chunk, HTTP_CHUNK_MIN), HTTP_CHUNK_MAX)
+            job = self.jobs[download_id] = JobTuning(host, status, concurrency, chunk)
+            # Una subida que el trabajo anterior no llegó a juzgar se juzga en este
+            job.previous = previous
+            job.hold = hold
+            self._publish(job)
+
+    def end_job(self, download_id):
+        with self.lock:
+            job = self.jobs.pop(download_id, None)
+            if job is not None:
+                self.hosts[job.host] = (job.concurrency, job.chunk, job.previous, job.hold)
+
+    # Asigna a una instancia de yt-dlp los valores actuales del trabajo mientras descarga
+    @contextlib.contextmanager
+    def attach(self, download_id, params):
+        job = self.jobs.get(download_id)
+        if job is None:
+            yield
+            return
+        with self.lock:
+            if not job.downloads:
+                job.epoch = None
+            granted = self.budget.resize(0, job.concurrency)
+            job.downloads[id(params)] = (params, granted, job.concurrency)
+            # Sin conexiones libres la descarga sigue con la única de su turno, que no se cuenta
+            params['concurrent_fragment_downloads'] = max(granted, 1)
+            params['http_chunk_size'] = job.chunk
+        try:
+            yield
+        finally:
+            with self.lock:
+                _, held, _ = job.downloads.pop(id(params))
+                self.budget.release(held)
+
+    def observe(self, download_id, downloaded):
+        job = self.jobs.get(download_id)
+        if job is None:
+            return
+        now = time.time()
+        epoch = job.epoch
+        if epoch is not None and now - epoch[0] < AUTOTUNE_INTERVAL:
+            return
+        waited = bandwidth.jobs[download_id].waited if download_id in bandwidth.jobs else 0.0
+        with self.lock:
+            if job.epoch is not epoch or download_id not in self.jobs:
+                return
+            # Mientras siga alguna descarga que empezó con otro valor, la medición vuelve a empezar
+            if not job.downloads or any(level != job.concurrency for _, _, level in job.downloads.values()):
+                job.epoch = None
+                return
+            job.epoch = (now, downloaded, waited)
+            if epoch is None:
+                return
+            throughput = (downloaded - epoch[1]) / (now - epoch[0])
+            if throughput <= 0:
+                return
+            job.throughput = throughput
+            self._adjust(job, throughput, waited > epoch[2])
+            self._publish(job)
+
+    def _adjust(self, job, throughput, limited):
+        current = job.concurrency
+        target = current
+        if limited:
+            # El trabajo ya llega a su límite de ancho de banda: sobran conexiones
+            target = max(FRAGMENT_CONCURRENCY_MIN, current - 1)
+            job.previous = None
+            job.hold = AUTOTUNE_HOLD
+        elif job.hold:
+            job.hold -= 1
+        elif job.previous is not None and throughput < job.previous[1] * (1 + AUTOTUNE_GAIN):
+            # Más conexiones no mejoraron el rendimiento: volver al valor anterior
+            target = job.previous[0]
+            job.previous = None
+            job.hold = AUTOTUNE_HOLD
+        elif current < FRAGMENT_CONCURRENCY_MAX:
+            target = min(FRAGMENT_CONCURRENCY_MAX, current * 2)
+            job.previous = (current, throughput)
+        connections = sum(held for _, held, _ in job.downloads.values()) or 1
+        chunk = int(throughput / connections * AUTOTUNE_CHUNK_SECONDS) // 1048576 * 1048576
+        job.chunk = min(max(chunk, HTTP_CHUNK_MIN), HTTP_CHUNK_MAX)
+        if target != current:
+            # El valor nuevo se aplica a las siguientes descargas y se mide desde cero
+            job.concurrency = target
+            job.epoch = None
+
+    # Un 429 del sitio devuelve al mínimo las conexiones de las próximas descargas de sus trabajos
+    def throttled(self, host):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.host == host:
+                    job.concurrency = FRAGMENT_CONCURRENCY_MIN
+                    job.previous = None
+                    job.hold = AUTOTUNE_HOLD
+                    job.epoch = None
+                    self._publish(job)
+
+    def _publish(self, job):
+        job.status['fragments'] = {
+            'concurrency': job.concurrency,
+            'http_chunk_size': job.chunk,
+            'connections': sum(max(held, 1) for _, held, _ in job.downloads.values()),
+            'throughput': round(job.throughput),
+        }
+
+fragment_tuner = FragmentTuner(FRAGMENT_AUTOTUNE, MAX_FRAGMENT_CONNECTIONS)
+
+# Tiempo acumulado por etapa en status['timings'] (varios videos de una lista suman en paralelo)
+timings_lock = threading.Lock()
+
+def add_timing(download_id, stage, seconds, **attrs):
+    status = download_status.get(download_id)
+    if status is None:
+        return
+    with timings_lock:
+        timings = status.setdefault('timings', {})
+        timings[stage] = round(timings.get(stage, 0) + seconds, 3)
+    METRIC_STAGE_SECONDS.observe(seconds, stage=stage)
+    write_span(download_id, stage, time.time() - seconds, seconds, **attrs)
+
+# Turno de ffmpeg para un postprocesador de yt-dlp (modo inline): dura lo que dura su ejecución,
+# también si falla, porque yt-dlp no emite el evento 'finished' cuando el postprocesador lanza
+@contextlib.contextmanager
+def postprocess_slot(download_id, postprocessor):
+    status = download_status.get(download_id)
+    wait_start = time.time()
+    if status is not None:
+        status['current_stage'] = 'Esperando turno de post-procesamiento...'
+    with postprocess_slots:
+        add_timing(download_id, 'postprocess_wait', time.time() - wait_start)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            add_timing(download_id, 'postprocess', elapsed, postprocessor=postprocessor)
+            METRIC_POSTPROCESS_SECONDS.observe(elapsed, postprocessor=postprocessor)
+
+# Caché LRU con TTL para metadatos de yt-dlp, opcionalmente persistida en disco
+class MetadataCache:
+    """
+    Guarda resultados de extracción por clave normalizada ('playlist:<id>', 'video:<id>').
+    En memoria se expulsa la entrada menos usada cuando se supera max_entries; si se
+    indica cache_dir, cada entrada se escribe también como JSON para sobrevivir reinicios.
+    """
+
+    def __init__(self, max_entries, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._entries[key]
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+                if stored['expires'] > now:
+                    self._remember(key, stored['value'], stored['expires'])
+                    with self._lock:
+                        self.hits += 1
+                    return stored['value']
+                os.remove(self._disk_path(key))
+            except (OSError, ValueError, KeyError):
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value, ttl):
+        expires = time.time() + ttl
+        self._remember(key, value, expires)
+        if self.cache_dir:
+            tmp_path = self._disk_path(key) + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'expires': expires, 'value': value}, f)
+                os.replace(tmp_path, self._disk_path(key))
+            except (OSError, TypeError, ValueError):
+                app.logger.warning('No se pudo persistir la entrada de caché %s', key)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.cache_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_DIR or None)
+
+# Normalizar una URL de YouTube a una clave estable ('playlist:<id>', 'video:<id>' o 'url:<ruta>')
+def metadata_cache_key(url):
+    parsed = urlparse(url if '://' in url else f'https://{url}')
+    query = parse_qs(parsed.query)
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if query.get('list'):
+        return f"playlist:{query['list'][0]}"
+    if query.get('v'):
+        return f"video:{query['v'][0]}"
+    if host.endswith('youtu.be') and parsed.path.strip('/'):
+        return f"video:{parsed.path.strip('/').split('/')[0]}"
+    match = re.match(r'^/(?:shorts|live|embed)/([\w-]+)', parsed.path)
+    if match:
+        return f'video:{match.group(1)}'
+    return f"url:{host}{parsed.path.rstrip('/')}"
+
+# Claves de la información completa de un video que no deben reutilizarse entre descargas
+VIDEO_INFO_DROP_KEYS = ('requested_downloads', 'requested_formats', 'requested_subtitles', 'filepath', 'filename',
+                        'automatic_captions', 'heatmap')
+
+# Guardar la información completa de un video para reutilizarla en descargas posteriores
+def cache_video_info(ydl, info):
+    if not info or not info.get('id') or 'entries' in info:
+        return None
+    compact = {k: v for k, v in ydl.sanitize_info(info).items()
+               if k not in VIDEO_INFO_DROP_KEYS and not k.startswith('__')}
+    compact['format_choices'] = rank_formats(compact)
+    metadata_cache.put(f"video:{info['id']}", compact, VIDEO_INFO_CACHE_TTL)
+    return compact
+
+# Agrupa llamadas concurrentes con la misma clave en una sola ejecución (single-flight)
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        if leader:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call['done'].set()
+        else:
+            call['done'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    def running(self, key):
+        with self._lock:
+            return key in self._calls
+
+video_info_flight = SingleFlight()
+
+# Futures para encadenar etapas que terminan en otro pool sin bloquear al hilo que las lanza
+def resolved_future(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+def chain_future(future, fn):
+    """Devuelve un Future con el resultado de fn(future), que se ejecuta cuando future termina."""
+    chained = Future()
+
+    def done(source):
+        try:
+            chained.set_result(fn(source))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+def gather_futures(futures):
+    """Future que termina con la lista de resultados cuando terminan todos (el primer error gana)."""
+    futures = list(futures)
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        error = next((f.exception() for f in futures if f.exception() is not None), None)
+        if error is not None:
+            gathered.set_exception(error)
+        else:
+            gathered.set_result([f.result() for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+# Almacén direccionado por contenido: cada artefacto se descarga una vez y los trabajos lo enlazan
+class ContentStore:
+    """
+    Guarda los archivos finales en STORE_FOLDER/<clave>/, donde la clave se deriva del ID del
+    video, los formatos seleccionados y el perfil de post-procesamiento. Un segundo trabajo con
+    la misma clave reutiliza el resultado o se suma a la descarga en curso en vez de repetirla.
+    """
+
+    MANIFEST = '.artifacts.json'
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._pending = {}
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def profile(config):
+        # El perfil incluye todo lo que cambia el archivo resultante
+        profile = {k: config.get(k) for k in ('format', 'merge_output_format', 'postprocessors', 'postprocessor_args')}
+        if config.get('postprocess_preset'):
+            profile['postprocess_preset'] = config['postprocess_preset']
+        return profile
+
+    @classmethod
+    def key_for(cls, video_id, config):
+        raw = json.dumps([video_id, cls.profile(config)], sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        manifest_path = os.path.join(self.entry_dir(key), self.MANIFEST)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        paths = [os.path.join(self.entry_dir(key), name) for name in manifest.get('files', [])]
+        if not paths or not all(os.path.isfile(path) for path in paths):
+            return None
+        # La fecha del manifiesto registra el último uso del artefacto
+        os.utime(manifest_path)
+        return paths
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def fetch(self, key, producer, on_wait=None):
+        """
+        Devuelve un Future con las rutas del artefacto. producer(directorio) solo se ejecuta si
+        no existe y debe devolver un Future; las peticiones concurrentes comparten el mismo y
+        llaman a on_wait() al sumarse a él.
+        """
+        paths = self.lookup(key)
+        if paths:
+            return resolved_future(paths)
+        with self._lock:
+            shared = self._pending.get(key)
+            if shared is None:
+                future = self._pending[key] = Future()
+        if shared is not None:
+            if on_wait:
+                on_wait()
+            return shared
+        try:
+            produced = self._produce(key, producer)
+        except Exception as e:
+            produced = resolved_future(error=e)
+
+        def settle(source):
+            with self._lock:
+                del self._pending[key]
+            if source.exception() is not None:
+                future.set_exception(source.exception())
+            else:
+                future.set_result(source.result())
+
+        produced.add_done_callback(settle)
+        return future
+
+    def _produce(self, key, producer):
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        lock_file = open(os.path.join(entry_dir, '.lock'), 'w')
+        try:
+            # Otro proceso de gunicorn puede estar descargando la misma clave
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            paths = self.lookup(key)
+            if paths:
+                lock_file.close()
+                return resolved_future(paths)
+            produced = producer(entry_dir)
+        except BaseException:
+            lock_file.close()
+            raise
+        # El bloqueo se mantiene hasta que ffmpeg termina y el manifiesto está escrito
+        return chain_future(produced, lambda source: self._finish(key, entry_dir, lock_file, source))
+
+    def _finish(self, key, entry_dir, lock_file, produced):
+        try:
+            paths = [path for path in produced.result() if os.path.isfile(path)]
+            if paths:
+                manifest_path = os.path.join(entry_dir, self.MANIFEST)
+                with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'files': [os.path.relpath(path, entry_dir) for path in paths],
+                               'created': time.time()}, f)
+                os.replace(manifest_path + '.tmp', manifest_path)
+            return paths
+        finally:
+            lock_file.close()
+
+content_store = ContentStore(STORE_FOLDER) if CONTENT_STORE_ENABLED else None
+
+# Enlazar artefactos del almacén en el directorio de un trabajo (hardlink, o symlink si no es posible)
+def link_artifacts(paths, job_dir):
+    linked = []
+    for src in paths:
+        base, ext = os.path.splitext(os.path.basename(src))
+        dst = os.path.join(job_dir, base + ext)
+        suffix = 2
+        while os.path.lexists(dst):
+            try:
+                if os.path.samefile(dst, src):
+                    break
+            except OSError:
+                pass
+            dst = os.path.join(job_dir, f'{base} ({suffix}){ext}')
+            suffix += 1
+        else:
+            try:
+                os.link(src, dst)
+            except OSError:
+                try:
+                    os.symlink(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+        linked.append(dst)
+    return linked
+
+# Hooks y logger fijos de una instancia del pool: reenvían a los de la tarea que la tiene prestada
+class PooledHooks:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.progress_hooks = ()
+        self.postprocessor_hooks = ()
+        self.post_hooks = ()
+        self.logger = None
+        self.streams = None
+        self.download_id = None
+
+    def progress_hook(self, d):
+        for hook in self.progress_hooks:
+            hook(d)
+
+    def postprocessor_hook(self, d):
+        for hook in self.postprocessor_hooks:
+            hook(d)
+
+    def post_hook(self, filepath):
+        for hook in self.post_hooks:
+            hook(filepath)
+
+    def debug(self, message):
+        if self.logger is not None:
+            self.logger.debug(message)
+
+    def info(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    def warning(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
+
+    def error(self, message):
+        if self.logger is not None:
+            self.logger.error(message)
+        else:
+            app.logger.warning('yt-dlp: %s', message)
+
+# Registra la ruta y los códecs de cada stream descargado, para la etapa ffmpeg. Hereda de una clase
+# de yt-dlp, así que se define en el primer uso y no al importar la aplicación
+@functools.cache
+def stream_collector_class():
+    class StreamCollector(yt_dlp.postprocessor.PostProcessor):
+        def __init__(self, hooks):
+            super().__init__()
+            self.hooks = hooks
+
+        def run(self, info):
+            if self.hooks.streams is not None:
+                self.hooks.streams.append({
+                    'path': info['filepath'],
+                    'vcodec': info.get('vcodec') or 'none',
+                    'acodec': info.get('acodec') or 'none',
+                })
+            return [], info
+
+    return StreamCollector
+
+class PooledYoutubeDL:
+    def __init__(self, options):
+        self.hooks = PooledHooks()
+        config = dict(options)
+        config.update({
+            'progress_hooks': [self.hooks.progress_hook],
+            'postprocessor_hooks': [self.hooks.postprocessor_hook],
+            'post_hooks': [self.hooks.post_hook],
+            'logger': self.hooks,
+        })
+        self.ydl = yt_dlp.YoutubeDL(config)
+        self.ydl.add_post_processor(stream_collector_class()(self.hooks), when='after_move')
+        self.ydl.run_pp = self.run_pp
+        self.params = dict(self.ydl.params)
+        self.format = self.params.get('format')
+        self.uses = 0
+
+    # Los postprocesadores de ffmpeg comparten el pool limitado de turnos
+    def run_pp(self, pp, infodict):
+        run_pp = yt_dlp.YoutubeDL.run_pp.__get__(self.ydl)
+        if pp.pp_key() not in FFMPEG_POSTPROCESSORS:
+            return run_pp(pp, infodict)
+        with postprocess_slot(self.hooks.download_id, pp.pp_key()):
+            return run_pp(pp, infodict)
+
+    def bind(self, task, streams, download_id=None):
+        ydl = self.ydl
+        ydl.params.clear()
+        ydl.params.update(self.params)
+        for key in YoutubeDLPool.TASK_PARAMS:
+            if key in task:
+                ydl.params[key] = task[key]
+        # El selector de formato se compila en el constructor: se recompila solo si cambia
+        fmt = ydl.params.get('format')
+        if fmt != self.format:
+            ydl.format_selector = fmt if fmt in (None, '-') or callable(fmt) else ydl.build_format_selector(fmt)
+            self.format = fmt
+        hooks = self.hooks
+        hooks.progress_hooks = task.get('progress_hooks') or ()
+        hooks.postprocessor_hooks = task.get('postprocessor_hooks') or ()
+        hooks.post_hooks = task.get('post_hooks') or ()
+        hooks.logger = task.get('logger')
+        hooks.streams = streams
+        hooks.download_id = download_id
+
+    def close(self):
+        self.ydl.__exit__(None, None, None)
+
+# Pool de instancias de YoutubeDL agrupadas por sus opciones fijas
+class YoutubeDLPool:
+    """
+    Construir un YoutubeDL prepara la plantilla de salida, los postprocesadores y el selector de
+    formato; con el uso acumula extractores inicializados y el gestor de peticiones HTTP con sus
+    conexiones. checkout() presta una instancia libre con las mismas opciones fijas y le asigna lo que
+    cambia entre tareas (TASK_PARAMS, hooks, logger); al devolverla se restauran los parámetros.
+    Una instancia que termina con una excepción se descarta, y cada una se renueva tras
+    YTDLP_POOL_MAX_USES usos. Se conservan como mucho YTDLP_POOL_SIZE libres, expulsando las
+    de las opciones usadas hace más tiempo.
+    """
+    TASK_PARAMS = ('format', 'paths', 'playlist_items', 'noplaylist')
+    TASK_HOOKS = ('progress_hooks', 'postprocessor_hooks', 'post_hooks', 'logger')
+
+    def __init__(self, size, max_uses):
+        self.size = size
+        self.max_uses = max_uses
+        self.idle = OrderedDict()   # clave de opciones -> instancias libres, la más reciente al final
+        self.idle_count = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def key_for(cls, options):
+        static = {k: v for k, v in options.items() if k not in cls.TASK_PARAMS + cls.TASK_HOOKS}
+        return json.dumps(static, sort_keys=True, default=repr)
+
+    @contextlib.contextmanager
+    def checkout(self, options, streams=None, download_id=None):
+        key = self.key_for(options)
+        pooled = None
+        with self.lock:
+            free = self.idle.get(key)
+            if free:
+                pooled = free.pop()
+                self.idle_count -= 1
+                if not free:
+                    del self.idle[key]
+        METRIC_YTDLP_CHECKOUTS.inc(result='hit' if pooled else 'miss')
+        if pooled is None:
+            pooled = PooledYoutubeDL({k: v for k, v in options.items() if k not in self.TASK_HOOKS})
+        pooled.bind(options, streams, download_id)
+        reusable = False
+        try:
+            yield pooled.ydl
+            reusable = True
+        finally:
+            pooled.hooks.clear()
+            pooled.uses += 1
+            if reusable and pooled.uses < self.max_uses:
+                self.checkin(key, pooled)
+            else:
+                pooled.close()
+
+    def checkin(self, key, pooled):
+        evicted = []
+        with self.lock:
+            self.idle.setdefault(key, []).append(pooled)
+            self.idle.move_to_end(key)
+            self.idle_count += 1
+            while self.idle_count > self.size:
+                oldest = next(iter(self.idle))
+                free = self.idle[oldest]
+                evicted.append(free.pop(0))
+                self.idle_count -= 1
+                if not free:
+                    del self.idle[oldest]
+        for old in evicted:
+            old.close()
+
+    def prewarm(self, options_list):
+        for options in options_list:
+            with self.checkout(options) as ydl:
+                ydl.get_info_extractor('Youtube')
+
+    def stats(self):
+        with self.lock:
+            return {'idle': self.idle_count, 'keys': len(self.idle)}
+
+ytdl_pool = YoutubeDLPool(YTDLP_POOL_SIZE, YTDLP_POOL_MAX_USES)
+
+# Opciones de las extracciones sin descarga
+VIDEO_INFO_OPTIONS = {'quiet': True, 'no_warnings': True}
+FLAT_INFO_OPTIONS = {'quiet': True, 'extract_flat': True, 'force_generic_extractor': False}
+
+# Información completa de un video con caché y coalescencia de extracciones concurrentes
+def get_cached_video_info(url):
+    key = metadata_cache_key(url)
+    if key.startswith('video:'):
+        cached = metadata_cache.get(key)
+        if cached is not None:
+            return cached
+
+    def extract():
+        with ytdl_pool.checkout(VIDEO_INFO_OPTIONS) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return cache_video_info(ydl, info) or ydl.sanitize_info(info)
+
+    return video_info_flight.do(key, extract)
+
+# Extracción aplanada (título y entradas) con caché; devuelve entries=None para un video único
+def get_flat_info(url, refresh=False):
+    key = metadata_cache_key(url)
+    cached = metadata_cache.get(f'flat:{key}') if not refresh else None
+    if cached is not None:
+        return cached
+
+    with ytdl_pool.checkout(FLAT_INFO_OPTIONS) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if 'entries' in info:
+        flat = {
+            'id': info.get('id', ''),
+            'title': info.get('title', 'Playlist'),
+            'entries': [{
+                'id': entry.get('id', ''),
+                'title': entry.get('title'),
+                'url': entry.get('url', ''),
+            } for entry in info.get('entries') or [] if entry is not None],
+        }
+    else:
+        flat = {'id': info.get('id', ''), 'title': info.get('title', 'Video'), 'entries': None}
+    metadata_cache.put(f'flat:{key}', flat, PLAYLIST_CACHE_TTL)
+    return flat
+
+# Logger de yt-dlp: cuenta los reintentos, detecta el throttling y manda los errores al log de la aplicación
+class YtdlpLogger:
+    def __init__(self, download_id):
+        self.download_id = download_id
+
+    def debug(self, message):
+        # '[download] Got error: ... Retrying fragment 3 (1/10)...' o '... Retrying (1/10)...'
+        if 'Retrying' in message:
+            METRIC_RETRIES.inc(kind='fragment' if 'Retrying fragment' in message else 'http')
+        self._check_throttle(message)
+
+    info = debug
+    warning = debug
+
+    def error(self, message):
+        app.logger.warning('yt-dlp [%s]: %s', self.download_id, message)
+        self._check_throttle(message)
+
+    def _check_throttle(self, message):
+        if 'HTTP Error 429' in message or 'Too Many Requests' in message:
+            bandwidth.report_throttle(self.download_id)
+
+# Espera entre reintentos de yt-dlp (n empieza en 0): 1, 2, 4... segundos
+def retry_sleep(n):
+    return min(2 ** n, 30)
+
+# Formato de video de las listas: códecs que el mp4 acepta sin recodificar y techo opcional de resolución
+def playlist_video_format(options, separate):
+    try:
+        cap = f"[height<={int(options['max_height'])}]" if options.get('max_height') else ''
+    except (TypeError, ValueError):
+        cap = ''
+    codecs = '|'.join(MERGE_CONTAINERS['mp4']['video'])
+    if separate:
+        return f"bv*[vcodec~='^({codecs})']{cap}/bv*{cap},ba[acodec^=mp4a]/ba"
+    fallback = f'/best{cap}/best' if cap else '/best'
+    return f"bestvideo[vcodec~='^({codecs})']{cap}+bestaudio[acodec^=mp4a]/bestvideo{cap}+bestaudio{fallback}"
+
 # Configuración mejorada de yt-dlp para optimizar las descargas
 def get_ytdlp_config(download_type, options):
     """
@@ -40,13 +1943,41 @@ def get_ytdlp_config(download_type, options):
         'quiet': True,                     # Reducir salida a consola
         'no_warnings': True,               # Ocultar advertencias
         'socket_timeout': 30,              # Timeout para conexiones
-        'http_chunk_size': 10485760,       # 10MB por chunk para mejor rendimiento
+        'http_chunk_size': HTTP_CHUNK_SIZE, # 10MB por chunk para mejor rendimiento
+        'retry_sleep_functions': {'http': retry_sleep, 'fragment': retry_sleep},  # Espera creciente entre reintentos
         'buffersize': 1024*1024,           # 1MB de buffer para mejor velocidad
         'nocheckcertificate': True,        # Ignorar problemas con certificados SSL
         'extractor_retries': 3,            # Reintentos para extractores
         'postprocessor_hooks': [lambda d: postprocessor_hook(d, options.get('download_id'))], # Hook para etapas de post-procesamiento
+        'logger': YtdlpLogger(options.get('download_id')),  # Cuenta reintentos para /metrics
     }
     
+    # Con la etapa ffmpeg propia, yt-dlp solo descarga los streams por separado
+    if POSTPROCESS_PIPELINE:
+        if download_type == 'single':
+            # El formato lo fija _download_videos con los IDs elegidos por el usuario
+            base_config.update({
+                'format': options.get('format', 'bv*,ba/b'),
+                'postprocess_preset': {'kind': 'merge', 'container': 'mp4'},
+            })
+        elif download_type == 'playlist':
+            base_config.update({
+                'playlist_items': '1-1000',
+                'concurrent_fragment_downloads': 3,
+            })
+            if options.get('format') == 'audio':
+                codec = options.get('audio_format', 'mp3')
+                base_config.update({
+                    'format': 'bestaudio/best',
+                    'postprocess_preset': {'kind': 'audio', 'codec': codec if codec in AUDIO_PRESETS else 'mp3'},
+                })
+            else:
+                base_config.update({
+                    'format': playlist_video_format(options, separate=True),
+                    'postprocess_preset': {'kind': 'merge', 'container': 'mp4'},
+                })
+        return base_config
+    
     # Agregar opciones específicas para el tipo de descarga
     if download_type == 'single':
         # Para videos individuales, optimizar la mezcla de formatos
@@ -65,17 +1996,18 @@ def get_ytdlp_config(download_type, options):
         })
         
         if options.get('format') == 'audio':
+            codec = options.get('audio_format', 'mp3')
             base_config.update({
                 'format': 'bestaudio/best',
                 'postprocessors': [{
                     'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
+                    'preferredcodec': codec if codec in AUDIO_PRESETS else 'mp3',
                     'preferredquality': '192',
                 }],
             })
         else: # video
             base_config.update({
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+                'format': playlist_video_format(options, separate=False),
                 'merge_output_format': 'mp4',
             })
             
@@ -125,208 +2057,1191 @@ def postprocessor_hook(d, download_id):
             if all(not status.get(k, False) for k in ['merging', 'encoding', 'extracting_audio']):
                 status['current_stage'] = 'Procesamiento completado'
 
-# Función para manejar el progreso con cálculos más estables
-def progress_hook(d, download_id):
-    status = download_status.get(download_id)
-    if not status:
-        return
+    publish_status(download_id)
 
-    # Identificar qué parte se está procesando (video, audio, merge)
-    filename = d.get('filename', '')
-    format_id = d.get('info_dict', {}).get('format_id', 'default')
-    
-    # Inicializar o actualizar el seguimiento de partes si no existe
-    if 'parts' not in status:
-        status['parts'] = {}
-    
-    # Inicializar historial de velocidad si no existe
-    if 'speed_history' not in status:
-        status['speed_history'] = []
-    
-    # Inicializar tiempo de inicio si no existe
-    if 'start_time' not in status:
-        status['start_time'] = time.time()
-    
-    # Crear una clave única para esta parte del proceso
-    part_key = format_id
-    
-    # Detectar si estamos en fase de mezcla por el nombre del archivo
-    if '_mp4' in filename or '.mp4.' in filename or '.mkv.' in filename or '.temp.' in filename:
-        part_key = 'merge'
-        status['current_stage'] = 'Mezclando video y audio...'
-        status['merging'] = True
-    elif 'merging' in d.get('status', '').lower():
-        # También detectar por el status de yt-dlp
-        status['current_stage'] = 'Mezclando video y audio...'
-        status['merging'] = True
-    
-    # Inicializar la entrada para esta parte si no existe
-    if part_key not in status['parts']:
-        status['parts'][part_key] = {
-            'total_bytes': 0,
-            'downloaded_bytes': 0,
-            'status': 'pending',
-            'last_update': time.time(),
-            'last_bytes': 0
-        }
-    
-    part = status['parts'][part_key]
-    
-    status['hook_status'] = d['status']
-    
-    # Establecer la etapa actual si no estamos en un post-procesamiento
-    if not any(status.get(k, False) for k in ['merging', 'encoding', 'extracting_audio']):
-        if part_key == 'merge':
-            status['current_stage'] = 'Mezclando video y audio...'
-        else:
-            status['current_stage'] = f"Descargando {part_key}..."
-    
-    if d['status'] == 'downloading':
-        # Actualizar datos de esta parte
-        status['current_video'] = os.path.basename(filename)
-        part['status'] = 'downloading'
-        
-        # Actualizar bytes solo si hay información disponible
-        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
-        if total_bytes:
-            part['total_bytes'] = total_bytes
-        
-        downloaded_bytes = d.get('downloaded_bytes')
-        if downloaded_bytes:
-            part['downloaded_bytes'] = downloaded_bytes
-        
-        # Calcular y suavizar la velocidad de descarga
-        current_time = time.time()
-        time_diff = current_time - part.get('last_update', current_time - 1)
-        
-        if time_diff > 0 and 'last_bytes' in part:
-            bytes_diff = downloaded_bytes - part.get('last_bytes', 0)
-            if bytes_diff > 0:
-                # Calcular velocidad instantánea
-                current_speed = bytes_diff / time_diff
-                
-                # Añadir a historial para suavizar (solo las últimas 5 muestras)
-                status['speed_history'].append(current_speed)
-                if len(status['speed_history']) > 5:
-                    status['speed_history'].pop(0)
-                
-                # Calcular velocidad promedio
-                avg_speed = sum(status['speed_history']) / len(status['speed_history'])
-                status['speed'] = avg_speed
-            else:
-                # Si no hay progreso, usar el último valor o el reportado por yt-dlp
-                status['speed'] = status.get('speed') or d.get('speed', 0)
-        else:
-            # Usar la velocidad reportada por yt-dlp si está disponible
-            reported_speed = d.get('speed')
-            if reported_speed:
-                status['speed'] = reported_speed
-        
-        # Actualizar para la próxima iteración
-        part['last_update'] = current_time
-        part['last_bytes'] = downloaded_bytes
-        
-        # Calcular tiempo transcurrido desde el inicio de la descarga
-        status['elapsed'] = time.time() - status.get('start_time', time.time())
-        
-        # Calcular ETA basado en la velocidad promedio
-        if status.get('speed', 0) > 0:
-            # Calcular bytes restantes
-            total_bytes_all_parts = sum(p.get('total_bytes', 0) for p in status['parts'].values())
-            downloaded_bytes_all_parts = sum(p.get('downloaded_bytes', 0) for p in status['parts'].values())
-            
-            if total_bytes_all_parts > downloaded_bytes_all_parts:
-                remaining_bytes = total_bytes_all_parts - downloaded_bytes_all_parts
-                status['eta'] = remaining_bytes / status['speed']
+# Progreso de una parte (formato) de un video
+class PartProgress:
+    __slots__ = ('total_bytes', 'downloaded_bytes', 'status', 'last_update', 'speed')
+
+    def __init__(self, now):
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.status = 'pending'
+        self.last_update = now
+        self.speed = 0.0
+
+# Progreso agregado de un trabajo, actualizado de forma incremental en cada llamada del hook
+class JobProgress:
+    """
+    yt-dlp llama al hook en cada chunk (y desde varios hilos en las listas), así que aquí
+    solo se actualizan contadores acumulados; el diccionario de estado se reescribe como
+    mucho cada PROGRESS_PUBLISH_INTERVAL segundos o cuando una parte termina o falla.
+    """
+
+    __slots__ = ('download_id', 'status', 'lock', 'parts', 'unfinished', 'total_bytes', 'downloaded_bytes',
+                 'active_speed', 'speed', 'reported_eta', 'hook_status', 'part_label', 'current_video',
+                 'last_filename', 'last_is_merge', 'completed_names', 'last_publish', 'counted_bytes')
+
+    SPEED_ALPHA = 0.3  # Peso de la muestra más reciente en la media exponencial
+
+    def __init__(self, download_id, status):
+        self.download_id = download_id
+        self.status = status
+        self.lock = threading.Lock()
+        self.parts = {}
+        self.unfinished = 0
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.active_speed = 0.0
+        self.speed = 0.0
+        self.reported_eta = 0
+        self.hook_status = 'pending'
+        self.part_label = ''
+        self.current_video = None
+        self.last_filename = None
+        self.last_is_merge = False
+        self.completed_names = set()
+        self.last_publish = 0.0
+        self.counted_bytes = 0
+
+    def update(self, d):
+        now = time.time()
+        hook_status = d['status']
+        filename = d.get('filename', '')
+        status = self.status
+        with self.lock:
+            # Detectar la fase de mezcla por el nombre del archivo solo cuando este cambia
+            if filename != self.last_filename:
+                self.last_filename = filename
+                self.last_is_merge = '_mp4' in filename or '.mp4.' in filename or '.mkv.' in filename or '.temp.' in filename
+            info = d.get('info_dict') or {}
+            self.part_label = 'merge' if self.last_is_merge else info.get('format_id', 'default')
+            if self.last_is_merge or 'merging' in hook_status.lower():
+                status['current_stage'] = 'Mezclando video y audio...'
+                status['merging'] = True
+
+            # En listas se descargan varios videos en paralelo: separar sus partes por ID de video
+            key = (info.get('id', ''), self.part_label)
+            part = self.parts.get(key)
+            if part is None:
+                part = self.parts[key] = PartProgress(now)
+                self.unfinished += 1
+                # Archivo parcial que /api/stream sigue mientras crece
+                if 'stream_path' in status and not status['stream_path']:
+                    status['stream_path'] = d.get('tmpfilename') or filename
+            self.hook_status = hook_status
+
+            if hook_status == 'downloading':
+                self.current_video = filename
+                part.status = 'downloading'
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    self.total_bytes += total - part.total_bytes
+                    part.total_bytes = total
+                downloaded = d.get('downloaded_bytes')
+                if downloaded:
+                    delta = downloaded - part.downloaded_bytes
+                    self.downloaded_bytes += delta
+                    part.downloaded_bytes = downloaded
+                    elapsed = now - part.last_update
+                    if delta > 0 and elapsed > 0:
+                        # Velocidad agregada de todas las partes activas, suavizada con una EWMA
+                        part_speed = delta / elapsed
+                        self.active_speed += part_speed - part.speed
+                        part.speed = part_speed
+                        if self.speed:
+                            self.speed += self.SPEED_ALPHA * (self.active_speed - self.speed)
+                        else:
+                            self.speed = self.active_speed
+                    part.last_update = now
+                elif not self.speed and d.get('speed'):
+                    self.speed = d['speed']
+                self.reported_eta = d.get('eta') or 0
+                if now - self.last_publish < PROGRESS_PUBLISH_INTERVAL:
+                    return
+            elif hook_status == 'finished':
+                if part.status != 'finished':
+                    part.status = 'finished'
+                    self.unfinished -= 1
+                    self.active_speed -= part.speed
+                    part.speed = 0.0
+                    if part.total_bytes > 0:
+                        # Asegurar que se marca como 100% completado
+                        self.downloaded_bytes += part.total_bytes - part.downloaded_bytes
+                        part.downloaded_bytes = part.total_bytes
+                # Guardar el archivo finalizado
+                if not filename.endswith(('.part', '.ytdl', '.f')) and filename not in self.completed_names:
+                    self.completed_names.add(filename)
+                    status['completed_files'].append(filename)
+                # Si todas las partes están descargadas, empieza la mezcla
+                if self.unfinished == 0 and not status.get('current_stage', '').startswith('Mezclando'):
+                    status['current_stage'] = 'Mezclando video y audio...'
+                    status['current_progress'] = 99
+                    status['merging'] = True
+            elif hook_status == 'error':
+                if part.status == 'finished':
+                    self.unfinished += 1
+                part.status = 'error'
+                self.active_speed -= part.speed
+                part.speed = 0.0
+                status['errors'].append(f"Error durante la descarga del fragmento: {os.path.basename(filename)}")
+
+            self._publish(now)
+        publish_status(self.download_id)
+
+    def _publish(self, now):
+        # Volcar los valores agregados al diccionario de estado que leen la API y los eventos SSE
+        status = self.status
+        self.last_publish = now
+        status['hook_status'] = self.hook_status
+        status['parts_finished'] = self.unfinished == 0
+        postprocessing = status.get('merging', False) or status.get('encoding', False) or status.get('extracting_audio', False)
+        if not postprocessing:
+            if self.part_label == 'merge':
+                status['current_stage'] = 'Mezclando video y audio...'
             else:
-                status['eta'] = 0
+                status['current_stage'] = f"Descargando {self.part_label}..."
+        if self.total_bytes > 0:
+            status['total_bytes'] = self.total_bytes
+            status['downloaded_bytes'] = self.downloaded_bytes
+        if self.downloaded_bytes > self.counted_bytes:
+            METRIC_DOWNLOADED_BYTES.inc(self.downloaded_bytes - self.counted_bytes)
+            self.counted_bytes = self.downloaded_bytes
+        if self.hook_status != 'downloading':
+            return
+        status['current_video'] = os.path.basename(self.current_video)
+        status['speed'] = self.speed
+        status['elapsed'] = now - status.get('start_time', now)
+        remaining = self.total_bytes - self.downloaded_bytes
+        if self.speed > 0:
+            status['eta'] = remaining / self.speed if remaining > 0 else 0
         else:
-            # Si no podemos calcular, usar el ETA reportado por yt-dlp
-            status['eta'] = d.get('eta', 0)
-        
-        # Calcular el progreso general combinando todas las partes
-        total_bytes_all_parts = sum(p.get('total_bytes', 0) for p in status['parts'].values())
-        downloaded_bytes_all_parts = sum(p.get('downloaded_bytes', 0) for p in status['parts'].values())
-        
-        if total_bytes_all_parts > 0:
-            status['total_bytes'] = total_bytes_all_parts
-            status['downloaded_bytes'] = downloaded_bytes_all_parts
+            status['eta'] = self.reported_eta
+        if self.total_bytes > 0:
             # Si estamos mezclando, mantener el progreso en 99% hasta que termine
-            if status.get('merging', False) or status.get('encoding', False) or status.get('extracting_audio', False):
+            if postprocessing:
                 status['current_progress'] = 99
             else:
-                status['current_progress'] = int((downloaded_bytes_all_parts / total_bytes_all_parts) * 100)
+                status['current_progress'] = int(self.downloaded_bytes * 100 / self.total_bytes)
 
-    elif d['status'] == 'finished':
-        # Marcar esta parte como completada
-        part['status'] = 'finished'
-        if part['total_bytes'] > 0:
-            part['downloaded_bytes'] = part['total_bytes']  # Asegurar que se marca como 100% completado
-        
-        # Guardar el archivo finalizado
-        if not filename.endswith(('.part', '.ytdl', '.f')):
-            if 'completed_files' not in status:
-                status['completed_files'] = []
-            if filename not in status['completed_files']:
-                status['completed_files'].append(filename)
-        
-        # No incrementamos completed_videos aquí, se hará al final
-        
-        # Si detectamos que todas las partes están descargadas, establecer la etapa de mezcla
-        all_parts_finished = all(p.get('status') == 'finished' for p in status['parts'].values())
-        if all_parts_finished and not status.get('current_stage', '').startswith('Mezclando'):
-            status['current_stage'] = 'Mezclando video y audio...'
-            status['current_progress'] = 99  # Mantener en 99% durante la mezcla
-            status['merging'] = True
-    
-    elif d['status'] == 'error':
-        part['status'] = 'error'
-        status['errors'].append(f"Error durante la descarga del fragmento: {os.path.basename(filename)}")
+job_progress = {}
+
+# Grabación opcional de los eventos del hook (JSON Lines) para reproducirlos en benchmarks/
+hook_record_file = open(PROGRESS_HOOK_RECORD, 'a', encoding='utf-8') if PROGRESS_HOOK_RECORD else None
+hook_record_lock = threading.Lock()
+
+def record_hook_event(d):
+    info = d.get('info_dict') or {}
+    event = {k: d.get(k) for k in ('status', 'filename', 'tmpfilename', 'downloaded_bytes', 'total_bytes',
+                                   'total_bytes_estimate', 'speed', 'eta', 'fragment_index', 'fragment_count')}
+    event['info_dict'] = {'id': info.get('id'), 'format_id': info.get('format_id')}
+    event['t'] = time.time()
+    with hook_record_lock:
+        hook_record_file.write(json.dumps(event) + '\n')
+
+# Función para manejar el progreso con cálculos más estables
+def progress_hook(d, download_id):
+    progress = job_progress.get(download_id)
+    if progress is None:
+        status = download_status.get(download_id)
+        if not status:
+            return
+        progress = job_progress.setdefault(download_id, JobProgress(download_id, status))
+    if hook_record_file is not None:
+        record_hook_event(d)
+    progress.update(d)
+    bandwidth.consume(download_id, progress.downloaded_bytes)
+    fragment_tuner.observe(download_id, progress.downloaded_bytes)
 
 # Función para extraer información de la lista de reproducción
 def extract_playlist_info(url):
-    ydl_opts = {
-        'quiet': True,
-        'extract_flat': True,
-        'force_generic_extractor': False,
-        'retries': 10,                # Aumentar el número de reintentos
-        'fragment_retries': 10,       # Aumentar reintentos para fragmentos
-        'skip_unavailable_fragments': True,
-        'ignoreerrors': True,         # Ignorar errores y continuar
-        'extractor_retries': 10,      # Reintentos específicos para extractores
-        'socket_timeout': 30,         # Aumentar el tiempo de espera del socket
+    try:
+        info = get_flat_info(url)
+    except Exception as e:
+        return {'error': str(e)}
+
+    if info['entries'] is not None:
+        return {
+            'title': info['title'] or 'Playlist desconocida',
+            'total_videos': len(info['entries']),
+            'videos': [{
+                'title': entry.get('title') or f'Video {i+1}',
+                'id': entry.get('id', ''),
+                'url': entry.get('url', '')
+            } for i, entry in enumerate(info['entries'])]
+        }
+    return {
+        'title': info['title'] or 'Video único',
+        'total_videos': 1,
+        'videos': [{
+            'title': info['title'] or 'Video único',
+            'id': info.get('id', ''),
+            'url': url
+        }]
     }
-    
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+
+# URL descargable de una entrada obtenida con extract_flat
+def entry_url(entry):
+    url = entry.get('url') or entry.get('id', '')
+    if not url.startswith(('http://', 'https://')):
+        url = f"https://www.youtube.com/watch?v={entry.get('id') or url}"
+    return url
+
+# Presets de audio: se copia el stream si ya tiene el códec de destino y si no se recodifica
+AUDIO_PRESETS = {
+    'mp3': {'ext': 'mp3', 'muxer': 'mp3', 'encoder': 'libmp3lame', 'copy_codecs': ('mp3',)},
+    'm4a': {'ext': 'm4a', 'muxer': 'ipod', 'encoder': 'aac', 'copy_codecs': ('mp4a', 'aac')},
+    'opus': {'ext': 'opus', 'muxer': 'opus', 'encoder': 'libopus', 'copy_codecs': ('opus',)},
+}
+# Contenedores de la mezcla y códecs que aceptan sin recodificar
+MERGE_CONTAINERS = {
+    'mp4': {'video': ('avc1', 'av01', 'hev1', 'hvc1'), 'audio': ('mp4a', 'aac'), 'audio_encoder': 'aac'},
+    'webm': {'video': ('vp9', 'vp09', 'vp8', 'av01'), 'audio': ('opus', 'vorbis'), 'audio_encoder': 'libopus'},
+}
+FORMAT_CHOICE_HEIGHTS = (360, 480, 720, 1080, 1440, 2160)   # Techos de resolución de las opciones MP4
+
+def format_size(f, duration):
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = int(f['tbr'] * 125 * duration)   # kbit/s -> bytes
+    return size or None
+
+def codec_fits(codec, container, kind):
+    return (codec or '').startswith(MERGE_CONTAINERS[container][kind])
+
+# Opciones recomendadas de un video, calculadas una vez y guardadas con su información en caché
+def rank_formats(info):
+    """
+    Devuelve pocas opciones listas para descargar en lugar de todos los formatos: la mejor MP4
+    sin recodificar para cada techo de FORMAT_CHOICE_HEIGHTS, la mejor calidad absoluta (en el
+    contenedor que evita recodificar), el mejor archivo único con audio (sin mezcla, se puede
+    reproducir mientras se descarga) y tres de solo audio. Cada opción indica los formatos, el
+    contenedor, el tamaño estimado y si la mezcla tendrá que recodificar el audio.
+    """
+    duration = info.get('duration')
+    formats = [f for f in info.get('formats') or [] if f.get('format_id') and f.get('ext') != 'mhtml']
+    videos = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('acodec') == 'none']
+    audios = [f for f in formats if f.get('acodec') not in (None, 'none') and f.get('vcodec') == 'none']
+    combined = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none')]
+
+    def video_rank(f):
+        return (f.get('height') or 0, f.get('fps') or 0, f.get('tbr') or 0)
+
+    # A igual resolución, el códec más compatible del contenedor (avc1 antes que av01)
+    def mp4_rank(f):
+        codecs = MERGE_CONTAINERS['mp4']['video']
+        position = next(i for i, codec in enumerate(codecs) if f['vcodec'].startswith(codec))
+        return (f.get('height') or 0, f.get('fps') or 0, -position, f.get('tbr') or 0)
+
+    def audio_rank(f):
+        return f.get('abr') or f.get('tbr') or 0
+
+    def best_audio(container=None):
+        fits = [f for f in audios if container is None or codec_fits(f.get('acodec'), container, 'audio')]
+        return max(fits, key=audio_rank) if fits else None
+
+    choices = []
+    seen = set()
+
+    def add(choice_id, label, video, audio, container):
+        key = (video and video['format_id'], audio and audio['format_id'], container)
+        if key in seen:
+            return
+        seen.add(key)
+        sizes = [format_size(f, duration) for f in (video, audio) if f]
+        choices.append({
+            'id': choice_id,
+            'label': label,
+            'video_format_id': video['format_id'] if video else 'none',
+            'audio_format_id': audio['format_id'] if audio else 'none',
+            'container': container,
+            'height': video.get('height') if video else None,
+            'filesize_approx': sum(sizes) if sizes and all(sizes) else None,
+            'reencode': bool(video and audio and not codec_fits(audio.get('acodec'), container, 'audio')),
+            'streamable': (video is None or audio is None) and (video or audio).get('protocol', 'https') in STREAM_PROTOCOLS,
+        })
+
+    # MP4 sin recodificar: cada video aparece con el techo más bajo que lo incluye
+    mp4_videos = [f for f in videos if codec_fits(f.get('vcodec'), 'mp4', 'video')]
+    mp4_audio = best_audio('mp4')
+    if mp4_audio:
+        picked = set()
+        for cap in FORMAT_CHOICE_HEIGHTS:
+            fits = [f for f in mp4_videos if (f.get('height') or 0) <= cap]
+            if fits:
+                video = max(fits, key=mp4_rank)
+                if video['format_id'] not in picked:
+                    picked.add(video['format_id'])
+                    add(f'mp4-{cap}', f"MP4 {video.get('height')}p (sin recodificar)", video, mp4_audio, 'mp4')
+
+    # Mejor calidad: el contenedor que acepte tal cual el video y el audio elegidos
+    if videos and audios:
+        video, audio = max(videos, key=video_rank), best_audio()
+        container = next((name for name in MERGE_CONTAINERS
+                          if codec_fits(video.get('vcodec'), name, 'video') and codec_fits(audio.get('acodec'), name, 'audio')), 'mp4')
+        add('best', f"Mejor calidad: {video.get('height')}p {container.upper()}", video, audio, container)
+    # La mejor calidad primero y las MP4 de mayor a menor resolución
+    choices.sort(key=lambda c: (c['id'] != 'best', -(c['height'] or 0)))
+
+    if combined:
+        video = max(combined, key=video_rank)
+        add('single-file', f"{video.get('height')}p {video.get('ext')} en un solo archivo (sin mezcla)", video, None, video.get('ext'))
+
+    if audios:
+        audio = best_audio()
+        add('audio-best', f"Solo audio, mejor calidad ({audio.get('ext')})", None, audio, audio.get('ext'))
+        if mp4_audio:
+            add('audio-m4a', 'Solo audio M4A (sin recodificar)', None, mp4_audio, 'm4a')
+        def lightness(f):
+            # Bytes y bitrate no se comparan entre sí: primero los de tamaño conocido, y sin
+            # tamaño, el de menor bitrate
+            size = format_size(f, duration)
+            return (size is None, size or 0, audio_rank(f) or float('inf'))
+
+        smallest = min(audios, key=lightness)
+        add('audio-small', f"Solo audio, el más ligero ({smallest.get('ext')})", None, smallest, smallest.get('ext'))
+    return choices
+
+# Opción recomendada por su ID; 'mp4-N' cae en la mayor MP4 disponible por debajo de N
+def resolve_choice(choices, choice_id):
+    for choice in choices:
+        if choice['id'] == choice_id:
+            return choice
+    match = re.match(r'^mp4-(\d+)$', choice_id or '')
+    if match:
+        fits = [c for c in choices if c['id'].startswith('mp4-') and int(c['id'][4:]) <= int(match.group(1))]
+        if fits:
+            return max(fits, key=lambda c: int(c['id'][4:]))
+    return None
+
+
+# Etapa de post-procesamiento separada de las descargas
+# Fallo de ffmpeg en la etapa de post-procesamiento: repetir la descarga no lo arregla
+class PostprocessError(RuntimeError):
+    pass
+
+class PostprocessPipeline:
+    """
+    Mezcla y convierte con ffmpeg en un pool propio de MAX_POSTPROCESS_WORKERS procesos,
+    cada uno limitado a FFMPEG_THREADS hilos. submit() devuelve un Future sin esperar a ffmpeg:
+    el trabajo pasa a 'postprocessing' y su worker y el turno de descarga quedan libres para
+    otros trabajos. Siempre que el destino lo permite se copian los streams (remux) en lugar
+    de recodificarlos.
+    """
+
+    def __init__(self, workers, threads):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='ffmpeg')
+
+    def submit(self, download_id, streams, target_dir, preset):
+        return self.executor.submit(self._process, download_id, streams, target_dir, preset, time.time())
+
+    @staticmethod
+    def _base_name(path):
+        # 'Título.f137.mp4' -> 'Título'
+        name = os.path.basename(path)
+        match = re.match(r'(.*)\.f[^.]+\.[^.]+$', name)
+        return match.group(1) if match else os.path.splitext(name)[0]
+
+    def _process(self, download_id, streams, target_dir, preset, submitted):
+        started = time.time()
+        add_timing(download_id, 'postprocess_wait', started - submitted)
+        status = download_status.get(download_id)
+        video = next((s for s in streams if s['vcodec'] != 'none'), None)
+        audio = next((s for s in streams if s['acodec'] != 'none' and s is not video), None)
+        flag = None
+        try:
+            if preset['kind'] == 'merge' and video is not None and audio is not None:
+                flag, stage = 'merging', 'Mezclando video y audio...'
+                muxer = preset.get('container', 'mp4')
+                output = os.path.join(target_dir, f"{self._base_name(video['path'])}.{muxer}")
+                if codec_fits(audio['acodec'], muxer, 'audio'):
+                    audio_args = ['-c:a', 'copy']
+                else:
+                    audio_args = ['-c:a', MERGE_CONTAINERS[muxer]['audio_encoder'], '-b:a', AUDIO_BITRATE]
+                args = ['-i', video['path'], '-i', audio['path'], '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', *audio_args]
+            elif preset['kind'] == 'audio' and (audio or video) is not None:
+                source = audio or video
+                audio_preset = AUDIO_PRESETS[preset['codec']]
+                flag, stage = 'extracting_audio', 'Extrayendo audio...'
+                output = os.path.join(target_dir, f"{self._base_name(source['path'])}.{audio_preset['ext']}")
+                if source['acodec'].startswith(audio_preset['copy_codecs']):
+                    codec_args = ['-c:a', 'copy']
+                else:
+                    codec_args = ['-c:a', audio_preset['encoder'], '-b:a', AUDIO_BITRATE]
+                args = ['-i', source['path'], '-vn', *codec_args]
+                muxer = audio_preset['muxer']
+            else:
+                # Un solo stream que ya sirve tal cual: solo quitar el sufijo del formato
+                source = (video or audio or streams[0])['path']
+                output = os.path.join(target_dir, self._base_name(source) + os.path.splitext(source)[1])
+                if source != output:
+                    os.replace(source, output)
+                return [output]
+
+            if status is not None:
+                status[flag] = True
+                status['current_stage'] = stage
+                status['current_progress'] = 99
+                publish_status(download_id)
+            temp_path = output + '.part'
+            command = [FFMPEG_BINARY, '-y', '-nostdin', '-loglevel', 'error', '-threads', str(self.threads),
+                       *args, '-f', muxer, temp_path]
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_path)
+                error = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+                raise PostprocessError(f"ffmpeg falló: {error[-1] if error else result.returncode}")
+            os.replace(temp_path, output)
+            # Los streams originales ya no hacen falta
+            for stream in streams:
+                if stream['path'] != output:
+                    with contextlib.suppress(OSError):
+                        os.remove(stream['path'])
+            return [output]
+        finally:
+            elapsed = time.time() - started
+            add_timing(download_id, 'postprocess', elapsed, postprocessor=f"pipeline:{preset['kind']}")
+            METRIC_POSTPROCESS_SECONDS.observe(elapsed, postprocessor=f"pipeline:{preset['kind']}")
+            if status is not None and flag:
+                status[flag] = False
+                if all(not status.get(k, False) for k in ['merging', 'encoding', 'extracting_audio']):
+                    status['current_stage'] = 'Procesamiento completado'
+                publish_status(download_id)
+
+postprocess_pipeline = PostprocessPipeline(MAX_POSTPROCESS_WORKERS, FFMPEG_THREADS) if POSTPROCESS_PIPELINE else None
+
+# Ejecutar yt-dlp para un video en target_dir; devuelve las rutas finales o [] si falló.
+# Si se pasa streams, cada stream descargado se anota ahí con sus códecs.
+# Con download_id, la instancia usa los fragmentos simultáneos y el chunk ajustados para el trabajo.
+def run_video_download(base_config, url, target_dir, cache_key=None, extra_config=None, streams=None, download_id=None):
+    final_paths = []
+    config = dict(base_config)
+    config.update(extra_config or {})
+    config.pop('postprocess_preset', None)
+    config.update({
+        # Con streams separados, el ID de formato evita que video y audio compartan nombre
+        'outtmpl': '%(title)s.f%(format_id)s.%(ext)s' if streams is not None else '%(title)s.%(ext)s',
+        # La carpeta va en 'paths' para que la plantilla no cambie y la instancia del pool sirva a otros trabajos
+        'paths': {'home': target_dir},
+        # yt-dlp llama a post_hooks con la ruta definitiva tras el post-procesamiento
+        'post_hooks': [final_paths.append],
+        # Un solo video por llamada: un fallo llega como DownloadError en lugar de ignorarse
+        'ignoreerrors': False,
+    })
+    cached_info = metadata_cache.get(cache_key) if cache_key else None
+    with ytdl_pool.checkout(config, streams, download_id) as ydl, fragment_tuner.attach(download_id, ydl.params):
+        if cached_info is not None:
+            # Reutilizar la información ya extraída; si las URLs caducaron, extraer de nuevo
+            try:
+                ydl.process_ie_result(copy.deepcopy(cached_info), download=True)
+            except yt_dlp.utils.DownloadError:
+                metadata_cache.delete(cache_key)
+                final_paths.clear()
+                if streams is not None:
+                    streams.clear()
+                cached_info = None
+        if cached_info is None:
+            # El error ya quedó en el log a través del logger de la tarea
+            try:
+                info = ydl.extract_info(url, download=True)
+            except yt_dlp.utils.DownloadError:
+                return []
+            cache_video_info(ydl, info)
+    return final_paths
+
+# Gestor de retención: caducidad, presupuesto de disco con expulsión LRU y limpieza de restos
+class RetentionManager:
+    """
+    Elimina trabajos terminados cuyo último acceso supera max_age, expulsa los menos usados
+    mientras el uso de disco supere max_bytes y borra artefactos del almacén que ya no
+    enlaza ningún trabajo ni lista sincronizada, según sus índices. Los trabajos en curso y
+    las descargas activas nunca se tocan; _sync no se barre ni cuenta para max_bytes.
+    """
+
+    def __init__(self, max_bytes, max_age, interval):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {
+            'sweeps': 0,
+            'expired_jobs': 0,
+            'evicted_jobs': 0,
+            'evicted_artifacts': 0,
+            'orphans_removed': 0,
+            'bytes_freed': 0,
+            'usage_bytes': 0,
+            'last_sweep': None,
+        }
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='retention-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                app.logger.exception('Error en el barrido de retención')
+
+    @staticmethod
+    def _recently_modified(path, now):
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    if now - os.path.getmtime(os.path.join(root, name)) < RETENTION_GRACE:
+                        return True
+                except OSError:
+                    pass
+        return False
+
+    def _remove_tree(self, path):
+        freed = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                    # Un hardlink compartido no libera espacio hasta que se borra el último enlace
+                    if st.st_nlink <= 1:
+                        freed += st.st_size
+                except OSError:
+                    pass
+        shutil.rmtree(path, ignore_errors=True)
+        self.stats['bytes_freed'] += freed
+        return freed
+
+    def _remove_file(self, path):
+        try:
+            st = os.lstat(path)
+            os.remove(path)
+        except OSError:
+            return
+        if st.st_nlink <= 1:
+            self.stats['bytes_freed'] += st.st_size
+        self.stats['orphans_removed'] += 1
+
+    @staticmethod
+    def disk_usage(include_sync=True):
+        # Cada inodo cuenta una sola vez aunque esté enlazado desde varios trabajos.
+        # Sin include_sync no cuentan los archivos enlazados en _sync, que la retención no borra
+        seen = set()
+        total = 0
+        if not include_sync:
+            for root, _, files in os.walk(SYNC_FOLDER):
+                for name in files:
+                    with contextlib.suppress(OSError):
+                        st = os.lstat(os.path.join(root, name))
+                        seen.add((st.st_dev, st.st_ino))
+        for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
+            if not include_sync and root == DOWNLOAD_FOLDER and '_sync' in dirs:
+                dirs.remove('_sync')
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_size
+        return total
+
+    @staticmethod
+    def _store_references():
+        # Claves del almacén enlazadas por cada trabajo (.manifest.jsonl) y cada lista sincronizada
+        # (.index.jsonl, donde vale la última línea de cada video)
+        references = {}
+        for name in os.listdir(DOWNLOAD_FOLDER):
+            if name.startswith('_'):
+                continue
+            keys = set()
+            with contextlib.suppress(OSError), open(os.path.join(DOWNLOAD_FOLDER, name, MANIFEST_NAME), encoding='utf-8') as f:
+                for line in f:
+                    with contextlib.suppress(ValueError, AttributeError):
+                        keys.add(json.loads(line).get('store'))
+            keys.discard(None)
+            if keys:
+                references[name] = keys
+        if os.path.isdir(SYNC_FOLDER):
+            for key in os.listdir(SYNC_FOLDER):
+                videos = {}
+                with contextlib.suppress(OSError), open(os.path.join(SYNC_FOLDER, key, SyncIndex.INDEX), encoding='utf-8') as f:
+                    for line in f:
+                        with contextlib.suppress(ValueError, KeyError, TypeError):
+                            record = json.loads(line)
+                            videos[record['id']] = record.get('store')
+                keys = set(videos.values()) - {None}
+                if keys:
+                    references[os.path.join('_sync', key)] = keys
+        return references
+
+    def _job_candidates(self, now):
+        # Trabajos terminados (o directorios huérfanos) ordenados del menos al más recientemente usado
+        candidates = []
+        for name in os.listdir(DOWNLOAD_FOLDER):
+            path = os.path.join(DOWNLOAD_FOLDER, name)
+            if name.startswith('_') or not os.path.isdir(path):
+                continue
+            status = find_job(name)
+            if status is not None:
+                if status.get('status') in ACTIVE_JOB_STATES:
+                    continue
+                last_used = max(status.get('last_access') or status.get('finished_at') or status.get('start_time', 0),
+                                job_store.last_access(name) or 0)
+            else:
+                last_used = os.path.getmtime(path)
+            candidates.append((last_used, name, path))
+        # Estados sin directorio (por ejemplo, errores antes de crearlo)
+        for name, status in list(download_status.items()):
+            if status.get('status') not in ACTIVE_JOB_STATES and not os.path.isdir(os.path.join(DOWNLOAD_FOLDER, name)):
+                candidates.append((status.get('finished_at') or status.get('start_time', 0), name, None))
+        candidates.sort()
+        return candidates
+
+    def _remove_job(self, name, path):
+        if path:
+            self._remove_tree(path)
+        download_status.pop(name, None)
+        job_options.pop(name, None)
+        job_manifests.pop(name, None)
+        job_store.delete(name)
+        status_versions.pop(name, None)
+        with status_changed_lock:
+            status_changed.pop(name, None)
+
+    def _sweep_store(self, now, references, expire_all_unreferenced=False):
+        if content_store is None or not os.path.isdir(STORE_FOLDER):
+            return
+        referenced = set().union(*references.values())
+        for key in os.listdir(STORE_FOLDER):
+            entry_dir = os.path.join(STORE_FOLDER, key)
+            if not os.path.isdir(entry_dir) or content_store.in_flight(key) or self._recently_modified(entry_dir, now):
+                continue
+            manifest_path = os.path.join(entry_dir, ContentStore.MANIFEST)
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    artifacts = set(json.load(f).get('files', []))
+                last_used = os.path.getmtime(manifest_path)
+            except (OSError, ValueError):
+                # Descarga abandonada sin manifiesto: solo restos parciales
+                if now - os.path.getmtime(entry_dir) > self.max_age:
+                    self._remove_tree(entry_dir)
+                    self.stats['orphans_removed'] += 1
+                continue
+
+            for name in os.listdir(entry_dir):
+                if name not in artifacts and not name.startswith('.') and name.endswith(LEFTOVER_SUFFIXES):
+                    self._remove_file(os.path.join(entry_dir, name))
+            if key not in referenced and (expire_all_unreferenced or now - last_used > self.max_age):
+                self._remove_tree(entry_dir)
+                self.stats['evicted_artifacts'] += 1
+
+    def _clean_job_leftovers(self, now):
+        for name in os.listdir(DOWNLOAD_FOLDER):
+            path = os.path.join(DOWNLOAD_FOLDER, name)
+            status = find_job(name) if os.path.isdir(path) else None
+            if name.startswith('_') or not os.path.isdir(path) or (status and status.get('status') in ACTIVE_JOB_STATES):
+                continue
+            for filename in os.listdir(path):
+                file_path = os.path.join(path, filename)
+                if (not filename.startswith('.') and filename.endswith(LEFTOVER_SUFFIXES)
+                        and now - os.path.getmtime(file_path) > RETENTION_GRACE):
+                    self._remove_file(file_path)
+
+    def sweep(self):
+        with self._lock:
+            now = time.time()
+            references = self._store_references()
+            # 1. Caducidad por antigüedad del último acceso
+            for last_used, name, path in self._job_candidates(now):
+                if now - last_used > self.max_age:
+                    self._remove_job(name, path)
+                    references.pop(name, None)
+                    self.stats['expired_jobs'] += 1
+            self._clean_job_leftovers(now)
+            self._sweep_store(now, references)
+
+            # 2. Presupuesto de disco (sin _sync): expulsar por LRU hasta quedar por debajo
+            usage = self.disk_usage(include_sync=False)
+            if self.max_bytes > 0 and usage > self.max_bytes:
+                for _, name, path in self._job_candidates(now):
+                    self._remove_job(name, path)
+                    references.pop(name, None)
+                    self.stats['evicted_jobs'] += 1
+                    self._sweep_store(now, references, expire_all_unreferenced=True)
+                    usage = self.disk_usage(include_sync=False)
+                    if usage <= self.max_bytes:
+                        break
+
+            self.stats['usage_bytes'] = usage
+            self.stats['sweeps'] += 1
+            self.stats['last_sweep'] = now
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+        data.update({'max_bytes': self.max_bytes, 'max_age': self.max_age, 'interval': self.interval})
+        return data
+
+retention_manager = RetentionManager(DOWNLOAD_MAX_BYTES, DOWNLOAD_MAX_AGE, RETENTION_SWEEP_INTERVAL)
+retention_manager.start()
+
+# Índice incremental de los archivos finales de un trabajo
+class FileManifest:
+    """
+    Se alimenta con las rutas que yt-dlp entrega en post_hooks, así que nunca hace falta
+    recorrer el directorio del trabajo. Cada archivo nuevo se añade como una línea JSON
+    al índice oculto, que otros workers o un reinicio pueden leer sin escanear el disco.
+    """
+
+    def __init__(self, download_id):
+        self.download_id = download_id
+        self.path = os.path.join(DOWNLOAD_FOLDER, download_id, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.files = []
+        self.names = set()
+        self.ordered = True
+
+    @classmethod
+    def load(cls, download_id):
+        manifest = cls(download_id)
+        try:
+            with open(manifest.path, encoding='utf-8') as f:
+                for line in f:
+                    with contextlib.suppress(ValueError):
+                        manifest._insert(json.loads(line))
+        except FileNotFoundError:
+            return None
+        return manifest
+
+    def _insert(self, record):
+        if record['name'] in self.names:
+            return False
+        self.names.add(record['name'])
+        if self.files and record.get('index', 0) < self.files[-1].get('index', 0):
+            self.ordered = False
+        self.files.append({
+            'name': record['name'],
+            'size': record['size'],
+            'url': f"/downloads/{self.download_id}/{record['name']}",
+            'index': record.get('index', 0),
+        })
+        return True
+
+    # Registrar archivos terminados; index es la posición en la lista (para ordenar) y store la
+    # clave del almacén de la que se enlazaron, que los protege de la retención
+    def add(self, paths, index=0, store=None):
+        lines = []
+        with self.lock:
+            for file_path in paths:
+                record = {'name': os.path.basename(file_path), 'size': os.path.getsize(file_path), 'index': index or 0}
+                if store:
+                    record['store'] = store
+                if self._insert(record):
+                    lines.append(json.dumps(record) + '\n')
+            if lines:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+
+    # Archivos en el orden de la lista
+    def sorted_files(self):
+        with self.lock:
+            if not self.ordered:
+                self.files.sort(key=lambda file: file['index'])
+                self.ordered = True
+            return list(self.files)
+
+job_manifests = {}
+
+# Índice del trabajo: el de este proceso mientras descarga o el guardado en disco
+def get_manifest(download_id, create=False):
+    manifest = job_manifests.get(download_id)
+    if manifest is None:
+        manifest = FileManifest.load(download_id)
+        if manifest is None and create:
+            manifest = FileManifest(download_id)
+        if manifest is not None and create:
+            manifest = job_manifests.setdefault(download_id, manifest)
+    return manifest
+
+# Descargar un video pasando por el almacén compartido cuando se conoce su ID; devuelve un Future
+# con las rutas finales, que sigue pendiente mientras ffmpeg trabaja
+def fetch_video(base_config, url, video_id, download_id, extra_config=None, on_wait=None, slot=None, index=0, stream=False):
+    cache_key = f'video:{video_id}' if video_id else None
+    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+    slot = slot or contextlib.nullcontext()
+
+    preset = base_config.get('postprocess_preset') if postprocess_pipeline is not None else None
+
+    def produce(target_dir):
+        streams = [] if preset else None
+        wait_start = time.time()
+        with slot:
+            started = time.time()
+            add_timing(download_id, 'download_wait', started - wait_start)
+            paths = run_video_download(base_config, url, target_dir, cache_key, extra_config, streams, download_id)
+            add_timing(download_id, 'download', time.time() - started)
+        # El turno de descarga ya está libre: ffmpeg trabaja en su propio pool
+        if paths and streams:
+            return postprocess_pipeline.submit(download_id, streams, target_dir, preset)
+        return resolved_future(paths)
+
+    def link(produced):
+        paths = produced.result()
+        return link_artifacts(paths, download_dir) if paths else []
+
+    def register(produced):
+        paths = produced.result()
+        if paths:
+            get_manifest(download_id, create=True).add(paths, index, store_key)
+        return paths
+
+    store_key = None
+    try:
+        if content_store is None or not video_id:
+            produced = produce(download_dir)
+        else:
+            store_key = ContentStore.key_for(video_id, base_config)
+            if stream:
+                # /api/stream sigue el archivo parcial que anotan los hooks de esta descarga: del
+                # almacén solo sirve un artefacto terminado, nunca sumarse a otra descarga en curso
+                paths = content_store.lookup(store_key)
+                if not paths:
+                    store_key = None
+                produced = resolved_future(link_artifacts(paths, download_dir)) if paths else produce(download_dir)
+            else:
+                produced = chain_future(content_store.fetch(store_key, produce, on_wait), link)
+    except Exception as e:
+        produced = resolved_future(error=e)
+    return chain_future(produced, register)
+
+# Índice persistente de una lista sincronizada (trabajos de tipo 'sync')
+class SyncIndex:
+    """
+    SYNC_FOLDER/<clave>/ guarda un enlace a los archivos de cada video de la lista y el índice
+    oculto .index.jsonl, con una línea por video sincronizado (ID, archivos, perfil de formato y
+    fecha); la última línea de cada ID es la que vale. Los enlaces mantienen los archivos aunque
+    la retención borre los trabajos que los descargaron.
+    """
+
+    INDEX = '.index.jsonl'
+
+    def __init__(self, key):
+        self.key = key
+        self.root = os.path.join(SYNC_FOLDER, key)
+        self.path = os.path.join(self.root, self.INDEX)
+        self.lock = threading.Lock()
+        self.videos = {}
+        self.lines = 0
+        self._lock_file = None
+
+    # Una carpeta por URL de lista: /@canal y /@canal/videos son listados distintos
+    @staticmethod
+    def key_for(url):
+        cache_key = metadata_cache_key(url)
+        if cache_key.startswith('playlist:'):
+            return secure_filename(f"playlist_{cache_key[len('playlist:'):]}")
+        return 'url_' + hashlib.sha256(cache_key.encode('utf-8')).hexdigest()[:24]
+
+    @staticmethod
+    def profile_key(config):
+        raw = json.dumps(ContentStore.profile(config), sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+    # Bloqueo exclusivo mientras dura la sincronización, también frente a otros procesos.
+    # No espera: devuelve False si otra sincronización de la misma lista lo tiene
+    def acquire(self):
+        os.makedirs(self.root, exist_ok=True)
+        lock_file = open(os.path.join(self.root, '.lock'), 'w')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.load()
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        except BaseException:
+            lock_file.close()
+            raise
+        self._lock_file = lock_file
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def load(self):
+        self.videos = {}
+        self.lines = 0
         try:
-            info = ydl.extract_info(url, download=False)
-            if 'entries' in info:
-                # Filtrar entradas None que pueden aparecer cuando hay errores
-                valid_entries = [entry for entry in info['entries'] if entry is not None]
-                return {
-                    'title': info.get('title', 'Playlist desconocida'),
-                    'total_videos': len(valid_entries),
-                    'videos': [{
-                        'title': entry.get('title', f'Video {i+1}'),
-                        'id': entry.get('id', ''),
-                        'url': entry.get('url', '')
-                    } for i, entry in enumerate(valid_entries)]
-                }
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    with contextlib.suppress(ValueError, KeyError):
+                        record = json.loads(line)
+                        self.videos[record['id']] = record
+                        self.lines += 1
+        except FileNotFoundError:
+            return
+        # Reescribir el índice cuando acumula demasiadas líneas reemplazadas
+        if self.lines > 2 * len(self.videos) + 100:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(record) + '\n' for record in self.videos.values())
+            os.replace(self.path + '.tmp', self.path)
+            self.lines = len(self.videos)
+
+    # Archivos ya sincronizados de un video con el mismo perfil, o None si hay que descargarlo
+    def lookup(self, video_id, profile):
+        record = self.videos.get(video_id)
+        if record is None or record.get('profile') != profile:
+            return None
+        paths = [os.path.join(self.root, name) for name in record.get('files', [])]
+        if not paths or not all(os.path.isfile(path) for path in paths):
+            return None
+        return paths
+
+    def record(self, entry, profile, paths, store=None):
+        with self.lock:
+            # Un cambio de perfil sustituye los archivos anteriores del video
+            previous = self.videos.get(entry['id'])
+            for name in previous.get('files', []) if previous else []:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.root, name))
+            mirrored = link_artifacts(paths, self.root)
+            record = {
+                'id': entry['id'],
+                'title': entry['title'],
+                'files': [os.path.basename(path) for path in mirrored],
+                'profile': profile,
+                'store': store,
+                'synced_at': time.time(),
+            }
+            self.videos[entry['id']] = record
+            self.lines += 1
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+
+    # Marca como 'unchanged' (y enlaza en el trabajo) las entradas ya sincronizadas con este perfil
+    def plan(self, entries, profile, download_id):
+        download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+        summary = {'key': self.key, 'new': 0, 'changed': 0, 'unchanged': 0}
+        current = set()
+        for entry in entries:
+            current.add(entry['id'])
+            paths = self.lookup(entry['id'], profile) if entry['id'] else None
+            if paths:
+                get_manifest(download_id, create=True).add(link_artifacts(paths, download_dir), entry['index'])
+                entry['status'] = 'unchanged'
+                summary['unchanged'] += 1
+            elif entry['id'] in self.videos:
+                summary['changed'] += 1
             else:
-                return {
-                    'title': info.get('title', 'Video único'),
-                    'total_videos': 1,
-                    'videos': [{
-                        'title': info.get('title', 'Video único'),
-                        'id': info.get('id', ''),
-                        'url': url
-                    }]
-                }
+                summary['new'] += 1
+        summary['removed'] = sum(1 for video_id in self.videos if video_id not in current)
+        return summary
+
+# Descargar un único video de una lista con reintentos; devuelve un Future con las rutas finales
+def download_playlist_entry(base_config, entry, download_id):
+    status = download_status[download_id]
+    attempts = PLAYLIST_ENTRY_RETRIES + 1
+    extra_config = {'noplaylist': True, 'playlist_items': None}
+
+    def mark_shared():
+        entry['shared'] = True
+
+    def settle(future):
+        try:
+            final_paths = future.result()
         except Exception as e:
-            return {'error': str(e)}
+            entry['error'] = str(e)
+            return None
+        if final_paths:
+            entry['status'] = 'completed'
+            entry['error'] = None
+            return final_paths
+        entry['error'] = 'yt-dlp no generó ningún archivo'
+        return None
+
+    def fail():
+        entry['status'] = 'error'
+        status['errors'].append(f"No se pudo descargar \"{entry['title']}\": {entry['error']}")
+        return []
+
+    for attempt in range(1, attempts + 1):
+        entry['attempts'] = attempt
+        entry['status'] = 'downloading'
+        entry['shared'] = False
+        future = fetch_video(base_config, entry['url'], entry['id'], download_id, extra_config,
+                             on_wait=mark_shared, slot=bandwidth.slot(download_id, playlist_entry_slots),
+                             index=entry['index'])
+        if entry['shared']:
+            # Otro trabajo descarga el mismo video: esperar su resultado sin ocupar un turno de
+            # entrada (el productor puede estar esperando uno) y reintentar aquí si su descarga falla
+            wait_futures([future])
+        elif not future.done():
+            # La descarga terminó y ffmpeg sigue en su pool: el hilo de la entrada queda libre.
+            # Un fallo de ffmpeg no se reintenta, porque repetir la descarga no lo arregla
+            entry['status'] = 'postprocessing'
+            return chain_future(future, lambda f: settle(f) or fail())
+        final_paths = settle(future)
+        if final_paths:
+            return resolved_future(final_paths)
+        if isinstance(future.exception(), PostprocessError):
+            break
+        if attempt < attempts:
+            entry['status'] = 'retrying'
+            METRIC_RETRIES.inc(kind='entry')
+            time.sleep(2 ** attempt)
+    return resolved_future(fail())
+
+# Descargar las entradas de una lista en paralelo y agregar los archivos en el orden de la lista;
+# devuelve un Future que termina con el resumen cuando ffmpeg acaba con todas
+def download_playlist_entries(base_config, valid_entries, download_options, download_id, sync_index=None):
+    status = download_status[download_id]
+    try:
+        workers = int(download_options.get('parallel', PLAYLIST_WORKERS))
+    except (TypeError, ValueError):
+        workers = PLAYLIST_WORKERS
+    workers = min(max(workers, 1), MAX_PLAYLIST_WORKERS)
+
+    status['entries'] = [{
+        'index': i + 1,
+        'id': entry.get('id', ''),
+        'title': entry.get('title') or f'Video {i + 1}',
+        'url': entry_url(entry),
+        'status': 'pending',
+        'attempts': 0,
+        'error': None,
+    } for i, entry in enumerate(valid_entries)]
+    # En una sincronización solo se descargan los videos nuevos o con otro perfil de formato
+    profile = SyncIndex.profile_key(base_config) if sync_index else None
+    if sync_index:
+        status['sync'] = sync_index.plan(status['entries'], profile, download_id)
+        status['completed_videos'] = status['sync']['unchanged']
+    status['parallel_workers'] = workers
+    status['status'] = 'downloading'
+    lock = threading.Lock()
+
+    def finish_entry(entry, future):
+        paths = future.result()
+        if paths and sync_index and entry['id']:
+            store = ContentStore.key_for(entry['id'], base_config) if content_store is not None else None
+            sync_index.record(entry, profile, paths, store)
+        with lock:
+            if paths:
+                status['completed_videos'] += 1
+        return paths
+
+    def run_entry(entry):
+        if entry['status'] == 'unchanged':
+            return resolved_future([])
+        return chain_future(download_playlist_entry(base_config, entry, download_id),
+                            lambda future: finish_entry(entry, future))
+
+    def summarize(_):
+        # El índice ya tiene los archivos de cada video en el orden de la lista
+        manifest = get_manifest(download_id)
+        final_files = manifest.sorted_files() if manifest else []
+
+        failed = sum(1 for entry in status['entries'] if entry['status'] == 'error')
+        status['final_files'] = final_files
+        if final_files and not failed:
+            status['status'] = 'completed'
+            status['current_progress'] = 100
+            status['current_stage'] = 'Descarga completada'
+        elif final_files:
+            status['status'] = 'partial'
+            status['current_stage'] = f'Descarga parcial: {failed} videos con error'
+        else:
+            status['status'] = 'error'
+            status['current_stage'] = 'Error en la descarga'
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{download_id}-entry') as executor:
+        futures = list(executor.map(run_entry, status['entries']))
+
+    # Las descargas terminaron; si ffmpeg sigue con alguna entrada, el resumen espera a que acabe
+    pending = gather_futures(futures)
+    if not pending.done():
+        status['status'] = 'postprocessing'
+        publish_status(download_id)
+    return chain_future(pending, summarize)
+
+# Otra sincronización de la misma lista está en curso: volver a la cola pasado un rato en lugar
+# de ocupar un worker esperando el bloqueo
+def requeue_sync(download_options, download_id):
+    status = download_status[download_id]
+    status['status'] = 'queued'
+    status['current_stage'] = 'Esperando a otra sincronización de esta lista...'
+    publish_status(download_id)
+
+    def resubmit():
+        if not scheduler.submit(download_id, download_videos, (download_options, download_id), status.get('priority', 1)):
+            status['status'] = 'error'
+            status['current_stage'] = 'Error en la descarga'
+            status['errors'].append('No se pudo volver a encolar la sincronización: la cola está llena.')
+            publish_status(download_id)
+
+    timer = threading.Timer(SYNC_RETRY_DELAY, resubmit)
+    timer.daemon = True
+    timer.start()
 
 # Función para descargar videos
 def download_videos(download_options, download_id):
+    sync_index = None
+    if download_options.get('type') == 'sync':
+        sync_index = SyncIndex(SyncIndex.key_for(download_options['url']))
+        if not sync_index.acquire():
+            requeue_sync(download_options, download_id)
+            return
+    status = download_status[download_id]
+    status['queue_wait'] = time.time() - status.get('queued_at', time.time())
+    add_timing(download_id, 'queue', status['queue_wait'])
+    status['status'] = 'starting'
+    status['current_stage'] = 'Iniciando...'
+    publish_status(download_id)
+    job_type = download_options.get('type', 'download')
+    METRIC_JOBS_STARTED.inc(type=job_type)
+    bandwidth.start_job(download_id, download_options['url'], status)
+    fragment_tuner.start_job(download_id, download_options['url'], status)
+    try:
+        pending = _download_videos(download_options, download_id, sync_index)
+    except BaseException:
+        finish_download(download_id, job_type, sync_index)
+        raise
+    if pending is None:
+        finish_download(download_id, job_type, sync_index)
+    else:
+        # ffmpeg sigue en su pool: el worker queda libre y el trabajo se cierra cuando termina
+        pending.add_done_callback(lambda _: finish_download(download_id, job_type, sync_index))
+
+# Cierre de un trabajo: tiempos, métricas y recursos (en el worker o cuando termina ffmpeg)
+def finish_download(download_id, job_type, sync_index=None):
+    status = download_status[download_id]
+    if sync_index is not None:
+        sync_index.release()
+    status['finished_at'] = time.time()
+    add_timing(download_id, 'total', status['finished_at'] - status.get('queued_at', status['finished_at']),
+               type=job_type, status=status['status'], bytes=status.get('downloaded_bytes', 0))
+    METRIC_JOBS_FINISHED.inc(type=job_type, status=status['status'])
+    download_seconds = status['timings'].get('download', 0)
+    if download_seconds > 0 and status.get('downloaded_bytes'):
+        METRIC_DOWNLOAD_SPEED.observe(status['downloaded_bytes'] / download_seconds)
+    bandwidth.end_job(download_id)
+    fragment_tuner.end_job(download_id)
+    job_progress.pop(download_id, None)
+    job_manifests.pop(download_id, None)
+    publish_status(download_id)
+    if cluster_agent is not None:
+        cluster_agent.wake()
+
+def _download_videos(download_options, download_id, sync_index=None):
     url = download_options['url']
     
     # Configurar opciones de descarga
@@ -336,8 +3251,9 @@ def download_videos(download_options, download_id):
     # Añadir el download_id a las opciones para que los hooks lo tengan disponible
     download_options['download_id'] = download_id
     
-    # Obtener configuración optimizada de yt-dlp
-    base_config = get_ytdlp_config(download_options['type'], download_options)
+    # Obtener configuración optimizada de yt-dlp (una sincronización descarga como una lista)
+    download_type = 'playlist' if download_options['type'] == 'sync' else download_options['type']
+    base_config = get_ytdlp_config(download_type, download_options)
     
     # Configurar ruta de salida y hooks de progreso
     base_config.update({
@@ -348,67 +3264,543 @@ def download_videos(download_options, download_id):
     })
 
     # Obtener información de la lista/video primero
+    valid_entries = None
+    # Un video individual consultado antes en /api/video_info ya tiene su información en caché
+    cache_key = metadata_cache_key(url)
+    cached_info = metadata_cache.get(cache_key) if cache_key.startswith('video:') else None
     try:
-        with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True, 'force_generic_extractor': False}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if 'entries' in info:
-                valid_entries = [entry for entry in info.get('entries', []) if entry is not None]
-                download_status[download_id]['playlist_title'] = info.get('title', 'Playlist')
-                download_status[download_id]['total_videos'] = len(valid_entries)
-            else:
-                download_status[download_id]['playlist_title'] = info.get('title', 'Video')
-                download_status[download_id]['total_videos'] = 1
+        extract_start = time.time()
+        # Una sincronización compara con la lista actual, no con la que haya en caché
+        info = (get_flat_info(url, refresh=download_options['type'] == 'sync') if cached_info is None
+                else {'title': cached_info.get('title'), 'entries': None})
+        add_timing(download_id, 'extract', time.time() - extract_start)
+        valid_entries = info['entries']
+        if valid_entries is not None:
+            download_status[download_id]['playlist_title'] = info['title'] or 'Playlist'
+            download_status[download_id]['total_videos'] = len(valid_entries)
+        else:
+            download_status[download_id]['playlist_title'] = info['title'] or 'Video'
+            download_status[download_id]['total_videos'] = 1
     except Exception as e:
         download_status[download_id]['status'] = 'error'
         download_status[download_id]['errors'].append(f'Error al obtener información: {str(e)}')
         return
 
+    # Las listas se reparten video a video entre varios workers
+    if download_options['type'] == 'playlist' and valid_entries:
+        return download_playlist_entries(base_config, valid_entries, download_options, download_id)
+
+    # Sincronización: la misma descarga, comparando la lista con su índice persistente (que
+    # download_videos mantiene bloqueado hasta que ffmpeg termina con la última entrada)
+    if download_options['type'] == 'sync':
+        if not valid_entries:
+            download_status[download_id]['status'] = 'error'
+            download_status[download_id]['current_stage'] = 'Error en la descarga'
+            download_status[download_id]['errors'].append(
+                'La lista no tiene videos.' if valid_entries is not None else
+                'La URL no es una lista: una sincronización necesita una lista o un canal.')
+            return None
+        return download_playlist_entries(base_config, valid_entries, download_options, download_id, sync_index)
+
     # Configurar opciones específicas según el tipo de descarga
-    if download_options['type'] == 'single':
+    if download_options['type'] == 'single' and download_options.get('stream_format'):
+        # Un único archivo sin mezcla para poder servirlo mientras se escribe
+        base_config['format'] = download_options['stream_format']
+        base_config.pop('postprocess_preset', None)
+    elif download_options['type'] == 'single' and download_options.get('video_format_id') == 'none':
+        # Solo audio
+        base_config['format'] = f"{download_options['audio_format_id']}/bestaudio/best"
+        base_config.pop('postprocess_preset', None)
+    elif download_options['type'] == 'single' and download_options.get('audio_format_id') == 'none':
+        # Un formato que ya trae video y audio: no hay nada que mezclar
+        base_config['format'] = f"{download_options['video_format_id']}/best"
+        base_config.pop('postprocess_preset', None)
+    elif download_options['type'] == 'single' and POSTPROCESS_PIPELINE:
+        # Video y audio por separado; la etapa ffmpeg los mezcla después
+        base_config['format'] = f"{download_options['video_format_id']}/bv*,{download_options['audio_format_id']}/ba"
+        base_config['postprocess_preset'] = {'kind': 'merge', 'container': merge_container(download_options)}
+    elif download_options['type'] == 'single':
         # Para video único, usar los formatos seleccionados por el usuario
         base_config['format'] = f"{download_options['video_format_id']}+{download_options['audio_format_id']}/bestvideo+bestaudio/best"
+        # Con una opción recomendada que no recodifica, el Merger solo copia los streams
+        container = merge_container(download_options)
+        if container != 'mp4' or (download_options.get('choice') and not download_options.get('reencode')):
+            base_config['merge_output_format'] = container
+            base_config.pop('postprocessor_args', None)
     
     # Si es una playlist, las opciones ya estarán configuradas por get_ytdlp_config
     
     # Iniciar descarga
+    download_status[download_id]['status'] = 'downloading'
+    video_id = cache_key[len('video:'):] if cache_key.startswith('video:') else None
+
+    def mark_shared():
+        download_status[download_id]['current_stage'] = 'Uniéndose a una descarga en curso del mismo video...'
+
+    future = fetch_video(base_config, url, video_id, download_id, on_wait=mark_shared, slot=bandwidth.slot(download_id),
+                         stream=bool(download_options.get('stream_format')))
+    if future.done():
+        finish_single(download_id, future)
+        return None
+    # La descarga terminó y queda la etapa de ffmpeg, que cierra el trabajo al acabar
+    download_status[download_id]['status'] = 'postprocessing'
+    publish_status(download_id)
+    return chain_future(future, lambda f: finish_single(download_id, f))
+
+# Estado final de un video único a partir del resultado de fetch_video
+def finish_single(download_id, future):
     try:
-        download_status[download_id]['status'] = 'downloading'
-        with yt_dlp.YoutubeDL(base_config) as ydl:
-            ydl.download([url])
-        
-        # Procesar los archivos finales
-        final_files = []
-        for filename in os.listdir(download_dir):
-            # Ignorar archivos temporales y metadatos
-            if filename.endswith(('.part', '.ytdl', '.f', '.json', '.webp', '.jpg')):
-                continue
-            
-            file_path = os.path.join(download_dir, filename)
-            if os.path.isfile(file_path):
-                final_files.append({
-                    'name': filename,
-                    'path': file_path,
-                    'size': os.path.getsize(file_path),
-                    'url': f'/downloads/{download_id}/{filename}'
-                })
-        
-        if final_files:
-            download_status[download_id]['status'] = 'completed'
-            download_status[download_id]['current_progress'] = 100
-            download_status[download_id]['final_files'] = final_files
-            download_status[download_id]['completed_videos'] = len(final_files)
-            download_status[download_id]['current_stage'] = 'Descarga completada'
-        else:
-            # Si no hay archivos finales pero no hubo error, puede ser un problema
-            if not download_status[download_id]['errors']:
-                download_status[download_id]['errors'].append('La descarga finalizó pero no se encontraron archivos. Puede que el formato no sea compatible.')
-            download_status[download_id]['status'] = 'error'
-            download_status[download_id]['current_stage'] = 'Error en la descarga'
-    
+        future.result()
     except Exception as e:
         download_status[download_id]['status'] = 'error'
         download_status[download_id]['current_stage'] = 'Error en la descarga'
         download_status[download_id]['errors'].append(f'Error inesperado durante la descarga: {str(e)}')
+        return
+
+    # Los archivos finales ya están en el índice del trabajo
+    manifest = get_manifest(download_id)
+    final_files = manifest.sorted_files() if manifest else []
+
+    if final_files:
+        download_status[download_id]['status'] = 'completed'
+        download_status[download_id]['current_progress'] = 100
+        download_status[download_id]['final_files'] = final_files
+        download_status[download_id]['completed_videos'] = len(final_files)
+        download_status[download_id]['current_stage'] = 'Descarga completada'
+    else:
+        # Si no hay archivos finales pero no hubo error, puede ser un problema
+        if not download_status[download_id]['errors']:
+            download_status[download_id]['errors'].append('La descarga finalizó pero no se encontraron archivos. Puede que el formato no sea compatible.')
+        download_status[download_id]['status'] = 'error'
+        download_status[download_id]['current_stage'] = 'Error en la descarga'
+
+# Formato que se puede servir mientras se descarga: con audio y video juntos o solo audio
+def streamable_format(info, options):
+    formats = {f.get('format_id'): f for f in info.get('formats', [])}
+    video_id = options.get('video_format_id') or 'none'
+    if video_id == 'none':
+        fmt = formats.get(options.get('audio_format_id'))
+        ok = fmt is not None and fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none'
+    else:
+        fmt = formats.get(video_id)
+        ok = fmt is not None and fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none'
+    if ok and fmt.get('protocol', 'https') in STREAM_PROTOCOLS:
+        return fmt['format_id']
+    return None
+
+# Estado inicial de un trabajo de descarga
+def new_job_status(download_id, priority=1):
+    now = time.time()
+    return {
+        'id': download_id,
+        'status': 'queued',
+        'playlist_title': '',
+        'current_video': None,
+        'total_videos': 0,
+        'completed_videos': 0,
+        'current_progress': 0,
+        'total_bytes': 0,
+        'downloaded_bytes': 0,
+        'speed': 0,
+        'eta': 0,
+        'start_time': now,        # Tiempo de inicio preciso
+        'elapsed': 0,
+        'hook_status': 'pending',
+        'current_stage': 'En cola...',
+        'queued_at': now,
+        'queue_wait': 0,
+        'priority': priority,
+        'timings': {},             # Segundos acumulados por etapa (cola, extracción, descarga, ffmpeg...)
+        'parts_finished': False,   # Todas las partes descargadas (lo mantiene progress_hook)
+        'completed_files': [],     # Archivos completados
+        'final_files': [],         # Archivos finales con URLs
+        'errors': []
+    }
+
+def new_download_id(data):
+    return secure_filename(f"{data.get('type', 'download')}_{os.urandom(4).hex()}")
+
+# Registrar un trabajo y ponerlo en la cola; devuelve False (sin dejar rastro) si la cola está llena
+def enqueue_download(download_id, data, priority):
+    # Inicializar un estado de descarga profesional y completo
+    status = new_job_status(download_id, priority)
+    if data.get('stream_format'):
+        status['stream_path'] = None
+        status['stream_url'] = f'/api/stream/{download_id}'
+
+    if cluster_queue is not None:
+        # Modo distribuido: el trabajo espera en la cola compartida a que lo reclame un nodo libre
+        if not cluster_queue.submit(download_id, status, data, priority, MAX_QUEUED_DOWNLOADS):
+            return False
+        cluster_agent.wake()
+        return True
+
+    download_status[download_id] = status
+    job_options[download_id] = data
+    job_persister.save_now(download_id)
+
+    if not scheduler.submit(download_id, download_videos, (data, download_id), priority):
+        del download_status[download_id]
+        job_options.pop(download_id, None)
+        job_store.delete(download_id)
+        return False
+    return True
+
+# Posición en la cola local o, si el trabajo aún no tiene nodo, en la compartida
+def queue_position(download_id):
+    if download_id in download_status or cluster_queue is None:
+        return scheduler.position(download_id)
+    return cluster_queue.position(download_id)
+
+def is_youtube_url(url):
+    return bool(url) and re.match(r'^(https?\:\/\/)?(www\.youtube\.com|youtu\.?be)\/.*$', url) is not None
+
+# Formatos de un video tal y como los devuelve /api/video_info
+def format_summary(info):
+    return [{
+        'format_id': f.get('format_id'),
+        'ext': f.get('ext'),
+        'resolution': f.get('resolution'),
+        'fps': f.get('fps'),
+        'filesize_approx': f.get('filesize_approx'),
+        'vcodec': f.get('vcodec'),
+        'acodec': f.get('acodec'),
+        'abr': f.get('abr')
+    } for f in info.get('formats', [])]
+
+# Opciones recomendadas de un video (la información de la caché ya las trae calculadas)
+def format_choices(info):
+    choices = info.get('format_choices')
+    return choices if choices is not None else rank_formats(info)
+
+# Opciones de descarga de un trabajo 'single' que corresponden a una opción recomendada
+def choice_options(choice):
+    return {
+        'choice': choice['id'],
+        'video_format_id': choice['video_format_id'],
+        'audio_format_id': choice['audio_format_id'],
+        'container': choice['container'],
+        'reencode': choice['reencode'],
+    }
+
+# Contenedor de la mezcla pedido por el trabajo (mp4 si no indica uno válido)
+def merge_container(options):
+    container = options.get('container')
+    return container if container in MERGE_CONTAINERS else 'mp4'
+
+# Límites de una página según ?offset= y ?limit= (limit=0 devuelve todo)
+def page_bounds(args, total, page_size):
+    try:
+        offset = max(int(args.get('offset', 0)), 0)
+        limit = max(int(args.get('limit', page_size)), 0)
+    except (TypeError, ValueError):
+        offset, limit = 0, page_size
+    end = min(offset + limit, total) if limit else total
+    return offset, end, end if end < total else None
+
+# Lotes en curso y sus extracciones (compartidas por todos los lotes)
+batch_pool = ThreadPoolExecutor(max_workers=max(BATCH_WORKERS, 1), thread_name_prefix='batch')
+batch_extract_pool = ThreadPoolExecutor(max_workers=BATCH_EXTRACT_WORKERS, thread_name_prefix='batch-extract')
+
+# Lote de URLs: expande las listas, elimina videos repetidos, extrae la información de cada video
+# una sola vez y, si se pidió descarga, crea un trabajo 'single' por video dosificando la cola.
+# Su estado se guarda en el almacén de trabajos al cambiar de fase y cuando terminan sus trabajos,
+# así que cualquier worker del nodo lo consulta y, si su proceso cae, otro lo retoma
+class Batch:
+    FINISHED_ITEM_STATES = FINISHED_JOB_STATES + ('extracted',)
+    FIELDS = ('id', 'options', 'kind', 'status', 'created_at', 'finished_at', 'duplicates', 'inputs', 'items')
+
+    def __init__(self, batch_id, urls, options):
+        self.id = batch_id
+        self.options = options
+        self.kind = 'download' if options.get('type') == 'download' else 'info'
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.finished_at = None
+        self.duplicates = 0
+        self.inputs = [{'url': url, 'kind': None, 'videos': 0, 'error': None} for url in urls]
+        self.items = []
+        self.wakeup = threading.Event()
+
+    @classmethod
+    def restore(cls, data):
+        batch = cls(data['id'], [inp['url'] for inp in data['inputs']], data['options'])
+        # Un lote que no terminó de expandirse vuelve a empezar desde sus URLs
+        if data['status'] not in ('queued', 'expanding'):
+            for field in cls.FIELDS:
+                setattr(batch, field, data[field])
+        return batch
+
+    def save(self):
+        try:
+            job_store.save_batch(self.id, self.status, {field: getattr(self, field) for field in self.FIELDS})
+        except (sqlite3.Error, TypeError, ValueError):
+            app.logger.exception('No se pudo persistir el lote %s', self.id)
+
+    def run(self):
+        try:
+            if self.status == 'queued':
+                self.status = 'expanding'
+                self._expand()
+                self.status = 'extracting'
+                self.save()
+            list(batch_extract_pool.map(self._extract, [item for item in self.items if item['status'] in ('pending', 'extracting')]))
+            if self.kind == 'download':
+                self.status = 'downloading'
+                self.save()
+                self._download()
+        except Exception as e:
+            app.logger.exception('Error no controlado en el lote %s', self.id)
+            for item in self.items:
+                if item['status'] not in self.FINISHED_ITEM_STATES:
+                    item['status'] = 'error'
+                    item['error'] = item['error'] or str(e)
+        succeeded = sum(1 for item in self.items if item['status'] in ('completed', 'extracted'))
+        if self.items and succeeded == len(self.items) and not any(inp['error'] for inp in self.inputs):
+            self.status = 'completed'
+        elif succeeded:
+            self.status = 'partial'
+        else:
+            self.status = 'error'
+        self.finished_at = time.time()
+        self.save()
+
+    def _expand(self):
+        # Las listas se aplanan en paralelo; los videos sueltos ya tienen su ID en la URL
+        flats = {}
+        for index, inp in enumerate(self.inputs):
+            if not is_youtube_url(inp['url']):
+                inp['error'] = 'URL de YouTube inválida'
+            elif not metadata_cache_key(inp['url']).startswith('video:'):
+                flats[index] = batch_extract_pool.submit(get_flat_info, inp['url'])
+
+        seen = set()
+        for index, inp in enumerate(self.inputs):
+            if inp['error']:
+                continue
+            if index in flats:
+                try:
+                    flat = flats[index].result()
+                except Exception as e:
+                    inp['error'] = str(e)
+                    continue
+                if flat['entries'] is None:
+                    videos = [(flat.get('id') or inp['url'], inp['url'], flat.get('title'))]
+                else:
+                    videos = [(entry.get('id') or entry_url(entry), entry_url(entry), entry.get('title'))
+                              for entry in flat['entries']]
+                inp['kind'] = 'video' if flat['entries'] is None else 'playlist'
+            else:
+                videos = [(metadata_cache_key(inp['url'])[len('video:'):], inp['url'], None)]
+                inp['kind'] = 'video'
+            inp['videos'] = len(videos)
+            for video_id, url, title in videos:
+                if video_id in seen:
+                    self.duplicates += 1
+                    continue
+                seen.add(video_id)
+                self.items.append({'id': video_id, 'url': url, 'title': title, 'status': 'pending',
+                                   'download_id': None, 'error': None})
+
+    def _extract(self, item):
+        item['status'] = 'extracting'
+        try:
+            info = get_cached_video_info(item['url'])
+        except Exception as e:
+            item['status'] = 'error'
+            item['error'] = str(e)
+            return
+        item['title'] = info.get('title') or item['title']
+        item['duration'] = info.get('duration')
+        if self.kind == 'info':
+            item['choices'] = format_choices(info)
+            if self.options.get('all_formats'):
+                item['formats'] = format_summary(info)
+        elif self.options.get('choice'):
+            choice = resolve_choice(format_choices(info), self.options['choice'])
+            if choice is None:
+                item['status'] = 'error'
+                item['error'] = f"La opción de formato {self.options['choice']} no está disponible"
+                return
+            item['selection'] = choice_options(choice)
+        item['status'] = 'extracted'
+
+    def _download(self):
+        # La información ya está en la caché: cada trabajo la reutiliza sin volver a extraer.
+        # Al retomar un lote, los elementos con trabajo siguen su curso y el resto se encola
+        pending = [item for item in self.items if item['status'] in ('extracted', 'waiting') and not item['download_id']]
+        active = [item for item in self.items if item['download_id'] and item['status'] not in FINISHED_JOB_STATES]
+        for item in pending:
+            item['status'] = 'waiting'
+        for item in active:
+            batch_waiters[item['download_id']] = self.wakeup
+        try:
+            priority = min(max(int(self.options.get('priority', 1)), 0), 9)
+        except (TypeError, ValueError):
+            priority = 1
+        try:
+            while pending or active:
+                self.wakeup.clear()
+                changed = False
+                for item in active:
+                    status = find_job(item['download_id'])
+                    state = status['status'] if status else 'error'
+                    if state in FINISHED_JOB_STATES:
+                        item['status'] = state
+                        batch_waiters.pop(item['download_id'], None)
+                        changed = True
+                active = [item for item in active if item['status'] not in FINISHED_JOB_STATES]
+                # No ocupar más de BATCH_MAX_PENDING_JOBS huecos de la cola para no dejar fuera a nadie
+                while pending and len(active) < BATCH_MAX_PENDING_JOBS:
+                    item = pending[0]
+                    data = {
+                        'url': item['url'],
+                        'type': 'single',
+                        'video_format_id': self.options.get('video_format_id', 'bestvideo'),
+                        'audio_format_id': self.options.get('audio_format_id', 'bestaudio'),
+                        'batch_id': self.id,
+                    }
+                    data.update(item.get('selection') or {})
+                    download_id = new_download_id(data)
+                    batch_waiters[download_id] = self.wakeup
+                    if not enqueue_download(download_id, data, priority):
+                        batch_waiters.pop(download_id, None)
+                        break   # Cola llena: se reintenta cuando termine otro trabajo o en la siguiente vuelta
+                    pending.pop(0)
+                    item['download_id'] = download_id
+                    item['status'] = 'queued'
+                    active.append(item)
+                    changed = True
+                if changed:
+                    self.save()
+                if pending or active:
+                    # publish_status despierta al lote cuando termina uno de sus trabajos; la espera
+                    # máxima cubre los que terminan en otro worker o nodo y la cola llena
+                    self.wakeup.wait(BATCH_POLL)
+        finally:
+            for item in active:
+                batch_waiters.pop(item['download_id'], None)
+
+    def view(self, args):
+        # El lote solo guarda cuándo termina cada trabajo: el estado de los que siguen activos se consulta al vuelo
+        live = {}
+        for item in self.items:
+            if item['download_id'] and item['status'] not in FINISHED_JOB_STATES:
+                status = find_job(item['download_id'])
+                if status:
+                    live[item['download_id']] = status['status']
+        counts = {}
+        for item in self.items:
+            state = live.get(item['download_id'], item['status'])
+            counts[state] = counts.get(state, 0) + 1
+        offset, end, next_offset = page_bounds(args, len(self.items), FILES_PAGE_SIZE)
+        items = []
+        for item in self.items[offset:end]:
+            item = dict(item)
+            if item['download_id']:
+                item['status_url'] = f"/api/status/{item['download_id']}"
+                item['status'] = live.get(item['download_id'], item['status'])
+            items.append(item)
+        return {
+            'batch_id': self.id,
+            'type': self.kind,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'inputs': self.inputs,
+            'duplicates': self.duplicates,
+            'counts': counts,
+            'total_items': len(self.items),
+            'offset': offset,
+            'next_offset': next_offset,
+            'items': items,
+        }
+
+# Lotes que ejecuta este proceso; los de otros workers se leen del almacén de trabajos
+batches = {}
+batches_lock = threading.Lock()
+
+def register_batch(batch):
+    now = time.time()
+    with batches_lock:
+        for batch_id in [key for key, old in batches.items() if old.finished_at and now - old.finished_at > BATCH_TTL]:
+            del batches[batch_id]
+        batches[batch.id] = batch
+    try:
+        job_store.purge_batches(now - BATCH_TTL)
+    except sqlite3.Error:
+        app.logger.exception('No se pudieron borrar los lotes caducados')
+
+def find_batch(batch_id):
+    batch = batches.get(batch_id)
+    if batch is None:
+        data = job_store.load_batch(batch_id)
+        batch = Batch.restore(data) if data else None
+    return batch
+
+# Latencia de cada respuesta HTTP para /metrics
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        METRIC_HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'desconocido')
+    return response
+
+# Uso de disco de DOWNLOAD_FOLDER para /metrics, recalculado como mucho cada DISK_USAGE_CACHE_TTL segundos
+disk_usage_cache = {'value': 0, 'at': 0.0}
+
+def cached_disk_usage():
+    now = time.time()
+    if now - disk_usage_cache['at'] > DISK_USAGE_CACHE_TTL:
+        disk_usage_cache['value'] = RetentionManager.disk_usage()
+        disk_usage_cache['at'] = now
+    return disk_usage_cache['value']
+
+metrics.register(Gauge('ytdl_active_jobs', 'Trabajos ejecutándose en este proceso', function=lambda: scheduler.stats()['active']))
+metrics.register(Gauge('ytdl_queued_jobs', 'Trabajos esperando un worker', function=lambda: scheduler.stats()['queued']))
+metrics.register(Gauge('ytdl_fragment_connections', 'Conexiones de fragmentos concedidas a las descargas en curso', function=lambda: fragment_tuner.budget.used))
+metrics.register(Gauge('ytdl_ytdlp_pool_idle', 'Instancias de YoutubeDL libres en el pool', function=lambda: ytdl_pool.stats()['idle']))
+metrics.register(Gauge('ytdl_download_folder_bytes', 'Bytes ocupados en DOWNLOAD_FOLDER', function=cached_disk_usage))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Comprobación de vida barata: no importa yt-dlp ni recorre el disco
+@app.route('/health', methods=['GET'])
+def health_api():
+    return jsonify({
+        'status': 'ok',
+        'ytdlp_loaded': yt_dlp.is_loaded(),
+        'ytdlp_pool': ytdl_pool.stats(),
+        'jobs': scheduler.stats(),
+        'node': NODE_ID if cluster_queue is not None else None,
+    })
+
+# Nodos del clúster con su capacidad y último latido, y trabajos esperando en la cola compartida
+@app.route('/api/cluster', methods=['GET'])
+def cluster_api():
+    if cluster_queue is None:
+        return jsonify({'error': 'Este nodo no está en modo distribuido (CLUSTER_DB_PATH)'}), 404
+    return jsonify({'node': NODE_ID, **cluster_queue.stats()})
+
+# Trabajo que tiene otro nodo del clúster: redirigir la petición al nodo con sus archivos
+def remote_job_response(download_id):
+    if cluster_queue is None or download_id in download_status:
+        return None
+    location = cluster_queue.locate(download_id)
+    if location is None or location['node'] == NODE_ID:
+        return None
+    if not location['alive'] or not location['url']:
+        return jsonify({'error': f"El nodo {location['node']} que tiene este trabajo no responde"}), 503
+    target = location['url'] + request.path
+    if request.query_string:
+        target += '?' + request.query_string.decode()
+    return redirect(target, code=307)
 
 # Rutas de la aplicación
 @app.route('/')
@@ -419,30 +3811,20 @@ def index():
 def get_video_info():
     data = request.json
     url = data.get('url', '')
-    if not url or not re.match(r'^(https?\:\/\/)?(www\.youtube\.com|youtu\.?be)\/.*$', url):
+    if not is_youtube_url(url):
         return jsonify({
             'error': 'URL de YouTube inválida.',
             'source': 'backend_validation',
             'details': 'La URL proporcionada no parece ser un enlace de YouTube válido.'
         }), 400
 
-    ydl_opts = {'quiet': True, 'no_warnings': True}
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = []
-            for f in info.get('formats', []):
-                formats.append({
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'resolution': f.get('resolution'),
-                    'fps': f.get('fps'),
-                    'filesize_approx': f.get('filesize_approx'),
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                    'abr': f.get('abr')
-                })
-            return jsonify({'title': info.get('title'), 'formats': formats})
+        info = extract_pool.run(get_cached_video_info, url)
+        response = {'title': info.get('title'), 'duration': info.get('duration'), 'choices': format_choices(info)}
+        # La lista completa de formatos solo si se pide
+        if data.get('all_formats'):
+            response['formats'] = format_summary(info)
+        return jsonify(response)
     except yt_dlp.utils.DownloadError as e:
         error_message = str(e)
         user_friendly_message = "No se pudo obtener la información del video desde YouTube. "
@@ -472,47 +3854,96 @@ def start_download():
     data = request.json
     url = data.get('url', '')
 
-    if not url or not re.match(r'^(https?\:\/\/)?(www\.youtube\.com|youtu\.?be)\/.*$', url):
+    if not is_youtube_url(url):
         return jsonify({'error': 'URL de YouTube inválida'}), 400
+    if data.get('type') == 'sync' and metadata_cache_key(url).startswith('video:'):
+        return jsonify({'error': 'Una sincronización necesita la URL de una lista o de un canal, no de un video.'}), 400
 
-    download_id = secure_filename(f"{data.get('type', 'download')}_{os.urandom(4).hex()}")
+    download_id = new_download_id(data)
 
-    # Inicializar un estado de descarga profesional y completo
-    download_status[download_id] = {
-        'id': download_id,
-        'status': 'starting',
-        'playlist_title': '',
-        'current_video': None,
-        'total_videos': 0,
-        'completed_videos': 0,
-        'current_progress': 0,
-        'total_bytes': 0,
-        'downloaded_bytes': 0,
-        'speed': 0,
-        'speed_history': [],       # Para suavizar las fluctuaciones
-        'eta': 0,
-        'start_time': time.time(), # Tiempo de inicio preciso
-        'elapsed': 0,
-        'hook_status': 'pending',
-        'current_stage': 'Iniciando...',
-        'parts': {},               # Para seguimiento detallado de partes
-        'completed_files': [],     # Archivos completados
-        'final_files': [],         # Archivos finales con URLs
-        'errors': []
-    }
+    # Los videos individuales tienen prioridad sobre las listas; el cliente puede indicar otra (0-9)
+    try:
+        priority = min(max(int(data.get('priority', 0 if data.get('type') == 'single' else 1)), 0), 9)
+    except (TypeError, ValueError):
+        priority = 1
 
-    thread = threading.Thread(target=download_videos, args=(data, download_id))
-    thread.daemon = True
-    thread.start()
+    # Opción recomendada de /api/video_info: el servidor la traduce a formatos y contenedor
+    if data.get('choice') and data.get('type') == 'single':
+        try:
+            choice = resolve_choice(format_choices(extract_pool.run(get_cached_video_info, url)), data['choice'])
+        except Exception as e:
+            return jsonify({'error': f'No se pudo obtener la información del video: {e}'}), 500
+        if choice is None:
+            return jsonify({'error': 'La opción de formato elegida no está disponible para este video.'}), 400
+        data.update(choice_options(choice))
 
-    return jsonify({'download_id': download_id})
+    # Reproducción mientras se descarga: solo formatos que yt-dlp escribe en un único archivo
+    stream_error = None
+    if data.get('stream') and data.get('type') == 'single':
+        try:
+            data['stream_format'] = streamable_format(extract_pool.run(get_cached_video_info, url), data)
+        except Exception as e:
+            data['stream_format'] = None
+            app.logger.warning('No se pudo comprobar el formato para streaming de %s: %s', url, e)
+        if not data['stream_format']:
+            stream_error = 'El formato elegido necesita mezclar video y audio; se podrá descargar al terminar.'
 
-@app.route('/api/status/<download_id>', methods=['GET'])
-def download_status_api(download_id):
-    if download_id not in download_status:
-        return jsonify({'error': 'ID de descarga no encontrado'})
+    if not enqueue_download(download_id, data, priority):
+        response = jsonify({'error': 'La cola de descargas está llena. Inténtalo de nuevo en unos minutos.'})
+        response.headers['Retry-After'] = '30'
+        return response, 429
+
+    response = {'download_id': download_id, 'status': 'queued', 'queue_position': queue_position(download_id)}
+    if data.get('stream'):
+        response['stream_url'] = f'/api/stream/{download_id}' if data.get('stream_format') else None
+        if stream_error:
+            response['stream_error'] = stream_error
+    return jsonify(response)
+
+@app.route('/api/batch', methods=['POST'])
+def start_batch():
+    data = request.json or {}
+    urls = data.get('urls')
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'Se necesita una lista de URLs en "urls"'}), 400
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({'error': f'Como máximo {BATCH_MAX_URLS} URLs por lote'}), 400
+
+    batch = Batch(secure_filename(f'batch_{os.urandom(4).hex()}'), [str(url).strip() for url in urls], data)
+    register_batch(batch)
+    batch.save()
+    batch_pool.submit(batch.run)
+    return jsonify({'batch_id': batch.id, 'type': batch.kind, 'status': batch.status, 'total_urls': len(urls)})
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def batch_status_api(batch_id):
+    batch = find_batch(batch_id)
+    if batch is None:
+        return jsonify({'error': 'ID de lote no encontrado'}), 404
+    return jsonify(batch.view(request.args))
+
+# Página de la lista de archivos según ?offset= y ?limit= (limit=0 devuelve todos)
+def paginate_files(files, args):
+    offset, end, next_offset = page_bounds(args, len(files), FILES_PAGE_SIZE)
+    page = [{'name': f['name'], 'size': f['size'], 'url': f['url']} for f in files[offset:end]]
+    return page, {
+        'total_files': len(files),
+        'offset': offset,
+        'next_offset': next_offset,
+    }
+
+# Vista pública del estado de un trabajo (compartida por /api/status y /api/events)
+def build_status_view(download_id, status, include_entries=False, file_args=None):
+    status_data = status.copy()
     
-    status_data = download_status[download_id].copy()
+    # Información de la cola para trabajos que aún esperan un worker
+    queue_stats = scheduler.stats()
+    status_data['queue_depth'] = queue_stats['queued'] + (cluster_queue.queued() if cluster_queue is not None else 0)
+    if status_data.get('status') == 'queued' and (download_id in download_status or cluster_queue is not None):
+        status_data['queue_position'] = queue_position(download_id)
+        status_data['queue_wait'] = time.time() - status_data.get('queued_at', time.time())
+        if status_data['queue_position']:
+            status_data['current_stage'] = f"En cola (posición {status_data['queue_position']})..."
     
     # Comprobar si estamos en fase de post-procesamiento
     is_postprocessing = False
@@ -520,9 +3951,9 @@ def download_status_api(download_id):
         is_postprocessing = True
         
     # Si hemos terminado de descargar todas las partes pero todavía estamos en postprocesamiento
-    all_parts_finished = all(p.get('status') == 'finished' for p in status_data.get('parts', {}).values()) if status_data.get('parts') else False
+    all_parts_finished = status_data.get('parts_finished', False)
     
-    if all_parts_finished and is_postprocessing:
+    if all_parts_finished and is_postprocessing and status_data.get('status') not in FINISHED_JOB_STATES:
         # Actualizar la etapa para mostrar el post-procesamiento
         if not status_data.get('current_stage') or 'Descargando' in status_data.get('current_stage', ''):
             if status_data.get('merging', False):
@@ -535,69 +3966,211 @@ def download_status_api(download_id):
         # Mantener el progreso en 99% durante post-procesamiento
         status_data['current_progress'] = 99
     
-    # Preparar archivos para la respuesta
-    if 'final_files' in status_data:
-        status_data['files'] = [
-            {
-                'name': os.path.basename(f['path']),
-                'size': f['size'],
-                'url': f['url']
-            } for f in status_data['final_files']
-        ]
+    # Resumen por estado de los videos de la lista; el detalle completo solo con ?entries=1
+    if status_data.get('entries'):
+        summary = {}
+        for entry in status_data['entries']:
+            summary[entry['status']] = summary.get(entry['status'], 0) + 1
+        status_data['entries_summary'] = summary
+        if include_entries:
+            status_data['entries'] = [entry.copy() for entry in status_data['entries']]
+        else:
+            del status_data['entries']
+    
+    # Archivos listos hasta ahora, servidos desde el índice del trabajo
+    files = job_files(download_id, status)
+    if files or 'final_files' in status_data:
+        status_data['files'], page = paginate_files(files, file_args or {})
+        status_data['files_total'] = page['total_files']
+        status_data['files_next_offset'] = page['next_offset']
     
     # Eliminar información interna que no queremos exponer en la API
-    keys_to_remove = ['final_files', 'parts', 'speed_history', 'completed_files', 'hook_status']
+    keys_to_remove = ['final_files', 'parts_finished', 'completed_files', 'hook_status', 'stream_path']
     for key in keys_to_remove:
         if key in status_data:
             del status_data[key]
     
-    return jsonify(status_data)
+    return status_data
 
-@app.route('/downloads/<download_id>/<path:filename>', methods=['GET'])
-def download_file(download_id, filename):
-    # Validar que el ID de descarga existe
-    if download_id not in download_status:
-        return jsonify({'error': 'ID de descarga no encontrado'}), 404
+@app.route('/api/status/<download_id>', methods=['GET'])
+def download_status_api(download_id):
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    status = find_job(download_id)
+    if status is None:
+        return jsonify({'error': 'ID de descarga no encontrado'})
     
-    # Usar el secure_filename para evitar ataques de path traversal
-    safe_filename = secure_filename(os.path.basename(filename))
-    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+    return jsonify(build_status_view(download_id, status, include_entries=request.args.get('entries') == '1',
+                                     file_args=request.args))
+
+@app.route('/api/events/<download_id>', methods=['GET'])
+def download_events_api(download_id):
+    # Flujo SSE con los cambios del estado; /api/status sigue disponible como alternativa
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    def generate():
+        if find_job(download_id) is None:
+            yield f"data: {json.dumps({'error': 'ID de descarga no encontrado'})}\n\n"
+            return
+        last_view = {}
+        version = -1
+        min_interval = 1.0 / SSE_MAX_RATE if SSE_MAX_RATE > 0 else 0
+        while True:
+            if download_id in download_status:
+                version = wait_for_status_change(download_id, version, SSE_KEEPALIVE)
+            elif version >= 0:
+                # Trabajo de otro worker: consultar el almacén persistente periódicamente
+                time.sleep(max(min_interval, JOB_STORE_FLUSH_INTERVAL))
+            version = max(version, 0)
+            status = find_job(download_id)
+            if status is None:
+                yield f"data: {json.dumps({'error': 'ID de descarga no encontrado'})}\n\n"
+                return
+            view = build_status_view(download_id, status)
+            delta = {key: value for key, value in view.items() if last_view.get(key) != value}
+            # Los campos que desaparecen del estado se envían aparte para que el cliente los borre
+            removed = [key for key in last_view if key not in view]
+            if removed:
+                delta['removed'] = removed
+            if delta:
+                yield f"data: {json.dumps(delta)}\n\n"
+                last_view = view
+            else:
+                yield ': keep-alive\n\n'
+            if view.get('status') in FINISHED_JOB_STATES:
+                yield 'event: end\ndata: {}\n\n'
+                return
+            # Limitar la frecuencia de eventos por trabajo
+            time.sleep(min_interval)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Evitar que nginx acumule el flujo
+    })
+
+# Esperar un cambio en el estado de un trabajo, local o de otro worker
+def wait_for_job(download_id, version, timeout):
+    if download_id in download_status:
+        version = wait_for_status_change(download_id, version, timeout)
+    else:
+        time.sleep(min(timeout, JOB_STORE_FLUSH_INTERVAL))
+    return version, find_job(download_id)
+
+@app.route('/api/stream/<download_id>', methods=['GET'])
+def stream_download(download_id):
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    status = find_job(download_id)
+    if status is None or 'stream_path' not in status:
+        return jsonify({'error': 'Este trabajo no admite reproducción durante la descarga'}), 404
     
-    # Verificar que el directorio existe
-    if not os.path.exists(download_dir):
-        return jsonify({'error': 'Directorio de descarga no encontrado'}), 404
+    # Esperar a que yt-dlp cree el archivo parcial (o a que el trabajo termine)
+    version = -1
+    deadline = time.time() + STREAM_START_TIMEOUT
+    source = None
+    while status is not None and status['status'] not in FINISHED_JOB_STATES and time.time() < deadline:
+        path = status.get('stream_path')
+        # Si el .part ya se renombró, el archivo definitivo tiene el mismo contenido
+        for candidate in (path, path[:-len('.part')] if path and path.endswith('.part') else None):
+            with contextlib.suppress(OSError, TypeError):
+                source = open(candidate, 'rb')
+                break
+        if source is not None:
+            break
+        version, status = wait_for_job(download_id, version, 1.0)
+        # Mientras esperaba en la cola compartida, otro nodo pudo reclamarlo
+        remote = remote_job_response(download_id)
+        if remote is not None:
+            return remote
     
-    # Intenta primero con el nombre exacto y luego con el nombre seguro
-    try:
-        return send_from_directory(download_dir, filename, as_attachment=True)
-    except:
-        try:
-            return send_from_directory(download_dir, safe_filename, as_attachment=True)
-        except:
-            return jsonify({'error': 'Archivo no encontrado'}), 404
-
-@app.route('/api/downloads/<download_id>', methods=['GET'])
-def list_downloads(download_id):
-    if download_id not in download_status:
-        return jsonify({'error': 'ID de descarga no encontrado'}), 404
+    if source is None:
+        # El archivo ya estaba en el almacén o la descarga terminó antes de empezar a seguirla
+        if status is not None and status['status'] == 'completed' and status.get('final_files'):
+            file_path = resolve_job_file(download_id, status['final_files'][0]['name'])
+            if file_path:
+                return send_job_file(download_id, file_path)
+        if status is None or status['status'] in FINISHED_JOB_STATES:
+            return jsonify({'error': 'La descarga falló antes de poder reproducirse'}), 502
+        return jsonify({'error': 'La descarga aún no ha empezado'}), 504
     
-    status = download_status[download_id]
-    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+    now = time.time()
+    if download_id in download_status:
+        download_status[download_id]['last_access'] = now
+    job_store.touch(download_id, now)
     
-    if not os.path.exists(download_dir):
-        return jsonify({'error': 'Directorio de descarga no encontrado'}), 404
+    def generate(version):
+        # El descriptor sigue siendo válido aunque yt-dlp renombre el .part al terminar
+        with source:
+            while True:
+                chunk = source.read(ARCHIVE_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                status = find_job(download_id)
+                if status is None or status['status'] == 'error':
+                    return
+                if status['status'] in FINISHED_JOB_STATES or (status.get('parts_finished') and status.get('hook_status') == 'finished'):
+                    # Vaciar lo que quede escrito y terminar
+                    yield from iter(lambda: source.read(ARCHIVE_CHUNK_SIZE), b'')
+                    return
+                version, _ = wait_for_job(download_id, version, 0.5)
     
-    # Si hay archivos finales ya registrados, usarlos
+    name = os.path.basename(source.name)
+    if name.endswith('.part'):
+        name = name[:-len('.part')]
+    return Response(generate(version), mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream', headers={
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+        'Content-Disposition': f"inline; filename*=UTF-8''{quote(name)}",
+    })
+
+# Resolver un archivo dentro del directorio de un trabajo sin permitir salir de él
+def resolve_job_file(download_id, filename):
+    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+    # Intenta primero con el nombre exacto y luego con el nombre seguro
+    for candidate in (filename, secure_filename(os.path.basename(filename))):
+        # Los archivos ocultos (como el índice del trabajo) no se sirven
+        if not candidate or os.path.basename(candidate).startswith('.'):
+            continue
+        file_path = safe_join(download_dir, candidate)
+        if file_path and os.path.isfile(file_path):
+            return file_path
+    return None
+
+# Respuesta para un archivo terminado según FILE_SERVING_MODE
+def send_job_file(download_id, file_path):
+    name = os.path.basename(file_path)
+    if FILE_SERVING_MODE == 'x-accel':
+        # nginx entrega el cuerpo sin copia y resuelve Range, If-Range y ETag
+        response = Response(status=200)
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(f'{download_id}/{name}')
+        response.headers['Content-Type'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(name)}"
+        return response
+    # send_file responde a Range/If-Range/If-None-Match (206/304) y usa wsgi.file_wrapper,
+    # que gunicorn sirve con os.sendfile; en modo x-sendfile delega en el servidor web
+    return send_file(file_path, as_attachment=True, download_name=name, conditional=True, etag=True, max_age=0)
+
+# Archivos finales de un trabajo: los del estado al terminar o, mientras descarga, los del índice
+def job_files(download_id, status):
     if status.get('final_files'):
-        return jsonify({
-            'files': status['final_files'],
-            'status': status['status']
-        })
+        return status['final_files']
+    manifest = get_manifest(download_id)
+    if manifest is not None:
+        return manifest.sorted_files()
+    if status.get('status') not in FINISHED_JOB_STATES:
+        return []
     
-    # De lo contrario, escanear el directorio
+    # Trabajos anteriores al índice: escanear el directorio una vez
+    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
     files = []
-    for filename in os.listdir(download_dir):
-        if filename.endswith(('.part', '.ytdl', '.f', '.json', '.webp', '.jpg')):
+    if not os.path.isdir(download_dir):
+        return files
+    for filename in sorted(os.listdir(download_dir)):
+        if filename.startswith('.') or filename.endswith(('.part', '.ytdl', '.f', '.json', '.webp', '.jpg')):
             continue
         
         file_path = os.path.join(download_dir, filename)
@@ -607,15 +4180,298 @@ def list_downloads(download_id):
                 'size': os.path.getsize(file_path),
                 'url': f'/downloads/{download_id}/{filename}'
             })
+    return files
+
+# Archivos empaquetados en streaming (sin archivo temporal ni compresión)
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+
+class ArchiveStream:
+    """Genera un ZIP o TAR sin comprimir a partir de (ruta, nombre, tamaño, mtime).
+    
+    El tamaño total se conoce antes de leer ningún byte, así que la respuesta
+    lleva Content-Length y el cliente puede mostrar una barra de progreso.
+    """
+    
+    def __init__(self, members, fmt):
+        self.members = members
+        self.fmt = fmt
+    
+    def __len__(self):
+        if self.fmt == 'tar':
+            return sum(len(self._tar_header(m)) + m[2] + self._tar_padding(m[2]) for m in self.members) + 2 * tarfile.BLOCKSIZE
+        # El CRC no cambia la longitud del directorio central
+        entries = [(member, 0, offset) for member, offset in self._zip_offsets()]
+        end = sum(self._zip_entry_length(member) for member in self.members)
+        return end + len(self._zip_directory(entries, end))
+    
+    def __iter__(self):
+        return self._iter_tar() if self.fmt == 'tar' else self._iter_zip()
+    
+    # Leer exactamente el tamaño anunciado; si el archivo cambió, cortar la respuesta
+    @staticmethod
+    def _read(path, size):
+        remaining = size
+        with open(path, 'rb') as f:
+            while remaining:
+                chunk = f.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f'{path} cambió durante el empaquetado')
+                remaining -= len(chunk)
+                yield chunk
+    
+    # --- TAR (formato PAX: nombres UTF-8 y tamaños sin límite) ---
+    
+    @staticmethod
+    def _tar_header(member):
+        path, name, size, mtime = member
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+    
+    @staticmethod
+    def _tar_padding(size):
+        return -size % tarfile.BLOCKSIZE
+    
+    def _iter_tar(self):
+        for member in self.members:
+            yield self._tar_header(member)
+            yield from self._read(member[0], member[2])
+            padding = self._tar_padding(member[2])
+            if padding:
+                yield b'\0' * padding
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+    
+    # --- ZIP (método store, CRC en descriptores de datos, zip64 si hace falta) ---
+    
+    @staticmethod
+    def _dos_time(mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    
+    def _zip_local_header(self, name, mtime, zip64):
+        dos_time, dos_date = self._dos_time(mtime)
+        name = name.encode('utf-8')
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        sizes = 0xFFFFFFFF if zip64 else 0
+        # Bit 3: CRC y tamaños en el descriptor; bit 11: nombre en UTF-8
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x0808, 0,
+                           dos_time, dos_date, 0, sizes, sizes, len(name), len(extra)) + name + extra
+    
+    # Cabecera local + datos + descriptor (16 bytes, o 24 con tamaños zip64)
+    def _zip_entry_length(self, member):
+        zip64 = member[2] >= ZIP64_LIMIT
+        return len(self._zip_local_header(member[1], member[3], zip64)) + member[2] + (24 if zip64 else 16)
+    
+    def _zip_offsets(self):
+        offset = 0
+        for member in self.members:
+            yield member, offset
+            offset += self._zip_entry_length(member)
+    
+    # Directorio central y fin de archivo; end es el desplazamiento donde empieza el directorio
+    def _zip_directory(self, entries, end):
+        directory = b''
+        for (path, name, size, mtime), crc, offset in entries:
+            dos_time, dos_date = self._dos_time(mtime)
+            encoded = name.encode('utf-8')
+            extra_fields = []
+            if size >= ZIP64_LIMIT:
+                extra_fields += [size, size]
+            if offset >= ZIP64_LIMIT:
+                extra_fields.append(offset)
+            extra = struct.pack(f'<HH{len(extra_fields)}Q', 1, 8 * len(extra_fields), *extra_fields) if extra_fields else b''
+            directory += struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45 if extra else 20, 0x0808, 0,
+                                     dos_time, dos_date, crc,
+                                     min(size, 0xFFFFFFFF), min(size, 0xFFFFFFFF),
+                                     len(encoded), len(extra), 0, 0, 0, 0o100644 << 16,
+                                     min(offset, 0xFFFFFFFF)) + encoded + extra
+        count = len(entries)
+        trailer = b''
+        if count >= 0xFFFF or len(directory) >= ZIP64_LIMIT or end >= ZIP64_LIMIT:
+            zip64_end = end + len(directory)
+            trailer += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(directory), end)
+            trailer += struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1)
+        trailer += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                               min(len(directory), 0xFFFFFFFF), min(end, 0xFFFFFFFF), 0)
+        return directory + trailer
+    
+    def _iter_zip(self):
+        entries = []
+        end = 0
+        for member, offset in self._zip_offsets():
+            path, name, size, mtime = member
+            zip64 = size >= ZIP64_LIMIT
+            yield self._zip_local_header(name, mtime, zip64)
+            crc = 0
+            for chunk in self._read(path, size):
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            if zip64:
+                yield struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+            else:
+                yield struct.pack('<IIII', 0x08074b50, crc, size, size)
+            entries.append((member, crc, offset))
+            end = offset + self._zip_entry_length(member)
+        yield self._zip_directory(entries, end)
+
+@app.route('/downloads/<download_id>.<any(zip, tar):fmt>', methods=['GET', 'HEAD'])
+def download_archive(download_id, fmt):
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    status = find_job(download_id)
+    if status is None:
+        return jsonify({'error': 'ID de descarga no encontrado'}), 404
+    if status.get('status') not in FINISHED_JOB_STATES:
+        return jsonify({'error': 'La descarga aún no ha terminado'}), 409
+    if not os.path.exists(os.path.join(DOWNLOAD_FOLDER, download_id)):
+        return jsonify({'error': 'Directorio de descarga no encontrado'}), 404
+    
+    # Fijar nombres y tamaños antes de empezar para poder anunciar Content-Length
+    members = []
+    seen = set()
+    for file in job_files(download_id, status):
+        file_path = resolve_job_file(download_id, file['name'])
+        if file_path is None or file['name'] in seen:
+            continue
+        seen.add(file['name'])
+        st = os.stat(file_path)
+        members.append((file_path, file['name'], st.st_size, st.st_mtime))
+    if not members:
+        return jsonify({'error': 'No hay archivos para empaquetar'}), 404
+    
+    # Registrar el acceso para que la retención no borre el trabajo mientras se envía
+    now = time.time()
+    if download_id in download_status:
+        download_status[download_id]['last_access'] = now
+    job_store.touch(download_id, now)
+    
+    archive = ArchiveStream(members, fmt)
+    response = Response(iter(archive), mimetype='application/zip' if fmt == 'zip' else 'application/x-tar',
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = str(len(archive))
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_id}.{fmt}"'
+    return response
+
+@app.route('/downloads/<download_id>/<path:filename>', methods=['GET', 'HEAD'])
+def download_file(download_id, filename):
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    # Validar que el ID de descarga existe
+    if find_job(download_id) is None:
+        return jsonify({'error': 'ID de descarga no encontrado'}), 404
+    
+    # Verificar que el directorio existe
+    if not os.path.exists(os.path.join(DOWNLOAD_FOLDER, download_id)):
+        return jsonify({'error': 'Directorio de descarga no encontrado'}), 404
+    
+    file_path = resolve_job_file(download_id, filename)
+    if file_path is None:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    
+    # Registrar el acceso para la expulsión LRU
+    now = time.time()
+    if download_id in download_status:
+        download_status[download_id]['last_access'] = now
+    job_store.touch(download_id, now)
+    
+    return send_job_file(download_id, file_path)
+
+@app.route('/api/retention', methods=['GET'])
+def retention_stats_api():
+    return jsonify(retention_manager.snapshot())
+
+@app.route('/api/downloads/<download_id>', methods=['GET'])
+def list_downloads(download_id):
+    remote = remote_job_response(download_id)
+    if remote is not None:
+        return remote
+    status = find_job(download_id)
+    if status is None:
+        return jsonify({'error': 'ID de descarga no encontrado'}), 404
+    
+    download_dir = os.path.join(DOWNLOAD_FOLDER, download_id)
+    
+    if not os.path.exists(download_dir):
+        return jsonify({'error': 'Directorio de descarga no encontrado'}), 404
+    
+    files = job_files(download_id, status)
     
-    # Guardar en el estado para acceso futuro
-    status['final_files'] = files
+    # Guardar en el estado para acceso futuro una vez terminado el trabajo
+    if status['status'] in FINISHED_JOB_STATES:
+        status['final_files'] = files
     
+    page, meta = paginate_files(files, request.args)
     return jsonify({
-        'files': files,
-        'status': status['status']
+        'files': page,
+        'status': status['status'],
+        **meta
     })
 
+# Volver a poner en cola un trabajo interrumpido
+def restart_status(status, stage):
+    status.update({
+        'status': 'queued',
+        'current_stage': stage,
+        'queued_at': time.time(),
+        'resumed': status.get('resumed', 0) + 1,
+        'timings': {},
+        'completed_videos': 0,
+        'parts_finished': False,
+        'completed_files': [],
+        'final_files': [],
+        'errors': [],
+    })
+
+# Reanudar los trabajos que quedaron a medias por un reinicio o la caída de un worker
+def resume_interrupted_jobs():
+    for download_id, status, options in job_store.claim_interrupted(JOB_OWNER):
+        # Si la cola compartida ya se lo dio a otro nodo, el estado local queda obsoleto
+        if cluster_queue is not None and not cluster_queue.adopt(download_id, JOB_OWNER, NODE_ID):
+            job_store.delete(download_id)
+            continue
+        # yt-dlp continúa desde los archivos .part que quedaron en disco
+        restart_status(status, 'Reanudando descarga interrumpida...')
+        download_status[download_id] = status
+        job_options[download_id] = options
+        if not scheduler.submit(download_id, download_videos, (options, download_id), status.get('priority', 1)):
+            status['status'] = 'error'
+            status['current_stage'] = 'Error en la descarga'
+            status['errors'].append('No se pudo reanudar la descarga: la cola está llena.')
+        job_persister.save_now(download_id)
+        app.logger.info('Trabajo %s reanudado por %s', download_id, JOB_OWNER)
+    # Los lotes retoman la fase en la que estaban; sus trabajos ya creados siguen por su cuenta
+    for data in job_store.claim_interrupted_batches(JOB_OWNER):
+        batch = Batch.restore(data)
+        register_batch(batch)
+        batch_pool.submit(batch.run)
+        app.logger.info('Lote %s reanudado por %s', batch.id, JOB_OWNER)
+
+# Los trabajos de un proceso que acaba de caer conservan su concesión un rato: volver a mirar periódicamente
+def resume_loop():
+    while True:
+        try:
+            resume_interrupted_jobs()
+        except sqlite3.Error:
+            app.logger.exception('No se pudieron reclamar los trabajos interrumpidos')
+        time.sleep(JOB_LEASE_TIMEOUT)
+
+# En modo debug, el proceso padre del recargador de Flask no debe reclamar trabajos
+if not (__name__ == '__main__' and os.environ.get('DEBUG', 'False').lower() == 'true' and not os.environ.get('WERKZEUG_RUN_MAIN')):
+    threading.Thread(target=resume_loop, daemon=True, name='job-resumer').start()
+    if cluster_agent is not None:
+        cluster_agent.start()
+    # Importar yt-dlp y preparar las instancias de extracción sin retrasar el arranque
+    if YTDLP_PREWARM:
+        threading.Thread(target=ytdl_pool.prewarm, args=([VIDEO_INFO_OPTIONS, FLAT_INFO_OPTIONS],),
+                         daemon=True, name='ytdlp-prewarm').start()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=os.environ.get('DEBUG', 'False').lower() == 'true')
\ No newline at end of file
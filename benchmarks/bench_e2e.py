@@ -0,0 +1,328 @@
+"""
+Benchmark de extremo a extremo sin depender de YouTube.
+
+Levanta un origen HTTP local con contenido sintético (archivo progresivo con soporte de
+Range, o segmentos DASH), sustituye la extracción de yt-dlp por un extractor ficticio que
+apunta a ese origen y lanza trabajos contra la aplicación real servida por HTTP:
+POST /api/download, sondeo de /api/status y descarga de los archivos en /downloads/...
+
+Informa trabajos/min, bytes/s, latencia p50/p99 de /api/status, coste de CPU de
+progress_hook y memoria máxima (RSS) del proceso.
+
+Uso:
+    python benchmarks/bench_e2e.py
+    python benchmarks/bench_e2e.py --kind single --jobs 50 --concurrency 10 --size 2
+    python benchmarks/bench_e2e.py --kind playlist --playlist-size 20 --media dash --origin-rate 5
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MB = 1024 * 1024
+FRAGMENT_SIZE = 1024 * 1024
+
+
+# Origen HTTP con un único contenido en memoria: /progressive.mp4 (con Range) y /frag/<n>
+def start_origin(size, rate):
+    payload = os.urandom(size)
+
+    class OriginHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(body=False)
+
+        def do_GET(self, body=True):
+            start, end = 0, len(payload)
+            match = re.match(r'^/frag/(\d+)$', self.path)
+            if match:
+                start = int(match.group(1)) * FRAGMENT_SIZE
+                end = min(start + FRAGMENT_SIZE, len(payload))
+                if start >= len(payload):
+                    self.send_error(404)
+                    return
+            elif self.path != '/progressive.mp4':
+                self.send_error(404)
+                return
+            status = 200
+            range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if range_match and not match:
+                status = 206
+                start = int(range_match.group(1))
+                end = min(int(range_match.group(2)) + 1, len(payload)) if range_match.group(2) else len(payload)
+            self.send_response(status)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(payload)}')
+            self.end_headers()
+            if not body:
+                return
+            view = memoryview(payload)[start:end]
+            block = 64 * 1024
+            for offset in range(0, len(view), block):
+                self.wfile.write(view[offset:offset + block])
+                # Limitar la velocidad por conexión si se pidió
+                if rate:
+                    time.sleep(block / rate)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Extractor ficticio: sustituye YoutubeDL.extract_info con formatos que apuntan al origen local
+def install_stub_extractor(yt_dlp, origin, size, media, playlist_size):
+    base = f'http://127.0.0.1:{origin.server_address[1]}'
+    if media == 'dash':
+        fmt = {
+            'format_id': 'dash', 'ext': 'mp4', 'protocol': 'http_dash_segments',
+            'url': f'{base}/frag/0', 'fragment_base_url': f'{base}/frag/',
+            'fragments': [{'path': str(i)} for i in range((size + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE)],
+        }
+    else:
+        fmt = {'format_id': '18', 'ext': 'mp4', 'protocol': 'http', 'url': f'{base}/progressive.mp4'}
+    # Un solo formato con video y audio: no hace falta ffmpeg para mezclar
+    fmt.update({'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'width': 640, 'height': 360, 'filesize': size})
+
+    def extract_info(self, url, download=True, ie_key=None, extra_info=None, process=True,
+                     force_generic_extractor=False):
+        match = re.search(r'list=([\w-]+)', url)
+        if match:
+            list_id = match.group(1)
+            info = {
+                '_type': 'playlist', 'id': list_id, 'title': f'Lista {list_id}',
+                'extractor': 'youtube:tab', 'extractor_key': 'YoutubeTab', 'webpage_url': url,
+                'entries': [{
+                    '_type': 'url', 'ie_key': 'Youtube', 'id': f'{list_id}v{i:04d}', 'title': f'Video {i}',
+                    'url': f'https://www.youtube.com/watch?v={list_id}v{i:04d}',
+                } for i in range(playlist_size)],
+            }
+        else:
+            video_id = re.search(r'v=([\w-]+)', url).group(1)
+            info = {
+                'id': video_id, 'title': f'Video {video_id}', 'webpage_url': url,
+                'extractor': 'youtube', 'extractor_key': 'Youtube', 'formats': [dict(fmt)],
+            }
+        if extra_info:
+            info.update(extra_info)
+        return self.process_ie_result(info, download, extra_info or {}) if process else info
+
+    yt_dlp.YoutubeDL.extract_info = extract_info
+
+
+# Cliente HTTP mínimo contra la aplicación
+class Client:
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def fetch(self, path):
+        # Descargar un archivo contando bytes sin guardarlo entero en memoria
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            total = 0
+            while True:
+                chunk = response.read(MB)
+                if not chunk:
+                    break
+                total += len(chunk)
+            return response.status, total
+        finally:
+            conn.close()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.status_latencies = []
+        self.job_durations = []
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_downloaded = 0
+        self.bytes_served = 0
+        self.serve_time = 0.0
+        self.hook_cpu = 0.0
+        self.hook_calls = 0
+        self.job_ids = []
+
+
+def run_job(client, stats, n, args, run_id):
+    if args.kind == 'playlist':
+        payload = {'url': f'https://www.youtube.com/playlist?list=B{run_id}{n:05d}', 'type': 'playlist',
+                   'format': 'video', 'parallel': args.parallel}
+    else:
+        payload = {'url': f'https://www.youtube.com/watch?v=b{run_id}{n:05d}', 'type': 'single',
+                   'video_format_id': 'none', 'audio_format_id': '18'}
+    started = time.perf_counter()
+    while True:
+        code, headers, body = client.request('POST', '/api/download', payload)
+        if code != 429:
+            break
+        with stats.lock:
+            stats.rejected += 1
+        time.sleep(float(headers.get('Retry-After', 1)) if args.honor_retry_after else 0.5)
+    download_id = json.loads(body)['download_id']
+    with stats.lock:
+        stats.job_ids.append(download_id)
+
+    # Sondear el estado como lo haría la interfaz sin SSE
+    while True:
+        t0 = time.perf_counter()
+        code, _, body = client.request('GET', f'/api/status/{download_id}')
+        latency = time.perf_counter() - t0
+        status = json.loads(body)
+        with stats.lock:
+            stats.status_latencies.append(latency)
+        if status.get('status') in ('completed', 'partial', 'error'):
+            break
+        time.sleep(args.poll_interval)
+
+    if status['status'] == 'error':
+        with stats.lock:
+            stats.failed += 1
+        return
+
+    code, _, body = client.request('GET', f'/api/downloads/{download_id}?limit=0')
+    files = json.loads(body).get('files', [])
+    served = 0
+    t0 = time.perf_counter()
+    for file in files:
+        code, size = client.fetch(file['url'].replace(' ', '%20'))
+        served += size
+    serve_time = time.perf_counter() - t0
+    with stats.lock:
+        stats.completed += 1
+        stats.job_durations.append(time.perf_counter() - started)
+        stats.bytes_downloaded += sum(file['size'] for file in files)
+        stats.bytes_served += served
+        stats.serve_time += serve_time
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(p * (len(values) - 1))), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de extremo a extremo con un origen local')
+    parser.add_argument('--kind', choices=('single', 'playlist'), default='playlist', help='Tipo de trabajo')
+    parser.add_argument('--jobs', type=int, default=8, help='Trabajos en total')
+    parser.add_argument('--concurrency', type=int, default=4, help='Clientes simultáneos')
+    parser.add_argument('--playlist-size', type=int, default=5, help='Videos por lista')
+    parser.add_argument('--parallel', type=int, default=3, help='Videos en paralelo por lista')
+    parser.add_argument('--size', type=float, default=4, help='Tamaño de cada video en MB')
+    parser.add_argument('--media', choices=('progressive', 'dash'), default='progressive', help='Tipo de formato')
+    parser.add_argument('--origin-rate', type=float, default=0, help='MB/s por conexión en el origen (0 = sin límite)')
+    parser.add_argument('--poll-interval', type=float, default=0.25, help='Segundos entre consultas de estado')
+    parser.add_argument('--honor-retry-after', action='store_true', help='Esperar Retry-After ante un 429')
+    parser.add_argument('--store', action='store_true', help='Activar el almacén compartido de descargas')
+    parser.add_argument('--keep', action='store_true', help='No borrar los directorios de los trabajos')
+    args = parser.parse_args()
+
+    # Aislar el benchmark: estado en memoria y sin barridos de retención
+    os.environ.setdefault('JOB_STORE', 'memory')
+    os.environ.setdefault('RETENTION_SWEEP_INTERVAL', '0')
+    os.environ['CONTENT_STORE'] = 'True' if args.store else 'False'
+    os.environ.pop('PROGRESS_HOOK_RECORD', None)
+
+    import yt_dlp
+    import app
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    size = int(args.size * MB)
+    origin = start_origin(size, args.origin_rate * MB)
+    install_stub_extractor(yt_dlp, origin, size, args.media, args.playlist_size)
+
+    stats = Stats()
+    original_hook = app.progress_hook
+
+    # Medir el tiempo de CPU del hilo dentro de progress_hook
+    def timed_hook(d, download_id):
+        t0 = time.thread_time()
+        original_hook(d, download_id)
+        elapsed = time.thread_time() - t0
+        with stats.lock:
+            stats.hook_cpu += elapsed
+            stats.hook_calls += 1
+
+    app.progress_hook = timed_hook
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Client(server.server_port)
+    run_id = os.urandom(2).hex()
+    store_before = set(os.listdir(app.STORE_FOLDER)) if app.content_store is not None else set()
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_job, client, stats, n, args, run_id) for n in range(args.jobs)]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - wall_start
+
+    server.shutdown()
+    origin.shutdown()
+    app.progress_hook = original_hook
+    if not args.keep:
+        for download_id in stats.job_ids:
+            shutil.rmtree(os.path.join(app.DOWNLOAD_FOLDER, download_id), ignore_errors=True)
+        # Solo las entradas del almacén creadas por esta ejecución
+        if app.content_store is not None:
+            for key in set(os.listdir(app.STORE_FOLDER)) - store_before:
+                shutil.rmtree(os.path.join(app.STORE_FOLDER, key), ignore_errors=True)
+
+    videos = args.jobs * (args.playlist_size if args.kind == 'playlist' else 1)
+    # ru_maxrss está en KB en Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'trabajos:              {args.jobs} {args.kind} ({videos} videos de {args.size:g} MB, {args.media})')
+    print(f'completados/fallidos:  {stats.completed}/{stats.failed} (429: {stats.rejected})')
+    print(f'tiempo total:          {wall:.2f} s')
+    print(f'trabajos/min:          {stats.completed / wall * 60:.1f}')
+    print(f'duración por trabajo:  p50 {percentile(stats.job_durations, 0.5):.2f} s, '
+          f'p99 {percentile(stats.job_durations, 0.99):.2f} s')
+    print(f'descargado:            {stats.bytes_downloaded / MB:.1f} MB ({stats.bytes_downloaded / wall / MB:.1f} MB/s)')
+    if stats.serve_time:
+        print(f'servido:               {stats.bytes_served / MB:.1f} MB ({stats.bytes_served / stats.serve_time / MB:.1f} MB/s)')
+    print(f'latencia /api/status:  p50 {percentile(stats.status_latencies, 0.5) * 1000:.2f} ms, '
+          f'p99 {percentile(stats.status_latencies, 0.99) * 1000:.2f} ms ({len(stats.status_latencies)} consultas)')
+    if stats.hook_calls:
+        print(f'CPU de progress_hook:  {stats.hook_cpu * 1000:.1f} ms en {stats.hook_calls} llamadas '
+              f'({stats.hook_cpu / stats.hook_calls * 1e6:.2f} µs/llamada)')
+    print(f'RSS máxima:            {peak_rss:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark de progress_hook.
+
+Reproduce un flujo de eventos del hook de yt-dlp (grabado con PROGRESS_HOOK_RECORD o
+generado de forma sintética) sobre un trabajo ficticio y mide el coste por evento.
+
+Uso:
+    python benchmarks/bench_progress_hook.py
+    python benchmarks/bench_progress_hook.py --events eventos.jsonl --repeat 20
+    python benchmarks/bench_progress_hook.py --videos 8 --chunks 2000 --publish-interval 0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+# Generar eventos parecidos a los de una lista: varios videos en paralelo, cada uno con video y audio
+def synthetic_events(videos, chunks, chunk_size=65536):
+    streams = []
+    for v in range(videos):
+        video_id = f'bench{v:06d}'
+        for format_id, ext in (('137', 'mp4'), ('140', 'm4a')):
+            filename = f'/tmp/bench/{video_id}.f{format_id}.{ext}'
+            total = chunks * chunk_size
+            events = [{
+                'status': 'downloading',
+                'filename': filename,
+                'tmpfilename': filename + '.part',
+                'downloaded_bytes': (i + 1) * chunk_size,
+                'total_bytes': total,
+                'speed': 5e6,
+                'eta': (chunks - i) * 0.01,
+                'info_dict': {'id': video_id, 'format_id': format_id},
+            } for i in range(chunks)]
+            events.append({'status': 'finished', 'filename': filename, 'downloaded_bytes': total,
+                           'total_bytes': total, 'info_dict': {'id': video_id, 'format_id': format_id}})
+            streams.append(events)
+    # Intercalar los flujos como lo harían descargas concurrentes
+    interleaved = []
+    for i in range(max(len(stream) for stream in streams)):
+        for stream in streams:
+            if i < len(stream):
+                interleaved.append(stream[i])
+    return interleaved
+
+
+def load_events(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(events, threads):
+    download_id = f'bench_{os.urandom(4).hex()}'
+    app.download_status[download_id] = app.new_job_status(download_id)
+    publications = [0]
+    original_publish = app.publish_status
+
+    def counting_publish(job_id):
+        publications[0] += 1
+        original_publish(job_id)
+
+    app.publish_status = counting_publish
+    try:
+        chunks = [events[i::threads] for i in range(threads)]
+        workers = [threading.Thread(target=lambda chunk=chunk: [app.progress_hook(d, download_id) for d in chunk])
+                   for chunk in chunks]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+    finally:
+        app.publish_status = original_publish
+        app.job_progress.pop(download_id, None)
+        app.download_status.pop(download_id, None)
+    return wall, cpu, publications[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coste por evento de progress_hook')
+    parser.add_argument('--events', help='Archivo .jsonl grabado con PROGRESS_HOOK_RECORD')
+    parser.add_argument('--videos', type=int, default=4, help='Videos simultáneos en el flujo sintético')
+    parser.add_argument('--chunks', type=int, default=5000, help='Eventos por formato en el flujo sintético')
+    parser.add_argument('--threads', type=int, default=1, help='Hilos que llaman al hook a la vez')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeticiones (se informa la mejor)')
+    parser.add_argument('--publish-interval', type=float, help='Sobrescribe PROGRESS_PUBLISH_INTERVAL')
+    args = parser.parse_args()
+
+    if args.publish_interval is not None:
+        app.PROGRESS_PUBLISH_INTERVAL = args.publish_interval
+    events = load_events(args.events) if args.events else synthetic_events(args.videos, args.chunks)
+
+    results = [replay(events, args.threads) for _ in range(args.repeat)]
+    wall, cpu, publications = min(results)
+    print(f'eventos:          {len(events)}')
+    print(f'hilos:            {args.threads}')
+    print(f'intervalo:        {app.PROGRESS_PUBLISH_INTERVAL}s')
+    print(f'tiempo total:     {wall * 1000:.1f} ms (CPU {cpu * 1000:.1f} ms)')
+    print(f'coste por evento: {wall / len(events) * 1e6:.2f} µs')
+    print(f'eventos/s:        {len(events) / wall:,.0f}')
+    print(f'publicaciones:    {publications}')
+
+
+if __name__ == '__main__':
+    main()
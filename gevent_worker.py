@@ -0,0 +1,15 @@
+# Worker gevent de gunicorn para servir miles de conexiones (SSE, /api/status) desde un solo proceso.
+# Uso: gunicorn --worker-class gevent_worker.GeventWorker --worker-connections 2000 app:app
+#
+# A diferencia de --worker-class gevent, solo parchea la E/S (socket, ssl, select, time): threading
+# sigue siendo el del sistema, así que las descargas, yt-dlp y ffmpeg corren en hilos reales y no
+# bloquean el bucle de eventos que atiende las peticiones.
+from gevent import monkey, socket
+from gunicorn.workers import ggevent
+
+
+class GeventWorker(ggevent.GeventWorker):
+    def patch(self):
+        monkey.patch_all(thread=False, queue=False, subprocess=False, os=False, signal=False)
+        self.sockets = [socket.socket(s.FAMILY, socket.SOCK_STREAM, fileno=s.sock.detach())
+                        for s in self.sockets]
@@ -36,9 +36,57 @@ function formatTime(seconds) {
 }
 
 // Estado global de descargas
-const statusIntervals = {};
+const statusWatchers = {};
 const downloadTimers = {}; // Para controlar el tiempo transcurrido en cada descarga
 
+// Seguimiento del estado de una descarga: SSE con deltas y polling como alternativa
+function watchDownload(downloadId, onStatus) {
+    const state = {};
+    const watcher = { source: null, interval: null, stopped: false };
+    statusWatchers[downloadId] = watcher;
+
+    const startPolling = () => {
+        if (watcher.stopped || watcher.interval) return;
+        watcher.interval = setInterval(() => {
+            fetch(`/api/status/${downloadId}`)
+                .then(r => r.json())
+                .then(status => {
+                    if (!watcher.stopped) onStatus(status);
+                });
+        }, 1000);
+    };
+
+    if (!window.EventSource) {
+        startPolling();
+        return watcher;
+    }
+
+    const source = new EventSource(`/api/events/${downloadId}`);
+    watcher.source = source;
+    source.onmessage = event => {
+        const { removed = [], ...changes } = JSON.parse(event.data);
+        Object.assign(state, changes);
+        removed.forEach(key => delete state[key]);
+        if (!watcher.stopped) onStatus({ ...state });
+    };
+    source.addEventListener('end', () => source.close());
+    source.onerror = () => {
+        // Conexión perdida o servidor sin soporte SSE: continuar con polling
+        source.close();
+        startPolling();
+    };
+    return watcher;
+}
+
+function stopWatching(downloadId) {
+    const watcher = statusWatchers[downloadId];
+    if (!watcher) return;
+    watcher.stopped = true;
+    if (watcher.source) watcher.source.close();
+    if (watcher.interval) clearInterval(watcher.interval);
+    delete statusWatchers[downloadId];
+}
+
 // Inicialización principal
 function initApp() {
     const playlistDownloadForm = document.getElementById('playlist-download-form');
@@ -51,6 +99,27 @@ function initApp() {
     const videoFormatSelect = document.getElementById('video-format-select');
     const audioFormatSelect = document.getElementById('audio-format-select');
 
+    // Las opciones recomendadas ya incluyen el audio; la lista completa se pide solo si hace falta
+    videoFormatSelect.addEventListener('change', function() {
+        if (videoFormatSelect.value === '__all__') {
+            const videoUrl = document.getElementById('video-url').value.trim();
+            videoFormatSelect.disabled = true;
+            fetch('/api/video_info', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ url: videoUrl, all_formats: true })
+            })
+            .then(response => response.json())
+            .then(data => {
+                videoFormatSelect.disabled = false;
+                if (!data.error) populateVideoInfo(data, videoFormatSelect, audioFormatSelect);
+            })
+            .catch(() => { videoFormatSelect.disabled = false; });
+            return;
+        }
+        audioFormatSelect.disabled = videoFormatSelect.value.startsWith('choice:');
+    });
+
     // Feedback de carga al obtener info del video
     getVideoInfoBtn.addEventListener('click', function() {
         const videoUrl = document.getElementById('video-url').value.trim();
@@ -113,9 +182,13 @@ function initApp() {
         const videoUrl = document.getElementById('video-url').value.trim();
         const videoFormat = document.getElementById('video-format-select').value;
         const audioFormat = document.getElementById('audio-format-select').value;
+        const choice = videoFormat.startsWith('choice:') ? videoFormat.slice('choice:'.length) : null;
+        const streamRequested = document.getElementById('stream-while-downloading').checked;
         const feedbackContainer = document.getElementById('video-feedback-container');
+        const streamContainer = document.getElementById('video-stream-container');
         feedbackContainer.innerHTML = '';
-        if (!videoUrl || !videoFormat || !audioFormat) {
+        streamContainer.innerHTML = '';
+        if (!videoUrl || !videoFormat || videoFormat === '__all__' || (!choice && !audioFormat)) {
             feedbackContainer.innerHTML = '<div class="alert alert-warning">Por favor, selecciona los formatos y la URL antes de descargar.</div>';
             return;
         }
@@ -124,11 +197,12 @@ function initApp() {
         fetch('/api/download', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ 
+            body: JSON.stringify(choice ? { url: videoUrl, type: 'single', choice, stream: streamRequested } : { 
                 url: videoUrl, 
                 type: 'single', 
                 video_format_id: videoFormat,
-                audio_format_id: audioFormat
+                audio_format_id: audioFormat,
+                stream: streamRequested
             })
         })
         .then(response => response.json())
@@ -138,6 +212,17 @@ function initApp() {
                 startSingleDownloadBtn.disabled = false;
                 return;
             }
+            // Enlace para reproducir el archivo mientras se descarga
+            if (data.stream_url) {
+                streamContainer.innerHTML = `
+                    <a href="${data.stream_url}" target="_blank" class="btn btn-sm btn-outline-success">
+                        <i class="bi bi-play-circle"></i> Reproducir mientras se descarga
+                    </a>
+                `;
+            } else if (data.stream_error) {
+                streamContainer.innerHTML = `<div class="alert alert-info small py-2">${data.stream_error}</div>`;
+            }
+            
             // Iniciar feedback profesional de progreso
             const downloadId = data.download_id;
             let lastDownloaded = 0;
@@ -150,141 +235,144 @@ function initApp() {
                 running: true
             };
             
-            statusIntervals[downloadId] = setInterval(() => {
-                fetch(`/api/status/${downloadId}`)
-                    .then(r => r.json())
-                    .then(status => {
-                        if (status.error) {
-                            feedbackContainer.innerHTML = `<div class='alert alert-danger'>${status.error}</div>`;
-                            clearInterval(statusIntervals[downloadId]);
-                            startSingleDownloadBtn.disabled = false;
-                            downloadTimers[downloadId].running = false;
-                            return;
-                        }
+            watchDownload(downloadId, status => {
+                if (status.error) {
+                    feedbackContainer.innerHTML = `<div class='alert alert-danger'>${status.error}</div>`;
+                    stopWatching(downloadId);
+                    startSingleDownloadBtn.disabled = false;
+                    downloadTimers[downloadId].running = false;
+                    return;
+                }
+                
+                // Calcular métricas
+                const percent = status.current_progress || 0;
+                const downloaded = status.downloaded_bytes || 0;
+                const total = status.total_bytes || 0;
+                
+                // Calcular tiempo transcurrido (acumulativo)
+                const timer = downloadTimers[downloadId];
+                const now = Date.now();
+                // Tiempo transcurrido desde la última actualización
+                const elapsedSinceLastUpdate = (now - timer.lastUpdateTime) / 1000;
+                
+                // Usar el tiempo del servidor si está disponible, de lo contrario, calcular localmente
+                let elapsedTime;
+                if (status.elapsed && status.elapsed > 0) {
+                    elapsedTime = status.elapsed; // Tiempo reportado por yt-dlp
+                } else {
+                    // Tiempo transcurrido desde el inicio
+                    elapsedTime = timer.totalElapsed + elapsedSinceLastUpdate;
+                }
+                
+                // Actualizar el timer para la próxima iteración
+                timer.lastUpdateTime = now;
+                timer.totalElapsed = elapsedTime;
+                
+                // Calcular velocidad y ETA
+                let speed = 0, eta = 0;
+                
+                // Usar la velocidad proporcionada por el backend si está disponible
+                if (status.speed && status.speed > 0) {
+                    speed = status.speed / (1024 * 1024); // Convertir a MB/s
+                    eta = status.eta || 0;
+                } else if (downloaded > lastDownloaded && elapsedSinceLastUpdate > 0) {
+                    // Calcular basado en la cantidad descargada desde la última actualización
+                    const bytesDownloadedSinceLastUpdate = downloaded - lastDownloaded;
+                    speed = (bytesDownloadedSinceLastUpdate / 1024 / 1024) / elapsedSinceLastUpdate;
+                    
+                    // Calcular ETA basado en la velocidad actual y los bytes restantes
+                    if (speed > 0 && total > downloaded) {
+                        eta = (total - downloaded) / (speed * 1024 * 1024);
+                    }
+                }
+                
+                lastDownloaded = downloaded;
+                
+                // Actualizar UI con la información actual
+                window.renderDownloadProgress({
+                    container: feedbackContainer,
+                    filename: status.current_video || 'Descargando...',
+                    percent,
+                    downloaded,
+                    total,
+                    speed: speed ? speed.toFixed(2) : null,
+                    eta,
+                    elapsed: elapsedTime,
+                    stage: status.current_stage || null // Pasar la etapa actual a la función de renderizado
+                });
+                
+                // Aviso si el sitio está limitando las descargas (HTTP 429)
+                const throttleWait = status.bandwidth && status.bandwidth.throttled_until
+                    ? Math.round(status.bandwidth.throttled_until - Date.now() / 1000) : 0;
+                if (throttleWait > 0) {
+                    feedbackContainer.innerHTML += `<div class='text-center small text-warning mt-1'>${status.bandwidth.host} está limitando las descargas: se reanudan en ${throttleWait} s</div>`;
+                }
+                
+                // Si la descarga ha terminado
+                if (status.status === 'completed' || status.status === 'partial' || status.status === 'error') {
+                    stopWatching(downloadId);
+                    startSingleDownloadBtn.disabled = false;
+                    
+                    if (status.status === 'completed') {
+                        feedbackContainer.innerHTML += '<div class="alert alert-success mt-2">¡Descarga completada!</div>';
                         
-                        // Calcular métricas
-                        const percent = status.current_progress || 0;
-                        const downloaded = status.downloaded_bytes || 0;
-                        const total = status.total_bytes || 0;
-                        
-                        // Calcular tiempo transcurrido (acumulativo)
-                        const timer = downloadTimers[downloadId];
-                        const now = Date.now();
-                        // Tiempo transcurrido desde la última actualización
-                        const elapsedSinceLastUpdate = (now - timer.lastUpdateTime) / 1000;
-                        
-                        // Usar el tiempo del servidor si está disponible, de lo contrario, calcular localmente
-                        let elapsedTime;
-                        if (status.elapsed && status.elapsed > 0) {
-                            elapsedTime = status.elapsed; // Tiempo reportado por yt-dlp
+                        // Mostrar enlaces a los archivos descargados si están disponibles
+                        if (status.files && status.files.length > 0) {
+                            window.renderDownloadLinks({
+                                container: feedbackContainer,
+                                files: status.files,
+                                title: "Archivos descargados"
+                            });
                         } else {
-                            // Tiempo transcurrido desde el inicio
-                            elapsedTime = timer.totalElapsed + elapsedSinceLastUpdate;
-                        }
-                        
-                        // Actualizar el timer para la próxima iteración
-                        timer.lastUpdateTime = now;
-                        timer.totalElapsed = elapsedTime;
-                        
-                        // Calcular velocidad y ETA
-                        let speed = 0, eta = 0;
-                        
-                        // Usar la velocidad proporcionada por el backend si está disponible
-                        if (status.speed && status.speed > 0) {
-                            speed = status.speed / (1024 * 1024); // Convertir a MB/s
-                            eta = status.eta || 0;
-                        } else if (downloaded > lastDownloaded && elapsedSinceLastUpdate > 0) {
-                            // Calcular basado en la cantidad descargada desde la última actualización
-                            const bytesDownloadedSinceLastUpdate = downloaded - lastDownloaded;
-                            speed = (bytesDownloadedSinceLastUpdate / 1024 / 1024) / elapsedSinceLastUpdate;
-                            
-                            // Calcular ETA basado en la velocidad actual y los bytes restantes
-                            if (speed > 0 && total > downloaded) {
-                                eta = (total - downloaded) / (speed * 1024 * 1024);
-                            }
+                            // Si no hay archivos en la respuesta, buscar en el endpoint específico
+                            fetch(`/api/downloads/${downloadId}`)
+                                .then(r => r.json())
+                                .then(data => {
+                                    if (data.files && data.files.length > 0) {
+                                        window.renderDownloadLinks({
+                                            container: feedbackContainer,
+                                            files: data.files,
+                                            title: "Archivos descargados"
+                                        });
+                                    } else {
+                                        feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se encontraron archivos para descargar.</div>';
+                                    }
+                                })
+                                .catch(err => {
+                                    console.error("Error al obtener archivos:", err);
+                                    feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se pudieron obtener los archivos descargados.</div>';
+                                });
                         }
-                        
-                        lastDownloaded = downloaded;
-                        
-                        // Actualizar UI con la información actual
-                        window.renderDownloadProgress({
-                            container: feedbackContainer,
-                            filename: status.current_video || 'Descargando...',
-                            percent,
-                            downloaded,
-                            total,
-                            speed: speed ? speed.toFixed(2) : null,
-                            eta,
-                            elapsed: elapsedTime,
-                            stage: status.current_stage || null // Pasar la etapa actual a la función de renderizado
-                        });
-                        
-                        // Si la descarga ha terminado
-                        if (status.status === 'completed' || status.status === 'partial' || status.status === 'error') {
-                            clearInterval(statusIntervals[downloadId]);
-                            startSingleDownloadBtn.disabled = false;
-                            
-                            if (status.status === 'completed') {
-                                feedbackContainer.innerHTML += '<div class="alert alert-success mt-2">¡Descarga completada!</div>';
-                                
-                                // Mostrar enlaces a los archivos descargados si están disponibles
-                                if (status.files && status.files.length > 0) {
+                    } else if (status.status === 'partial') {
+                        feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">Descarga parcial. Algunos archivos pueden faltar.</div>';
+                        // Intentar mostrar los archivos parciales
+                        fetch(`/api/downloads/${downloadId}`)
+                            .then(r => r.json())
+                            .then(data => {
+                                if (data.files && data.files.length > 0) {
                                     window.renderDownloadLinks({
                                         container: feedbackContainer,
-                                        files: status.files,
-                                        title: "Archivos descargados"
-                                    });
-                                } else {
-                                    // Si no hay archivos en la respuesta, buscar en el endpoint específico
-                                    fetch(`/api/downloads/${downloadId}`)
-                                        .then(r => r.json())
-                                        .then(data => {
-                                            if (data.files && data.files.length > 0) {
-                                                window.renderDownloadLinks({
-                                                    container: feedbackContainer,
-                                                    files: data.files,
-                                                    title: "Archivos descargados"
-                                                });
-                                            } else {
-                                                feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se encontraron archivos para descargar.</div>';
-                                            }
-                                        })
-                                        .catch(err => {
-                                            console.error("Error al obtener archivos:", err);
-                                            feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se pudieron obtener los archivos descargados.</div>';
-                                        });
-                                }
-                            } else if (status.status === 'partial') {
-                                feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">Descarga parcial. Algunos archivos pueden faltar.</div>';
-                                // Intentar mostrar los archivos parciales
-                                fetch(`/api/downloads/${downloadId}`)
-                                    .then(r => r.json())
-                                    .then(data => {
-                                        if (data.files && data.files.length > 0) {
-                                            window.renderDownloadLinks({
-                                                container: feedbackContainer,
-                                                files: data.files,
-                                                title: "Archivos disponibles (descarga parcial)"
-                                            });
-                                        }
+                                        files: data.files,
+                                        title: "Archivos disponibles (descarga parcial)"
                                     });
-                            } else if (status.status === 'error') {
-                                // Mostrar errores específicos si están disponibles
-                                if (status.errors && status.errors.length > 0) {
-                                    const errorList = status.errors.map(err => `<li>${err}</li>`).join('');
-                                    feedbackContainer.innerHTML += `
-                                        <div class="alert alert-danger mt-2">
-                                            <p><strong>Ocurrieron errores durante la descarga:</strong></p>
-                                            <ul>${errorList}</ul>
-                                        </div>
-                                    `;
-                                } else {
-                                    feedbackContainer.innerHTML += '<div class="alert alert-danger mt-2">Ocurrió un error durante la descarga.</div>';
                                 }
-                            }
+                            });
+                    } else if (status.status === 'error') {
+                        // Mostrar errores específicos si están disponibles
+                        if (status.errors && status.errors.length > 0) {
+                            const errorList = status.errors.map(err => `<li>${err}</li>`).join('');
+                            feedbackContainer.innerHTML += `
+                                <div class="alert alert-danger mt-2">
+                                    <p><strong>Ocurrieron errores durante la descarga:</strong></p>
+                                    <ul>${errorList}</ul>
+                                </div>
+                            `;
+                        } else {
+                            feedbackContainer.innerHTML += '<div class="alert alert-danger mt-2">Ocurrió un error durante la descarga.</div>';
                         }
-                    });
-            }, 1000);
+                    }
+                }
+            });
         })
         .catch(error => {
             feedbackContainer.innerHTML = `<div class='alert alert-danger'>${error}</div>`;
@@ -309,7 +397,12 @@ function initApp() {
         fetch('/api/download', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ url: playlistUrl, format: formatOption, type: 'playlist' })
+            body: JSON.stringify({
+                url: playlistUrl,
+                format: formatOption.startsWith('audio') ? 'audio' : formatOption,
+                audio_format: formatOption === 'audio-m4a' ? 'm4a' : 'mp3',
+                type: document.getElementById('playlist-sync').checked ? 'sync' : 'playlist'
+            })
         })
         .then(response => response.json())
         .then(data => {
@@ -322,123 +415,137 @@ function initApp() {
             let lastDownloaded = 0;
             let lastTime = Date.now();
             let elapsed = 0;
-            statusIntervals[downloadId] = setInterval(() => {
-                fetch(`/api/status/${downloadId}`)
-                    .then(r => r.json())
-                    .then(status => {
-                        if (status.error) {
-                            feedbackContainer.innerHTML = `<div class='alert alert-danger'>${status.error}</div>`;
-                            clearInterval(statusIntervals[downloadId]);
-                            return;
-                        }
-                        // Calcular métricas
-                        const percent = status.total_videos > 0 ? Math.round((status.completed_videos / status.total_videos) * 100) : 0;
-                        const downloaded = status.downloaded_bytes || 0;
-                        const total = status.total_bytes || 0;
-                        const now = Date.now();
-                        elapsed = (elapsed === 0 && percent > 0) ? 1 : Math.floor((now - lastTime) / 1000);
-                        let speed = 0, eta = 0;
-                        
-                        // Usar la velocidad proporcionada por el backend o calcularla
-                        if (status.speed && status.speed > 0) {
-                            speed = status.speed / (1024 * 1024); // Convertir a MB/s
-                            eta = status.eta || 0;
-                        } else if (downloaded > 0 && elapsed > 0) {
-                            speed = ((downloaded - lastDownloaded) / 1024 / 1024) / (elapsed || 1);
-                            eta = speed > 0 ? ((total - downloaded) / 1024 / 1024) / speed : 0;
-                        }
-                        
-                        lastDownloaded = downloaded;
-                        lastTime = now;
+            watchDownload(downloadId, status => {
+                if (status.error) {
+                    feedbackContainer.innerHTML = `<div class='alert alert-danger'>${status.error}</div>`;
+                    stopWatching(downloadId);
+                    return;
+                }
+                // Calcular métricas
+                const percent = status.total_videos > 0 ? Math.round((status.completed_videos / status.total_videos) * 100) : 0;
+                const downloaded = status.downloaded_bytes || 0;
+                const total = status.total_bytes || 0;
+                const now = Date.now();
+                elapsed = (elapsed === 0 && percent > 0) ? 1 : Math.floor((now - lastTime) / 1000);
+                let speed = 0, eta = 0;
+                
+                // Usar la velocidad proporcionada por el backend o calcularla
+                if (status.speed && status.speed > 0) {
+                    speed = status.speed / (1024 * 1024); // Convertir a MB/s
+                    eta = status.eta || 0;
+                } else if (downloaded > 0 && elapsed > 0) {
+                    speed = ((downloaded - lastDownloaded) / 1024 / 1024) / (elapsed || 1);
+                    eta = speed > 0 ? ((total - downloaded) / 1024 / 1024) / speed : 0;
+                }
+                
+                lastDownloaded = downloaded;
+                lastTime = now;
+                
+                // Mostrar la etapa actual
+                let stageInfo = '';
+                if (status.current_stage) {
+                    stageInfo = `<div class="text-center small text-muted mb-2">${status.current_stage}</div>`;
+                    feedbackContainer.innerHTML = stageInfo;
+                }
+                
+                window.renderDownloadProgress({
+                    container: feedbackContainer,
+                    filename: status.current_video || 'Descargando...',
+                    percent,
+                    downloaded,
+                    total,
+                    speed: speed ? speed.toFixed(2) : null,
+                    eta,
+                    elapsed,
+                    stage: status.current_stage || null // Pasar la etapa actual
+                });
+                
+                // Aviso si el sitio está limitando las descargas (HTTP 429)
+                const throttleWait = status.bandwidth && status.bandwidth.throttled_until
+                    ? Math.round(status.bandwidth.throttled_until - Date.now() / 1000) : 0;
+                if (throttleWait > 0) {
+                    feedbackContainer.innerHTML += `<div class='text-center small text-warning mt-1'>${status.bandwidth.host} está limitando las descargas: se reanudan en ${throttleWait} s</div>`;
+                }
+                
+                // Mostrar progreso de videos
+                if (status.total_videos > 1) {
+                    feedbackContainer.innerHTML += `<div class='text-center small text-muted mt-1'>Videos completados: <b>${status.completed_videos}</b> de <b>${status.total_videos}</b></div>`;
+                }
+                
+                // Resumen de la sincronización con la última vez
+                if (status.sync) {
+                    feedbackContainer.innerHTML += `<div class='text-center small text-muted mt-1'>Nuevos: <b>${status.sync.new}</b> · Con otro formato: <b>${status.sync.changed}</b> · Sin cambios: <b>${status.sync.unchanged}</b></div>`;
+                }
+                
+                // Si la descarga ha terminado
+                if (status.status === 'completed' || status.status === 'partial' || status.status === 'error') {
+                    stopWatching(downloadId);
+                    
+                    if (status.status === 'completed') {
+                        feedbackContainer.innerHTML += '<div class="alert alert-success mt-2">¡Descarga de lista completada!</div>';
                         
-                        // Mostrar la etapa actual
-                        let stageInfo = '';
-                        if (status.current_stage) {
-                            stageInfo = `<div class="text-center small text-muted mb-2">${status.current_stage}</div>`;
-                            feedbackContainer.innerHTML = stageInfo;
-                        }
-                        
-                        window.renderDownloadProgress({
-                            container: feedbackContainer,
-                            filename: status.current_video || 'Descargando...',
-                            percent,
-                            downloaded,
-                            total,
-                            speed: speed ? speed.toFixed(2) : null,
-                            eta,
-                            elapsed,
-                            stage: status.current_stage || null // Pasar la etapa actual
-                        });
-                        
-                        // Mostrar progreso de videos
-                        if (status.total_videos > 1) {
-                            feedbackContainer.innerHTML += `<div class='text-center small text-muted mt-1'>Videos completados: <b>${status.completed_videos}</b> de <b>${status.total_videos}</b></div>`;
+                        // Mostrar enlaces a los archivos descargados si están disponibles
+                        if (status.files && status.files.length > 0) {
+                            window.renderDownloadLinks({
+                                container: feedbackContainer,
+                                files: status.files,
+                                total: status.files_total,
+                                title: "Videos descargados",
+                                archiveUrl: `/downloads/${downloadId}`
+                            });
+                        } else {
+                            // Si no hay archivos en la respuesta, buscar en el endpoint específico
+                            fetch(`/api/downloads/${downloadId}`)
+                                .then(r => r.json())
+                                .then(data => {
+                                    if (data.files && data.files.length > 0) {
+                                        window.renderDownloadLinks({
+                                            container: feedbackContainer,
+                                            files: data.files,
+                                            total: data.total_files,
+                                            title: "Videos descargados",
+                                            archiveUrl: `/downloads/${downloadId}`
+                                        });
+                                    } else {
+                                        feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se encontraron archivos para descargar.</div>';
+                                    }
+                                })
+                                .catch(err => {
+                                    console.error("Error al obtener archivos:", err);
+                                    feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se pudieron obtener los archivos descargados.</div>';
+                                });
                         }
-                        
-                        // Si la descarga ha terminado
-                        if (status.status === 'completed' || status.status === 'partial' || status.status === 'error') {
-                            clearInterval(statusIntervals[downloadId]);
-                            
-                            if (status.status === 'completed') {
-                                feedbackContainer.innerHTML += '<div class="alert alert-success mt-2">¡Descarga de lista completada!</div>';
-                                
-                                // Mostrar enlaces a los archivos descargados si están disponibles
-                                if (status.files && status.files.length > 0) {
-                                    window.renderDownloadLinks({
+                    } else if (status.status === 'partial') {
+                        feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">Descarga parcial. Algunos videos pueden faltar.</div>';
+                        // Intentar mostrar los archivos parciales
+                        fetch(`/api/downloads/${downloadId}`)
+                            .then(r => r.json())
+                            .then(data => {
+                                if (data.files && data.files.length > 0) {                                                window.renderDownloadLinks({
                                         container: feedbackContainer,
-                                        files: status.files,
-                                        title: "Videos descargados"
-                                    });
-                                } else {
-                                    // Si no hay archivos en la respuesta, buscar en el endpoint específico
-                                    fetch(`/api/downloads/${downloadId}`)
-                                        .then(r => r.json())
-                                        .then(data => {
-                                            if (data.files && data.files.length > 0) {
-                                                window.renderDownloadLinks({
-                                                    container: feedbackContainer,
-                                                    files: data.files,
-                                                    title: "Videos descargados"
-                                                });
-                                            } else {
-                                                feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se encontraron archivos para descargar.</div>';
-                                            }
-                                        })
-                                        .catch(err => {
-                                            console.error("Error al obtener archivos:", err);
-                                            feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">No se pudieron obtener los archivos descargados.</div>';
-                                        });
-                                }
-                            } else if (status.status === 'partial') {
-                                feedbackContainer.innerHTML += '<div class="alert alert-warning mt-2">Descarga parcial. Algunos videos pueden faltar.</div>';
-                                // Intentar mostrar los archivos parciales
-                                fetch(`/api/downloads/${downloadId}`)
-                                    .then(r => r.json())
-                                    .then(data => {
-                                        if (data.files && data.files.length > 0) {                                                window.renderDownloadLinks({
-                                                container: feedbackContainer,
-                                                files: data.files,
-                                                title: "Videos disponibles (descarga parcial)"
-                                            });
-                                        }
+                                        files: data.files,
+                                        total: data.total_files,
+                                        title: "Videos disponibles (descarga parcial)",
+                                        archiveUrl: `/downloads/${downloadId}`
                                     });
-                            } else if (status.status === 'error') {
-                                // Mostrar errores específicos si están disponibles
-                                if (status.errors && status.errors.length > 0) {
-                                    const errorList = status.errors.map(err => `<li>${err}</li>`).join('');
-                                    feedbackContainer.innerHTML += `
-                                        <div class="alert alert-danger mt-2">
-                                            <p><strong>Ocurrieron errores durante la descarga:</strong></p>
-                                            <ul>${errorList}</ul>
-                                        </div>
-                                    `;
-                                } else {
-                                    feedbackContainer.innerHTML += '<div class="alert alert-danger mt-2">Ocurrió un error durante la descarga.</div>';
                                 }
-                            }
+                            });
+                    } else if (status.status === 'error') {
+                        // Mostrar errores específicos si están disponibles
+                        if (status.errors && status.errors.length > 0) {
+                            const errorList = status.errors.map(err => `<li>${err}</li>`).join('');
+                            feedbackContainer.innerHTML += `
+                                <div class="alert alert-danger mt-2">
+                                    <p><strong>Ocurrieron errores durante la descarga:</strong></p>
+                                    <ul>${errorList}</ul>
+                                </div>
+                            `;
+                        } else {
+                            feedbackContainer.innerHTML += '<div class="alert alert-danger mt-2">Ocurrió un error durante la descarga.</div>';
                         }
-                    });
-            }, 1000);
+                    }
+                }
+            });
         })
         .catch(error => {
             feedbackContainer.innerHTML = `<div class='alert alert-danger'>${error}</div>`;
@@ -453,42 +560,44 @@ function populateVideoInfo(data, videoSelect, audioSelect) {
     document.getElementById('video-title').textContent = data.title;
     videoSelect.innerHTML = '';
     audioSelect.innerHTML = '';
-    // ...igual que antes, pero modularizado...
-    const videoFormats = data.formats
-        .filter(f => f.vcodec !== 'none' && f.acodec === 'none')
-        .sort((a, b) => {
+    // Opciones recomendadas por el servidor (sin recodificar siempre que es posible)
+    const choices = data.choices || [];
+    if (choices.length > 0) {
+        const group = document.createElement('optgroup');
+        group.label = 'Recomendados';
+        choices.forEach(c => {
+            const option = document.createElement('option');
+            option.value = `choice:${c.id}`;
+            const size = c.filesize_approx ? formatFileSize(c.filesize_approx) : 'N/A';
+            option.textContent = `${c.label} - ${size}${c.reencode ? ' (recodifica el audio)' : ''}`;
+            group.appendChild(option);
+        });
+        videoSelect.appendChild(group);
+    }
+    const formats = data.formats || [];
+    const addFormatGroup = (label, list, suffix) => {
+        if (list.length === 0) return;
+        const group = document.createElement('optgroup');
+        group.label = label;
+        list.sort((a, b) => {
             const heightA = parseInt((a.resolution || '').split('x')[1]) || 0;
             const heightB = parseInt((b.resolution || '').split('x')[1]) || 0;
             return heightB - heightA;
+        }).forEach(f => {
+            const option = document.createElement('option');
+            option.value = f.format_id;
+            const height = (f.resolution || '').split('x')[1] || 'N/A';
+            const fps = f.fps ? `${f.fps}fps` : '';
+            const size = f.filesize_approx ? formatFileSize(f.filesize_approx) : 'N/A';
+            option.textContent = `${height}p ${fps} - ${f.ext} - ${size}${suffix}`;
+            group.appendChild(option);
         });
-    videoFormats.forEach(f => {
-        const option = document.createElement('option');
-        option.value = f.format_id;
-        const height = (f.resolution || '').split('x')[1] || 'N/A';
-        const fps = f.fps ? `${f.fps}fps` : '';
-        const size = f.filesize_approx ? formatFileSize(f.filesize_approx) : 'N/A';
-        option.textContent = `${height}p ${fps} - ${f.ext} - ${size}`;
-        videoSelect.appendChild(option);
-    });
-    if (videoFormats.length === 0) {
-        data.formats
-            .filter(f => f.vcodec !== 'none' && f.acodec !== 'none')
-            .sort((a, b) => {
-                const heightA = parseInt((a.resolution || '').split('x')[1]) || 0;
-                const heightB = parseInt((b.resolution || '').split('x')[1]) || 0;
-                return heightB - heightA;
-            })
-            .forEach(f => {
-                const option = document.createElement('option');
-                option.value = f.format_id;
-                const height = (f.resolution || '').split('x')[1] || 'N/A';
-                const fps = f.fps ? `${f.fps}fps` : '';
-                const size = f.filesize_approx ? formatFileSize(f.filesize_approx) : 'N/A';
-                option.textContent = `${height}p ${fps} - ${f.ext} - ${size} (con audio)`;
-                videoSelect.appendChild(option);
-            });
-    }
-    const audioFormats = data.formats
+        videoSelect.appendChild(group);
+    };
+    addFormatGroup('Video', formats.filter(f => f.vcodec !== 'none' && f.acodec === 'none'), '');
+    // Formatos con video y audio en un solo archivo (no necesitan mezcla y se pueden reproducir mientras se descargan)
+    addFormatGroup('Video con audio', formats.filter(f => f.vcodec !== 'none' && f.acodec !== 'none'), ' (con audio)');
+    const audioFormats = formats
         .filter(f => f.acodec !== 'none' && f.vcodec === 'none')
         .sort((a, b) => (b.abr || 0) - (a.abr || 0));
     audioFormats.forEach(f => {
@@ -499,6 +608,18 @@ function populateVideoInfo(data, videoSelect, audioSelect) {
         option.textContent = `${f.ext} - ${abr} - ${size}`;
         audioSelect.appendChild(option);
     });
+    if (audioFormats.length > 0) {
+        const option = document.createElement('option');
+        option.value = 'none';
+        option.textContent = 'Solo audio';
+        videoSelect.appendChild(option);
+    }
+    if (!data.formats) {
+        const option = document.createElement('option');
+        option.value = '__all__';
+        option.textContent = 'Ver todos los formatos...';
+        videoSelect.appendChild(option);
+    }
     if (videoSelect.children.length === 0) {
         const option = document.createElement('option');
         option.value = '';
@@ -509,10 +630,11 @@ function populateVideoInfo(data, videoSelect, audioSelect) {
     if (audioSelect.children.length === 0) {
         const option = document.createElement('option');
         option.value = '';
-        option.textContent = 'No hay formatos de audio disponibles';
+        option.textContent = choices.length > 0 ? 'Incluido en la opción recomendada' : 'No hay formatos de audio disponibles';
         option.disabled = true;
         audioSelect.appendChild(option);
     }
+    audioSelect.disabled = videoSelect.value.startsWith('choice:');
 }
 
 // Inicializar la app al cargar
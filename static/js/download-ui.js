@@ -72,7 +72,9 @@ function renderDownloadProgress({
 function renderDownloadLinks({
     container,
     files,
-    title = "Descarga completada"
+    title = "Descarga completada",
+    archiveUrl = null, // Base de /downloads/<id> para descargar todo en un archivo
+    total = null // Total de archivos del trabajo si la lista viene paginada
 }) {
     if (!files || files.length === 0) {
         container.innerHTML += `
@@ -102,10 +104,33 @@ function renderDownloadLinks({
         `;
     });
 
+    // Con varios archivos, ofrecer todo en un solo ZIP o TAR generado al vuelo
+    let archiveHtml = '';
+    if (archiveUrl && files.length > 1) {
+        archiveHtml = `
+            <div>
+                <a href="${archiveUrl}.zip" class="btn btn-sm btn-light" download>
+                    <i class="bi bi-file-earmark-zip"></i> Descargar todo (.zip)
+                </a>
+                <a href="${archiveUrl}.tar" class="btn btn-sm btn-outline-light" download>.tar</a>
+            </div>
+        `;
+    }
+
+    // La API devuelve los archivos por páginas; el resto se obtiene con el archivo completo
+    if (total && total > files.length) {
+        linksHtml += `
+            <div class="list-group-item small text-secondary">
+                Mostrando ${files.length} de ${total} archivos.${archiveUrl ? ' Usa "Descargar todo" para obtener el resto.' : ''}
+            </div>
+        `;
+    }
+
     container.innerHTML += `
         <div class="card shadow-sm border-0 mb-3">
-            <div class="card-header bg-success text-white">
-                <i class="bi bi-check-circle"></i> ${title}
+            <div class="card-header bg-success text-white d-flex justify-content-between align-items-center">
+                <span><i class="bi bi-check-circle"></i> ${title}</span>
+                ${archiveHtml}
             </div>
             <div class="list-group list-group-flush">
                 ${linksHtml}